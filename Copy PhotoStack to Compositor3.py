@@ -9,25 +9,164 @@
 
 
 import bpy
+import os
+import sys
+
+script_text = bpy.data.texts.get(os.path.basename(__file__))
+script_path = __file__ if os.path.isfile(__file__) or not script_text else bpy.path.abspath(script_text.filepath)
+script_dir = os.path.dirname(os.path.abspath(script_path))
+if script_dir not in sys.path:
+    sys.path.append(script_dir)
+
+try:
+    import photostack_ir
+except ImportError as error:
+    raise ImportError(f"{error}. Keep photostack_ir.py next to this script and open it from disk to run it in the Text Editor") from error
+
+# Custom property naming the shader node a compositor node was synced from
+SOURCE_KEY = "photostack_source"
+
+def link_once(links, from_socket, to_socket):
+    """Link two sockets unless they already are, returning True if a link was made."""
+    if to_socket.is_linked and to_socket.links[0].from_socket == from_socket:
+        return False
+    links.new(from_socket, to_socket)
+    return True
+
+def sync_photostack_to_compositor(shader_node_group, scene):
+    """Mirror a PhotoStack group in the scene compositor, changing only what differs.
+
+    Every compositor node made here records the shader node it stands for, so
+    a later sync finds it again, updates its image, blend type and links where
+    they changed, and removes it once its layer is gone. Syncing an unchanged
+    stack only compares. Returns (added, updated, removed) node counts.
+    """
+    scene.use_nodes = True
+    compositor_nodes = scene.node_tree.nodes
+    compositor_links = scene.node_tree.links
+
+    # Create a Viewer Node if not already present
+    viewer_node = None
+    for node in compositor_nodes:
+        if node.type == 'VIEWER':
+            viewer_node = node
+            break
+
+    if not viewer_node:
+        viewer_node = compositor_nodes.new(type="CompositorNodeViewer")
+        viewer_node.location = (500, 300)
+
+    # Layers in chain order from the IR shared with the flattener
+    base, *layers = photostack_ir.get_stack_ir(shader_node_group).layers
+    if not base.image_node or base.image_node.type != 'TEX_IMAGE':
+        raise ValueError("The PhotoStack chain does not end in an image texture.")
+
+    # The nodes this stack owns from earlier syncs, found in one pass
+    prefix = f"{shader_node_group.name}/"
+    owned = {node[SOURCE_KEY]: node for node in compositor_nodes if node.get(SOURCE_KEY, "").startswith(prefix)}
+    wanted = set()
+    added = updated = 0
+
+    def get_owned(source_node, node_type, label, location):
+        nonlocal added
+        key = prefix + source_node.name
+        wanted.add(key)
+        node = owned.get(key)
+        if node is None:
+            node = compositor_nodes.new(type=node_type)
+            node.name = source_node.name
+            node.label = label
+            node[SOURCE_KEY] = key
+            owned[key] = node
+            added += 1
+        if tuple(node.location) != location:
+            node.location = location
+        return node
+
+    def sync_image(source_node, position, row=0.0):
+        nonlocal updated
+        node = get_owned(source_node, "CompositorNodeImage", "PhotoStack Image", (300.0 * position, row))
+        if node.image != source_node.image:
+            node.image = source_node.image
+            updated += 1
+        return node
+
+    running = sync_image(base.image_node, 0).outputs[0]
+    for position, layer in enumerate(layers, start=1):
+        if not layer.image:
+            print(f"Mix node {layer.mix_node.name} has no image texture on B, skipped.")
+            continue
+
+        # A factor linked to another image texture, like a mask, is copied as a link from
+        # that image; other linked factors have no compositor counterpart
+        factor_node = layer.factor_socket.node if layer.factor_source == 'LINK' else None
+        if factor_node and not (factor_node.type == 'TEX_IMAGE' and factor_node.image):
+            print(f"The factor of {layer.mix_node.name} comes from {factor_node.name}, which can't be copied, skipped.")
+            continue
+
+        layer_output = sync_image(layer.image_node, position).outputs[0]
+        compositor_mix = get_owned(layer.mix_node, "CompositorNodeMixRGB", "PhotoStack Mix", (300.0 * position, -300.0))
+        factor_output = None
+        if factor_node:
+            factor_image = sync_image(factor_node, position, 300.0)
+            factor_output = factor_image.outputs['Alpha'] if layer.factor_socket.name == 'Alpha' else factor_image.outputs[0]
+
+        # The layer's own alpha, a linked image or the factor value drives the mix
+        factor = layer.factor if layer.factor_source == 'VALUE' else 1.0
+        settings = {
+            "blend_type": layer.blend_type,
+            "use_alpha": layer.factor_source == 'ALPHA',
+            "use_clamp": layer.clamp,
+            "mute": not layer.visible,
+        }
+        changed = False
+        for attribute, value in settings.items():
+            if getattr(compositor_mix, attribute) != value:
+                setattr(compositor_mix, attribute, value)
+                changed = True
+        if compositor_mix.inputs[0].default_value != factor:
+            compositor_mix.inputs[0].default_value = factor
+            changed = True
+
+        if factor_output:
+            changed |= link_once(compositor_links, factor_output, compositor_mix.inputs[0])
+        elif compositor_mix.inputs[0].is_linked:
+            compositor_links.remove(compositor_mix.inputs[0].links[0])
+            changed = True
+        changed |= link_once(compositor_links, running, compositor_mix.inputs[1])
+        changed |= link_once(compositor_links, layer_output, compositor_mix.inputs[2])
+        updated += changed
+        running = compositor_mix.outputs[0]
+
+    link_once(compositor_links, running, viewer_node.inputs[0])
+
+    # Layers that left the stack take their compositor nodes with them
+    removed = 0
+    for key, node in owned.items():
+        if key not in wanted:
+            compositor_nodes.remove(node)
+            removed += 1
+
+    return added, updated, removed
 
 def copy_photostack_nodes_to_compositor():
     # Ensure an object is selected
     obj = bpy.context.active_object
     if not obj:
         print("No active object selected.")
-        return
+        return None
 
     # Ensure the object has an active material
     if not obj.active_material:
         print("The selected object has no active material.")
-        return
+        return None
 
     material = obj.active_material
 
     # Ensure the material uses nodes
     if not material.use_nodes:
         print("The active material does not use nodes.")
-        return
+        return None
 
     # Access the node tree of the active material
     node_tree = material.node_tree
@@ -36,87 +175,16 @@ def copy_photostack_nodes_to_compositor():
     # Check if the active node is a group node
     if not active_node or active_node.type != 'GROUP':
         print("The active node is not a group node.")
-        return
-
-    shader_node_group = active_node.node_tree
+        return None
 
-    # Enable Compositor Nodes
-    bpy.context.scene.use_nodes = True
-    compositor_nodes = bpy.context.scene.node_tree.nodes
-    compositor_links = bpy.context.scene.node_tree.links
+    try:
+        added, updated, removed = sync_photostack_to_compositor(active_node.node_tree, bpy.context.scene)
+    except ValueError as e:
+        print(e)
+        return None
 
-    # Create a Viewer Node if not already present
-    viewer_node = None
-    for node in compositor_nodes:
-        if node.type == 'VIEWER':
-            viewer_node = node
-            break
-
-    if not viewer_node:
-        viewer_node = compositor_nodes.new(type="CompositorNodeViewer")
-        viewer_node.location = (500, 300)
-
-    # Keep track of added image and mix nodes for connections
-    image_nodes = []
-    node_offset_x = 0
-    node_offset_y = 0
-    
-    # Iterate through nodes in photoStack, copying Image Texture and Mix nodes
-    mix_nodes = [node for node in shader_node_group.nodes if node.type == 'MIX']  # Updated to 'MIX'
-    if not mix_nodes:
-        print("No Mix nodes found in the PhotoStack group.")
-        return
-
-    # Print the blend types found in shader Mix nodes
-    for i, mix_node in enumerate(mix_nodes):
-        print(f"Shader Mix Node {i} blend type: {mix_node.blend_type}")
-
-    # Copy Image Texture nodes
-    for node in shader_node_group.nodes:
-        if node.type == 'TEX_IMAGE':
-            new_node = compositor_nodes.new(type="CompositorNodeImage")
-            new_node.location = (node_offset_x, node_offset_y)
-            new_node.label = "PhotoStack Image"
-            new_node.name = node.name
-            if node.image:
-                new_node.image = node.image
-            image_nodes.append(new_node)
-            node_offset_x += 300
-
-    if len(image_nodes) >= 2:
-        # First Mix node setup
-        first_mix = compositor_nodes.new(type="CompositorNodeMixRGB")
-        first_mix.location = (node_offset_x, node_offset_y)
-        first_mix.use_alpha = True
-        first_mix.blend_type = mix_nodes[0].blend_type
-        print(f"Set first compositor mix node blend type to: {first_mix.blend_type}")
-        
-        compositor_links.new(image_nodes[0].outputs[0], first_mix.inputs[1])
-        compositor_links.new(image_nodes[1].outputs[0], first_mix.inputs[2])
-        node_offset_x += 300
-
-        # Additional Mix nodes
-        previous_mix = first_mix
-        for i in range(2, len(image_nodes)):
-            mix_node = compositor_nodes.new(type="CompositorNodeMixRGB")
-            mix_node.location = (node_offset_x, node_offset_y)
-            mix_node.use_alpha = True
-            if i - 1 < len(mix_nodes):
-                blend_type = mix_nodes[i - 1].blend_type
-                mix_node.blend_type = blend_type
-                print(f"Set compositor mix node {i} blend type to: {blend_type}")
-            
-            # Link previous Mix node output to the current Mix node input 1
-            compositor_links.new(previous_mix.outputs[0], mix_node.inputs[1])
-            compositor_links.new(image_nodes[i].outputs[0], mix_node.inputs[2])
-            previous_mix = mix_node
-            node_offset_x += 300
-
-    else:
-        print("Insufficient image nodes to perform mixing.")
-
-    compositor_links.new(previous_mix.outputs[0], viewer_node.inputs[0])
-    print("PhotoStack nodes copied to the Compositor with alpha blending and blend types applied.")
+    print(f"PhotoStack synced to the Compositor: {added} nodes added, {updated} updated, {removed} removed.")
+    return added, updated, removed
 
 
 
@@ -142,17 +210,25 @@ class NODE_OT_copy_photostack_to_compositor(bpy.types.Operator):
     bl_label = "Copy PhotoStack to Compositor"
     
     def execute(self, context):
-        copy_photostack_nodes_to_compositor()
+        result = copy_photostack_nodes_to_compositor()
+        if result is None:
+            self.report({'ERROR'}, "Select a PhotoStack group node in a material first.")
+            return {'CANCELLED'}
+
+        added, updated, removed = result
+        self.report({'INFO'}, f"Synced PhotoStack: {added} added, {updated} updated, {removed} removed")
         return {'FINISHED'}
 
 # Register the panel and operator
 def register():
+    photostack_ir.register("compositor_copy")
     bpy.utils.register_class(NODE_PT_photostack_copy)
     bpy.utils.register_class(NODE_OT_copy_photostack_to_compositor)
 
 def unregister():
     bpy.utils.unregister_class(NODE_PT_photostack_copy)
     bpy.utils.unregister_class(NODE_OT_copy_photostack_to_compositor)
+    photostack_ir.unregister("compositor_copy")
 
 if __name__ == "__main__":
     register()
@@ -0,0 +1,113 @@
+"""Flatten every PhotoStack in a directory of .blend files.
+
+Runs flattener.py headless in several Blender processes at once and merges
+their timing records into one JSON report:
+
+    python batch_flatten.py /path/to/blends --output /path/to/out --jobs 4
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FLATTENER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flattener.py")
+
+
+def flatten_file(blender, blend_path, output_dir, file_format, threads, precision):
+    """Flatten one .blend in its own Blender process and return its timing records."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report_path = os.path.join(temp_dir, "report.json")
+        command = [
+            blender, "--background", blend_path,
+            # Without this Blender exits 0 even when the script raises
+            "--python-exit-code", "1",
+            "--python", FLATTENER_SCRIPT, "--",
+            "--output", output_dir,
+            "--format", file_format,
+            "--threads", str(threads),
+            "--precision", precision,
+            "--report", report_path,
+        ]
+
+        start = time.perf_counter()
+        process = subprocess.run(command, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+
+        records = None
+        if os.path.exists(report_path):
+            with open(report_path) as report_file:
+                try:
+                    records = json.load(report_file)
+                except ValueError:
+                    pass
+
+    result = {
+        "file": blend_path,
+        "seconds": round(elapsed, 3),
+        "returncode": process.returncode,
+        "groups": records or [],
+    }
+    if records is None:
+        result["error"] = "flattener.py wrote no report"
+    elif not records:
+        result["error"] = "No PhotoStack groups were flattened"
+    if file_failed(result):
+        result["stderr"] = process.stderr[-2000:]
+    return result
+
+def file_failed(result):
+    """True when Blender failed, the report is missing or empty, or any group has an error."""
+    return result["returncode"] != 0 or "error" in result or any("error" in group for group in result["groups"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flatten every PhotoStack in a directory of .blend files")
+    parser.add_argument("directory", help="Directory searched recursively for .blend files")
+    parser.add_argument("--output", required=True, help="Directory the flattened images are written to")
+    parser.add_argument("--blender", default="blender", help="Blender executable")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Blender processes run at once")
+    parser.add_argument("--threads", type=int, default=1, help="Threads blending row bands inside each process")
+    parser.add_argument("--format", default='PNG', choices=['PNG', 'OPEN_EXR'], help="File format of the flattened images")
+    parser.add_argument("--precision", default='FLOAT32', choices=['FLOAT32', 'FLOAT16', 'UINT8'], help="Working precision of the flatten")
+    parser.add_argument("--report", default="flatten_report.json", help="JSON timing report written at the end")
+    args = parser.parse_args(argv)
+
+    blend_paths = sorted(glob.glob(os.path.join(args.directory, "**", "*.blend"), recursive=True))
+    if not blend_paths:
+        print(f"No .blend files found in {args.directory}")
+        return 1
+
+    output_dir = os.path.abspath(args.output)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    # Threads only wait on the Blender processes, the work happens in those
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = [executor.submit(flatten_file, args.blender, path, output_dir, args.format, args.threads, args.precision) for path in blend_paths]
+        files = []
+        for future in futures:
+            files.append(future.result())
+            status = "FAILED" if file_failed(files[-1]) else "ok"
+            print(f"{files[-1]['file']}: {status}, {files[-1]['seconds']}s, {len(files[-1]['groups'])} stacks")
+
+    report = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "jobs": args.jobs,
+        "files": files,
+    }
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    failed = [entry for entry in files if file_failed(entry)]
+    print(f"Flattened {len(files)} files in {report['seconds']}s, {len(failed)} failed, report written to {args.report}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""NumPy versions of Blender's MixRGB blend modes.
+
+Each kernel takes the base colour a, the blend colour b and the factor fac
+(a scalar or an array broadcastable against the RGB channels) and follows
+ramp_blend() in Blender's source, so results match the shader Mix node and the
+compositor MixRGB node. The sRGB transfer curves the image scripts convert
+byte images with live here too. This module has no bpy dependency and can be
+imported by any of the image scripts, or from a plain Python shell.
+"""
+
+import time
+
+import numpy as np
+
+
+def blend_mix(a, b, fac):
+    return a * (1.0 - fac) + b * fac
+
+def blend_darken(a, b, fac):
+    return a * (1.0 - fac) + np.minimum(a, b) * fac
+
+def blend_multiply(a, b, fac):
+    return a * ((1.0 - fac) + b * fac)
+
+def blend_burn(a, b, fac):
+    tmp = (1.0 - fac) + b * fac
+    with np.errstate(divide='ignore', invalid='ignore'):
+        burned = 1.0 - (1.0 - a) / tmp
+    return np.where(tmp <= 0.0, 0.0, np.clip(burned, 0.0, 1.0))
+
+def blend_lighten(a, b, fac):
+    return a * (1.0 - fac) + np.maximum(a, b) * fac
+
+def blend_screen(a, b, fac):
+    return 1.0 - ((1.0 - fac) + fac * (1.0 - b)) * (1.0 - a)
+
+def blend_dodge(a, b, fac):
+    tmp = 1.0 - fac * b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dodged = np.where(tmp <= 0.0, 1.0, np.minimum(a / tmp, 1.0))
+    return np.where(a != 0.0, dodged, a)
+
+def blend_add(a, b, fac):
+    return a + b * fac
+
+def blend_overlay(a, b, fac):
+    facm = 1.0 - fac
+    low = a * (facm + 2.0 * fac * b)
+    high = 1.0 - (facm + 2.0 * fac * (1.0 - b)) * (1.0 - a)
+    return np.where(a < 0.5, low, high)
+
+def blend_soft_light(a, b, fac):
+    screen = 1.0 - (1.0 - b) * (1.0 - a)
+    return a * (1.0 - fac) + fac * ((1.0 - a) * b * a + a * screen)
+
+def blend_linear_light(a, b, fac):
+    return np.where(b > 0.5, a + fac * (2.0 * (b - 0.5)), a + fac * (2.0 * b - 1.0))
+
+def blend_difference(a, b, fac):
+    return a * (1.0 - fac) + np.abs(a - b) * fac
+
+def blend_exclusion(a, b, fac):
+    return np.maximum(a * (1.0 - fac) + fac * (a + b - 2.0 * a * b), 0.0)
+
+def blend_subtract(a, b, fac):
+    return a - b * fac
+
+def blend_divide(a, b, fac):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        divided = a * (1.0 - fac) + fac * a / b
+    return np.where(b != 0.0, divided, a)
+
+def rgb_to_hsv(rgb):
+    """Vectorized rgb_to_hsv() from BLI_math_color, hue in [0, 1)."""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = np.maximum(np.maximum(r, g), b)
+    delta = maxc - np.minimum(np.minimum(r, g), b)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(maxc > 0.0, delta / maxc, 0.0)
+        h = np.where(r == maxc, (g - b) / delta,
+            np.where(g == maxc, 2.0 + (b - r) / delta, 4.0 + (r - g) / delta))
+    h = np.where(delta > 0.0, (h / 6.0) % 1.0, 0.0)
+
+    return h, s, maxc
+
+def hsv_to_rgb(h, s, v):
+    """Vectorized hsv_to_rgb() from BLI_math_color."""
+    h6 = h[..., np.newaxis] * 6.0 - np.array([3.0, 2.0, 4.0], dtype=np.float32)
+    rgb = np.abs(h6)
+    rgb[..., 0] -= 1.0
+    rgb[..., 1:] = 2.0 - rgb[..., 1:]
+    np.clip(rgb, 0.0, 1.0, out=rgb)
+    return ((rgb - 1.0) * s[..., np.newaxis] + 1.0) * v[..., np.newaxis]
+
+def blend_hue(a, b, fac):
+    a_h, a_s, a_v = rgb_to_hsv(a)
+    b_h, b_s, b_v = rgb_to_hsv(b)
+    tmp = hsv_to_rgb(b_h, a_s, a_v)
+    return np.where((b_s != 0.0)[..., np.newaxis], a * (1.0 - fac) + tmp * fac, a)
+
+def blend_saturation(a, b, fac):
+    a_h, a_s, a_v = rgb_to_hsv(a)
+    b_h, b_s, b_v = rgb_to_hsv(b)
+    fac_s = fac[..., 0] if isinstance(fac, np.ndarray) and fac.ndim == a.ndim else fac
+    tmp = hsv_to_rgb(a_h, a_s * (1.0 - fac_s) + b_s * fac_s, a_v)
+    return np.where((a_s != 0.0)[..., np.newaxis], tmp, a)
+
+def blend_value(a, b, fac):
+    a_h, a_s, a_v = rgb_to_hsv(a)
+    b_h, b_s, b_v = rgb_to_hsv(b)
+    fac_v = fac[..., 0] if isinstance(fac, np.ndarray) and fac.ndim == a.ndim else fac
+    return hsv_to_rgb(a_h, a_s, a_v * (1.0 - fac_v) + b_v * fac_v)
+
+def blend_color(a, b, fac):
+    a_h, a_s, a_v = rgb_to_hsv(a)
+    b_h, b_s, b_v = rgb_to_hsv(b)
+    tmp = hsv_to_rgb(b_h, b_s, a_v)
+    return np.where((b_s != 0.0)[..., np.newaxis], a * (1.0 - fac) + tmp * fac, a)
+
+# Keyed by the blend_type identifiers of ShaderNodeMix and CompositorNodeMixRGB
+BLEND_KERNELS = {
+    'MIX': blend_mix,
+    'DARKEN': blend_darken,
+    'MULTIPLY': blend_multiply,
+    'BURN': blend_burn,
+    'LIGHTEN': blend_lighten,
+    'SCREEN': blend_screen,
+    'DODGE': blend_dodge,
+    'ADD': blend_add,
+    'OVERLAY': blend_overlay,
+    'SOFT_LIGHT': blend_soft_light,
+    'LINEAR_LIGHT': blend_linear_light,
+    'DIFFERENCE': blend_difference,
+    'EXCLUSION': blend_exclusion,
+    'SUBTRACT': blend_subtract,
+    'DIVIDE': blend_divide,
+    'HUE': blend_hue,
+    'SATURATION': blend_saturation,
+    'COLOR': blend_color,
+    'VALUE': blend_value,
+}
+
+def blend_rgba(blend_mode, a, b, fac, use_alpha=False, clamp=False):
+    """Blend RGBA arrays the way the compositor MixRGB node does.
+
+    With use_alpha the factor is scaled by the alpha of b. The result keeps the
+    alpha of a, and clamp limits the colour to [0, 1] like use_clamp.
+    """
+    if use_alpha:
+        fac = fac * b[..., 3]
+    if isinstance(fac, np.ndarray) and fac.ndim == a.ndim - 1:
+        fac = fac[..., np.newaxis]
+
+    result = a.copy()
+    result[..., :3] = BLEND_KERNELS[blend_mode](a[..., :3], b[..., :3], fac)
+    if clamp:
+        np.clip(result[..., :3], 0.0, 1.0, out=result[..., :3])
+    return result
+
+def srgb_to_linear(values, out=None, scratch=None):
+    """Decode sRGB values to linear float32.
+
+    Writes into out when given, which may be values itself, and takes the
+    curve's temporary from scratch (shaped like values) when given.
+    """
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float32)
+    if scratch is None:
+        scratch = np.empty(values.shape, dtype=np.float32)
+
+    curve = values > 0.04045
+    np.add(values, 0.055, out=scratch)
+    scratch /= 1.055
+    with np.errstate(invalid='ignore'):
+        np.power(scratch, 2.4, out=scratch)
+    np.divide(values, 12.92, out=out)
+    np.copyto(out, scratch, where=curve)
+    return out
+
+def linear_to_srgb(values, out=None, scratch=None):
+    """Encode linear values to sRGB float32, clamping negatives to 0.
+
+    out and scratch work as in srgb_to_linear().
+    """
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float32)
+    if scratch is None:
+        scratch = np.empty(values.shape, dtype=np.float32)
+
+    np.maximum(values, 0.0, out=out)
+    curve = out > 0.0031308
+    np.power(out, 1.0 / 2.4, out=scratch)
+    scratch *= 1.055
+    scratch -= 0.055
+    out *= 12.92
+    np.copyto(out, scratch, where=curve)
+    return out
+
+def benchmark_kernels(size=2048, repeats=3):
+    """Print the throughput of every kernel in megapixels per second."""
+    rng = np.random.default_rng(0)
+    a = rng.random((size, size, 3), dtype=np.float32)
+    b = rng.random((size, size, 3), dtype=np.float32)
+    fac = rng.random((size, size, 1), dtype=np.float32)
+    megapixels = size * size / 1e6
+
+    for blend_mode, kernel in BLEND_KERNELS.items():
+        best = None
+        for i in range(repeats):
+            start = time.perf_counter()
+            kernel(a, b, fac)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{blend_mode:<13} {megapixels / best:8.1f} MP/s")
+
+
+if __name__ == "__main__":
+    benchmark_kernels()
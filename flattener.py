@@ -1,41 +1,693 @@
 import bpy
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-def create_compositor_node_tree(image1, image2, blend_mode):
-    bpy.context.scene.use_nodes = True
-    tree = bpy.context.scene.node_tree
+# Shared modules sit next to the scripts. Run from the Text Editor, __file__ is
+# <blend path>/<text name>, so look for the file the text was opened from.
+script_text = bpy.data.texts.get(os.path.basename(__file__))
+script_path = __file__ if os.path.isfile(__file__) or not script_text else bpy.path.abspath(script_text.filepath)
+script_dir = os.path.dirname(os.path.abspath(script_path))
+if script_dir not in sys.path:
+    sys.path.append(script_dir)
 
-    for node in tree.nodes:
-        tree.nodes.remove(node)
+try:
+    from blend_kernels import BLEND_KERNELS, blend_mix, blend_rgba, srgb_to_linear
+    import photostack_ir
+    from stack_pixels import (FLATTEN_BAND_ROWS, FLATTEN_TILE_SIZE, PRECISION_DTYPES, BandScratch, blend_layer_into,
+                              cut_tiles, decode_pixels, encode_pixels, get_mix_factor, iter_reflatten_dirty_tiles,
+                              iter_tile_checksums, place_crop, reduce_crop_pixels, run_job, scale_progress)
+except ImportError as error:
+    raise ImportError(f"{error}. Keep blend_kernels.py, photostack_ir.py and stack_pixels.py next to flattener.py and open it from disk to run it in the Text Editor") from error
 
-    image_node1 = tree.nodes.new(type='CompositorNodeImage')
-    image_node1.image = image1
-    image_node1.location = -300, 200
+PRECISION_ITEMS = [
+    ('FLOAT32', "Float 32", "Full precision, 16 bytes per pixel"),
+    ('FLOAT16', "Float 16", "Half precision, 8 bytes per pixel"),
+    ('UINT8', "8-bit sRGB", "sRGB encoded bytes, 4 bytes per pixel, clamps to 0-1"),
+]
 
-    image_node2 = tree.nodes.new(type='CompositorNodeImage')
-    image_node2.image = image2
-    image_node2.location = -300, -200
+# Flatten results kept for reuse before the least recently used is dropped
+FLATTEN_CACHE_MAX_ENTRIES = 8
 
-    mix_node = tree.nodes.new(type='CompositorNodeMixRGB')
-    mix_node.blend_type = blend_mode
-    mix_node.location = 200, 0
+# Seconds of flatten work done per timer tick by the modal operator
+FLATTEN_MODAL_SLICE = 0.05
 
-    tree.links.new(image_node1.outputs[0], mix_node.inputs[1])
-    tree.links.new(image_node2.outputs[1], mix_node.inputs[0])
-    tree.links.new(image_node2.outputs[0], mix_node.inputs[2])
+# Seconds between refreshes of the live preview
+FLATTEN_PREVIEW_INTERVAL = 0.25
 
-    composite_node = tree.nodes.new(type='CompositorNodeComposite')
-    composite_node.location = 400, 0
+# Downsample factors of the live preview
+PREVIEW_FACTOR_ITEMS = [
+    ('2', "1/2", "Half resolution"),
+    ('4', "1/4", "Quarter resolution"),
+    ('8', "1/8", "Eighth resolution"),
+]
 
-    tree.links.new(mix_node.outputs[0], composite_node.inputs[0])
+def stack_image_size(image):
+    """Resolution of image within its stack, sparse PhotoStack layers are stored smaller."""
+    if "photostack_size" in image:
+        return tuple(image["photostack_size"])
+    return tuple(image.size)
 
-def render_and_extract_image(output_name, width, height):
-    bpy.context.scene.render.resolution_x = width
-    bpy.context.scene.render.resolution_y = height
-    bpy.context.scene.render.image_settings.file_format = 'PNG'
-    bpy.context.scene.render.filepath = f'/tmp/{output_name}.png'
-    bpy.ops.render.render(write_still=True)
-    combined_image = bpy.data.images.load(bpy.context.scene.render.filepath)
-    return combined_image
+def read_image_pixels(image, buffer=None):
+    """Read an image into a float32 (height, width, 4) array in linear space.
+
+    Sparse PhotoStack layers come back at their full stack resolution, with the
+    stored crop placed at its offset on a transparent canvas. Pass a
+    preallocated flat buffer to reuse it across layers of the same size.
+    """
+    return run_job(iter_read_image_pixels(image, buffer))
+
+def iter_read_image_pixels(image, buffer=None):
+    """read_image_pixels() as a job, yielding the fraction done after each band is converted.
+
+    The foreach_get itself is a single call and cannot be split.
+    """
+    full_width, full_height = stack_image_size(image)
+    if (full_width, full_height) == tuple(image.size):
+        return (yield from iter_read_stored_pixels(image, buffer))
+
+    if buffer is None or buffer.size != full_width * full_height * 4:
+        buffer = np.empty(full_width * full_height * 4, dtype=np.float32)
+    pixels = buffer.reshape(full_height, full_width, 4)
+
+    if "photostack_offset" not in image:
+        pixels[...] = 0.0
+        return pixels
+    crop = yield from iter_read_stored_pixels(image)
+    return place_crop(crop, image["photostack_offset"], (full_width, full_height), out=pixels)
+
+def read_stored_pixels(image, buffer=None):
+    """Read the pixels an image actually stores as float32 (height, width, 4) in linear space."""
+    return run_job(iter_read_stored_pixels(image, buffer))
+
+def iter_read_stored_pixels(image, buffer=None):
+    width, height = image.size
+    channels = image.channels
+    stored = buffer if buffer is not None and buffer.size == width * height * channels else np.empty(width * height * channels, dtype=np.float32)
+    image.pixels.foreach_get(stored)
+    # An RGB or gray image is expanded into the RGBA buffer rather than a new array
+    out = buffer if channels != 4 and buffer is not None and buffer.size == width * height * 4 else None
+    return (yield from iter_stored_to_linear(image, stored.reshape(height, width, channels), out=out))
+
+def iter_stored_to_linear(image, buffer, band_rows=FLATTEN_BAND_ROWS, out=None):
+    """Turn the (height, width, channels) values foreach_get returned for image into linear RGBA.
+
+    Values with fewer than 4 channels are expanded into out when given. Converts
+    one band of rows at a time, yielding the fraction done after each.
+    """
+    height, width, channels = buffer.shape
+    if channels == 4:
+        pixels = buffer
+    else:
+        pixels = np.empty((height, width, 4), dtype=np.float32) if out is None else out.reshape(height, width, 4)
+        pixels[...] = 1.0
+        pixels[..., :min(channels, 3)] = buffer[..., :3]
+        if channels == 1:
+            pixels[..., 1] = pixels[..., 2] = buffer[..., 0]
+
+    # Byte images hand back their stored (sRGB) values, the compositor blends in linear
+    if not image.is_float and image.colorspace_settings.name == 'sRGB':
+        scratch = np.empty((min(band_rows, height), width, 3), dtype=np.float32)
+        for row in range(0, height, band_rows):
+            rows = pixels[row:row + band_rows, :, :3]
+            srgb_to_linear(rows, rows, scratch[:rows.shape[0]])
+            yield min(row + band_rows, height) / height
+
+    return pixels
+
+def write_image_pixels(name, pixels):
+    height, width = pixels.shape[:2]
+    image = bpy.data.images.new(name, width=width, height=height, alpha=True, float_buffer=True)
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+    return image
+
+def flatten_pixels(base, layer, blend_mode, factor, clamp=False):
+    """Blend layer over base in memory, keeping the base alpha like the compositor does."""
+    return blend_rgba(blend_mode, base, layer, factor, clamp=clamp)
+
+def get_mix_inputs(mix_node, image_nodes):
+    """Return (base node, layer node) from the Mix node links, falling back to selection order."""
+    linked = {}
+    for socket_name in ('A', 'B'):
+        from_socket = photostack_ir.get_linked_socket(mix_node, socket_name)
+        if from_socket and from_socket.node in image_nodes:
+            linked[socket_name] = from_socket.node
+
+    if len(linked) == 2:
+        return linked['A'], linked['B']
+    return image_nodes[0], image_nodes[1]
+
+def check_layer_factor(layer):
+    """Raise ValueError for a layer whose factor is linked to anything but its own alpha."""
+    if layer.factor_source == 'LINK':
+        raise ValueError(f"The factor of {layer.mix_node.name} comes from {layer.factor_socket.node.name}, "
+                         "only a layer's own alpha or a factor value can be flattened")
+
+def find_photostack_group(node_tree):
+    """Return the active '_photostack' group node, or the first one in the tree."""
+    active_node = node_tree.nodes.active
+    if active_node and active_node.type == 'GROUP' and active_node.node_tree and "_photostack" in active_node.node_tree.name:
+        return active_node
+
+    for node in node_tree.nodes:
+        if node.type == 'GROUP' and node.node_tree and "_photostack" in node.node_tree.name:
+            return node
+    return None
+
+def collect_stack_layers(nodegroup):
+    """Return the layers of a PhotoStack group from its shared stack IR.
+
+    Returns (base, layers), the StackLayers bottom to top. Hidden layers, whose
+    Mix nodes are muted, are left out.
+    """
+    stack_ir = photostack_ir.get_stack_ir(nodegroup)
+    base = stack_ir.layers[0]
+    if not base.image_node or base.image_node.type != 'TEX_IMAGE':
+        raise ValueError("Mix chain does not end in an image texture")
+
+    layers = []
+    for layer in stack_ir.layers[1:]:
+        if not layer.image_node or layer.image_node.type != 'TEX_IMAGE':
+            raise ValueError(f"Mix node {layer.mix_node.name} has no image texture on B")
+        if "photostack_atlas_rect" in layer.image_node:
+            raise ValueError(f"Layer {layer.image_node.name} is packed into an atlas, unpack the stack before flattening")
+        if layer.visible:
+            check_layer_factor(layer)
+            layers.append(layer)
+
+    return base, layers
+
+def iter_flatten_stack_pixels(base_image, layers, band_rows=FLATTEN_BAND_ROWS, workers=1, precision='FLOAT32'):
+    """Composite every StackLayer in layers over base_image in one pass.
+
+    Layers are read one at a time into a shared buffer and blended band by band
+    into the result, so peak memory is the result plus one layer and one band of
+    temporaries, whatever the number of layers. The band is split between the
+    workers, so the temporaries in flight do not grow with the worker count
+    either. Below float32 the result is held at that precision and the float32
+    layer buffer is reused for the final pixels. Yields the fraction done after
+    each chunk of bands and returns the float32 result.
+    """
+    base = yield from scale_progress(iter_read_image_pixels(base_image), 0.0, 0.0)
+    height, width = base.shape[:2]
+    chunk_rows = band_rows * 2
+    # Below float32 a band also needs decode scratch, a quarter of the rows keeps the
+    # temporaries well under what the smaller result saves
+    band_rows = max(band_rows // (workers if precision == 'FLOAT32' else workers * 4), 1)
+    scratch = BandScratch()
+
+    if precision == 'FLOAT32':
+        result = base
+        buffer = None
+    else:
+        result = np.empty(base.shape, dtype=PRECISION_DTYPES[precision])
+        for row in range(0, height, band_rows):
+            rows = slice(row, row + band_rows)
+            encode_pixels(base[rows], precision, result[rows], scratch.get("curve", base[rows, :, :3].shape))
+        # The base now lives in result, its float32 memory becomes the layer buffer
+        buffer = base.reshape(-1)
+    del base
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+        for index, layer in enumerate(layers):
+            layer_pixels = yield from scale_progress(iter_read_image_pixels(layer.image, buffer), index / len(layers), index / len(layers))
+            buffer = layer_pixels.reshape(-1)
+
+            kernel = BLEND_KERNELS[layer.blend_type]
+            factor = get_mix_factor(layer, layer_pixels)
+            clamp = layer.clamp
+
+            for row in range(0, height, chunk_rows):
+                rows = slice(row, row + chunk_rows)
+                fac = factor[rows] if isinstance(factor, np.ndarray) else factor
+                blend_layer_into(result[rows], layer_pixels[rows], kernel, fac, clamp, band_rows, executor, precision, scratch)
+                yield (index + min(row + chunk_rows, height) / height) / len(layers)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    if precision != 'FLOAT32':
+        pixels = buffer.reshape(height, width, 4) if buffer is not None and buffer.size == result.size else np.empty(result.shape, dtype=np.float32)
+        for row in range(0, height, band_rows):
+            rows = slice(row, row + band_rows)
+            decode_pixels(result[rows], precision, pixels[rows], scratch.get("curve", pixels[rows, :, :3].shape))
+        result = pixels
+
+    return result
+
+def flatten_stack_pixels(base_image, layers, band_rows=FLATTEN_BAND_ROWS, workers=1, precision='FLOAT32'):
+    return run_job(iter_flatten_stack_pixels(base_image, layers, band_rows, workers, precision))
+
+def compare_flatten_precisions(base_image, layers, workers=1):
+    """Flatten in every precision and measure it against float32.
+
+    Returns {precision: {"peak_bytes": ..., "max_error": ...}} where peak_bytes
+    is the largest amount of NumPy memory held during that flatten.
+    """
+    reference = None
+    report = {}
+    for precision in PRECISION_DTYPES:
+        tracemalloc.start()
+        result = flatten_stack_pixels(base_image, layers, workers=workers, precision=precision)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if reference is None:
+            reference = result
+        report[precision] = {
+            "peak_bytes": peak,
+            "max_error": float(np.abs(result - reference).max()),
+        }
+    return report
+
+def benchmark_parallel_flatten(size=4096, layer_counts=(4, 8, 16), worker_counts=None):
+    """Time the banded flatten on synthetic stacks for each worker count.
+
+    Run from Blender's Python console; prints seconds and speedup over one worker.
+    """
+    if worker_counts is None:
+        worker_counts = sorted({1, 2, 4, 8, 16, os.cpu_count() or 1})
+
+    rng = np.random.default_rng(0)
+    base = rng.random((size, size, 4), dtype=np.float32)
+    layer = rng.random((size, size, 4), dtype=np.float32)
+
+    for layer_count in layer_counts:
+        single = None
+        for workers in worker_counts:
+            result = base.copy()
+            executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+            start = time.perf_counter()
+            for i in range(layer_count):
+                blend_layer_into(result, layer, blend_mix, layer[..., 3], executor=executor)
+            elapsed = time.perf_counter() - start
+            if executor:
+                executor.shutdown()
+
+            single = single or elapsed
+            print(f"{layer_count} layers, {workers} workers: {elapsed:.3f}s ({single / elapsed:.2f}x)")
+
+def get_mix_settings(layer):
+    """Everything besides the pixels that changes what a StackLayer's Mix node produces."""
+    return (
+        layer.blend_type,
+        layer.factor_source,
+        round(layer.factor, 6) if layer.factor_source == 'VALUE' else None,
+        layer.clamp,
+    )
+
+class FlattenCache:
+    """LRU map from a hash of the flatten inputs to the name of the result image."""
+
+    def __init__(self, max_entries=FLATTEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        image_name = self.entries.get(key)
+        image = bpy.data.images.get(image_name) if image_name else None
+        if image is None:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        self.entries[key] = image.name
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            old_key, old_name = self.entries.popitem(last=False)
+            old_image = bpy.data.images.get(old_name)
+            # Only drop the datablock if no node uses it anymore
+            if old_image and old_image.users == 0:
+                bpy.data.images.remove(old_image)
+
+    def discard_image(self, image_name):
+        """Forget every key pointing at an image whose pixels were changed in place."""
+        for key in [key for key, name in self.entries.items() if name == image_name]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+flatten_cache = FlattenCache()
+
+def flatten_cache_key(images, mix_settings):
+    """Hash the pixel buffers, resolution and Mix settings of a flatten."""
+    digest = hashlib.blake2b(digest_size=16)
+    buffer = None
+    for image in images:
+        width, height = image.size
+        size = width * height * image.channels
+        if buffer is None or buffer.size != size:
+            buffer = np.empty(size, dtype=np.float32)
+        image.pixels.foreach_get(buffer)
+        digest.update(repr((width, height, image.channels)).encode())
+        digest.update(buffer)
+    digest.update(repr(mix_settings).encode())
+    return digest.hexdigest()
+
+def iter_image_tile_checksums(image, tile_size=FLATTEN_TILE_SIZE):
+    if stack_image_size(image) != tuple(image.size):
+        pixels = yield from scale_progress(iter_read_image_pixels(image), 0.0, 0.5)
+        return (yield from scale_progress(iter_tile_checksums(pixels, tile_size), 0.5, 1.0))
+
+    width, height = image.size
+    buffer = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(buffer)
+    return (yield from iter_tile_checksums(buffer.reshape(height, width, image.channels), tile_size))
+
+def iter_read_checksummed_pixels(image, tile_size=FLATTEN_TILE_SIZE):
+    """Read an image like read_image_pixels() and return (tile checksums, pixels) from that one read."""
+    if stack_image_size(image) != tuple(image.size):
+        pixels = yield from scale_progress(iter_read_image_pixels(image), 0.0, 0.5)
+        sums = yield from scale_progress(iter_tile_checksums(pixels, tile_size), 0.5, 1.0)
+        return sums, pixels
+
+    width, height = image.size
+    buffer = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(buffer)
+    buffer = buffer.reshape(height, width, image.channels)
+    # Checksum the stored values, like iter_image_tile_checksums(), before they are converted
+    sums = yield from scale_progress(iter_tile_checksums(buffer, tile_size), 0.0, 0.5)
+    pixels = yield from scale_progress(iter_stored_to_linear(image, buffer), 0.5, 1.0)
+    return sums, pixels
+
+def iter_stack_tile_checksums(images):
+    """Return the tile checksums of every image, yielding the fraction done after each band."""
+    checksums = []
+    for index, image in enumerate(images):
+        painted_images.discard(image.name)
+        checksums.append((yield from scale_progress(iter_image_tile_checksums(image), index / len(images), (index + 1) / len(images))))
+    return checksums
+
+def stack_cache_key(images, checksums, mix_settings):
+    """Hash the tile checksums, resolution and Mix settings of a stack flatten."""
+    digest = hashlib.blake2b(digest_size=16)
+    for image, sums in zip(images, checksums):
+        digest.update(repr((tuple(image.size), image.channels)).encode())
+        digest.update(sums)
+    digest.update(repr(mix_settings).encode())
+    return digest.hexdigest()
+
+def iter_read_dirty_tiles(images, old_checksums, tile_size=FLATTEN_TILE_SIZE):
+    """Read every image once, comparing its tile checksums with the last flatten right away.
+
+    Images painted since they were last flattened are read first and held
+    whole until every change is known; the others keep only the tiles found
+    dirty so far. An image changed without being marked can dirty tiles that
+    images read before it did not keep; only those images are read again, for
+    just the missing tiles. Yields the fraction done after each image and
+    returns (checksums, tiles) where tiles[i] maps the (y, x) corner of every
+    dirty tile to that tile of image i. tiles is None when the image sizes
+    changed, the caller then has to flatten in full.
+    """
+    order = sorted(range(len(images)), key=lambda index: images[index].name not in painted_images)
+    checksums = [None] * len(images)
+    kept = [None] * len(images)
+    dirty = None
+
+    for count, index in enumerate(order, 1):
+        image = images[index]
+        marked = image.name in painted_images
+        painted_images.discard(image.name)
+        sums, pixels = yield from scale_progress(iter_read_checksummed_pixels(image, tile_size), (count - 1) / len(images), count / len(images))
+        checksums[index] = sums
+
+        if kept is not None:
+            old = old_checksums[index]
+            if dirty is None:
+                dirty = np.zeros(sums.shape, dtype=bool)
+            if old.shape != sums.shape or sums.shape != dirty.shape:
+                kept = None
+            else:
+                dirty |= old != sums
+
+        if kept is not None:
+            kept[index] = pixels if marked else cut_tiles(pixels, np.argwhere(dirty), tile_size)
+        del pixels
+
+    if kept is None:
+        return checksums, None
+
+    corners = [(ty * tile_size, tx * tile_size) for ty, tx in np.argwhere(dirty)]
+    tiles = []
+    for index, pixels in enumerate(kept):
+        if not isinstance(pixels, dict):
+            tiles.append(cut_tiles(pixels, np.argwhere(dirty), tile_size))
+            continue
+        missing = [(y // tile_size, x // tile_size) for y, x in corners if (y, x) not in pixels]
+        if missing:
+            # Dirtied by an unmarked image read after this one, read it again for those tiles
+            pixels.update(cut_tiles((yield from scale_progress(iter_read_image_pixels(images[index]), 1.0, 1.0)), missing, tile_size))
+        tiles.append(pixels)
+    return checksums, tiles
+
+# Per PhotoStack group: result image, inputs and tile checksums of the last flatten
+flatten_tile_states = {}
+
+# Names of the images updated since a flatten last read them, incremental flattens read these first
+painted_images = set()
+
+def iter_flatten_photostack(nodegroup, base_image, layers, workers=1, precision='FLOAT32'):
+    """Flatten a stack into an image, reusing whatever the last flatten left valid.
+
+    Yields the fraction done as it goes. Nothing in bpy.data is touched until
+    the last step, so closing the generator early cancels cleanly. Returns
+    (image, how) where how is 'cached' when an identical flatten was found,
+    'incremental' when only changed tiles of the previous result were
+    re-blended, or 'full'.
+    """
+    images = [base_image] + [layer.image for layer in layers]
+    mix_settings = [precision] + [get_mix_settings(layer) for layer in layers]
+    input_names = [image.name for image in images]
+    state = flatten_tile_states.get(nodegroup.name)
+    combined_image = bpy.data.images.get(state["image"]) if state else None
+
+    if (combined_image and state["inputs"] == input_names and state["settings"] == mix_settings
+            and tuple(combined_image.size) == stack_image_size(base_image)):
+        # Each image is read once: its checksums are compared and its dirty tiles kept from that read
+        checksums, tiles = yield from scale_progress(iter_read_dirty_tiles(images, state["checksums"]), 0.0, 0.8)
+        read_end = 0.8
+    else:
+        checksums = yield from scale_progress(iter_stack_tile_checksums(images), 0.0, 0.3)
+        tiles = None
+        read_end = 0.3
+
+    cache_key = stack_cache_key(images, checksums, mix_settings)
+    cached_image = flatten_cache.get(cache_key)
+    if cached_image:
+        return cached_image, 'cached'
+
+    if tiles is not None:
+        if tiles[0]:
+            combined_pixels = read_image_pixels(combined_image)
+            yield from scale_progress(iter_reflatten_dirty_tiles(combined_pixels, layers, tiles, precision), read_end, 1.0)
+            combined_image.pixels.foreach_set(combined_pixels.ravel())
+            combined_image.update()
+        flatten_cache.discard_image(combined_image.name)
+        how = 'incremental'
+    else:
+        combined_pixels = yield from scale_progress(iter_flatten_stack_pixels(base_image, layers, workers=workers, precision=precision), read_end, 1.0)
+        # Into the existing result, so flattening again doesn't pile up _flat.001, .002 images
+        combined_image = update_image_pixels(f"{nodegroup.name}_flat", combined_pixels)
+        flatten_cache.discard_image(combined_image.name)
+        how = 'full'
+
+    flatten_cache.put(cache_key, combined_image)
+    flatten_tile_states[nodegroup.name] = {
+        "image": combined_image.name,
+        "inputs": input_names,
+        "settings": mix_settings,
+        "checksums": checksums,
+    }
+    return combined_image, how
+
+def flatten_photostack(nodegroup, base_image, layers, workers=1, precision='FLOAT32'):
+    return run_job(iter_flatten_photostack(nodegroup, base_image, layers, workers, precision))
+
+def reduce_image_pixels(image, factor):
+    """Box-reduce an image to 1/factor of its stack resolution, as linear float32.
+
+    Only the stored pixels are read; a sparse layer's crop is aligned to the
+    reduction grid first, so the result matches reducing the full canvas.
+    Colors are averaged premultiplied so transparent pixels do not darken
+    painted edges.
+    """
+    size = stack_image_size(image)
+    if size == tuple(image.size):
+        offset = (0, 0)
+    elif "photostack_offset" in image:
+        offset = image["photostack_offset"]
+    else:
+        # A placeholder that was never painted on
+        return np.zeros((-(-size[1] // factor), -(-size[0] // factor), 4), dtype=np.float32)
+    return reduce_crop_pixels(read_stored_pixels(image), offset, size, factor)
+
+def update_image_pixels(name, pixels):
+    """Write pixels to the float image called name, creating or resizing it as needed."""
+    image = bpy.data.images.get(name)
+    if image is None:
+        return write_image_pixels(name, pixels)
+
+    height, width = pixels.shape[:2]
+    if tuple(image.size) != (width, height):
+        image.scale(width, height)
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+    return image
+
+class StackPreview:
+    """Reduced-resolution composite of one PhotoStack, refreshed layer by layer.
+
+    Each layer keeps its reduction until it is painted on, so a refresh reads
+    only the changed layers and blends everything at the reduced size.
+    """
+
+    def __init__(self, nodegroup_name):
+        self.nodegroup_name = nodegroup_name
+        self.image_name = f"{nodegroup_name}_preview"
+        self.factor = None
+        self.reductions = {}
+        self.changed = set()
+        self.settings = None
+
+    def refresh(self, factor):
+        """Bring the preview image up to date, returning the number of layers reduced again."""
+        nodegroup = bpy.data.node_groups.get(self.nodegroup_name)
+        if nodegroup is None:
+            raise ValueError(f"PhotoStack {self.nodegroup_name} no longer exists")
+        if factor != self.factor:
+            self.reductions.clear()
+            self.factor = factor
+
+        base, layers = collect_stack_layers(nodegroup)
+        images = [base.image] + [layer.image for layer in layers]
+        reduced = 0
+        for image in images:
+            if image.name in self.changed or image.name not in self.reductions:
+                self.reductions[image.name] = reduce_image_pixels(image, factor)
+                reduced += 1
+        self.changed.clear()
+
+        settings = [(layer.mix_node.name, layer.image.name) + get_mix_settings(layer) for layer in layers]
+        if not reduced and settings == self.settings:
+            return 0
+        self.settings = settings
+
+        names = {image.name for image in images}
+        for name in [name for name in self.reductions if name not in names]:
+            del self.reductions[name]
+
+        result = self.reductions[base.image.name].copy()
+        for layer in layers:
+            layer_pixels = self.reductions[layer.image.name]
+            factor_value = get_mix_factor(layer, layer_pixels)
+            blend_layer_into(result, layer_pixels, BLEND_KERNELS[layer.blend_type], factor_value, layer.clamp)
+        update_image_pixels(self.image_name, result)
+        return reduced
+
+# The preview kept up to date by the timer, None when it is off
+stack_preview = None
+
+def refresh_stack_preview():
+    """Timer callback of the live preview, returns None to stop once the preview is off."""
+    global stack_preview
+    if stack_preview is None:
+        return None
+
+    try:
+        stack_preview.refresh(int(bpy.context.scene.flatten_preview_factor))
+    except (ValueError, KeyError) as error:
+        print(f"Live preview stopped: {error}")
+        stack_preview = None
+        return None
+    return FLATTEN_PREVIEW_INTERVAL
+
+@bpy.app.handlers.persistent
+def mark_painted_images(scene, depsgraph):
+    """Remember the images updated since they were last flattened, and queue them for the live preview."""
+    if not depsgraph.id_type_updated('IMAGE'):
+        return
+
+    names = {update.id.name for update in depsgraph.updates if isinstance(update.id, bpy.types.Image)}
+    painted_images.update(names)
+    if stack_preview is None:
+        return
+    if names == {stack_preview.image_name}:
+        return  # Only the preview's own write
+    names.discard(stack_preview.image_name)
+    # An image update that names no image could be any layer
+    stack_preview.changed |= names or set(stack_preview.reductions)
+
+def flatten_blend_file(output_dir, file_format='PNG', workers=1, precision='FLOAT32'):
+    """Flatten every '_photostack' group of the open .blend into output_dir.
+
+    Needs no UI context, so it runs under blender --background. Returns one
+    timing record per group.
+    """
+    blend_name = bpy.path.display_name_from_filepath(bpy.data.filepath) or "untitled"
+    extension = ".exr" if file_format == 'OPEN_EXR' else ".png"
+    os.makedirs(output_dir, exist_ok=True)
+
+    records = []
+    for nodegroup in bpy.data.node_groups:
+        if nodegroup.bl_idname != 'ShaderNodeTree' or "_photostack" not in nodegroup.name:
+            continue
+
+        record = {"file": bpy.data.filepath, "group": nodegroup.name}
+        start = time.perf_counter()
+        try:
+            base, layers = collect_stack_layers(nodegroup)
+            combined_image, how = flatten_photostack(nodegroup, base.image, layers, workers, precision)
+
+            combined_image.filepath_raw = os.path.join(output_dir, bpy.path.clean_name(f"{blend_name}_{nodegroup.name}") + extension)
+            combined_image.file_format = file_format
+            combined_image.save()
+
+            record.update(layers=len(layers) + 1, output=combined_image.filepath_raw)
+        except (ValueError, RuntimeError, KeyError) as error:
+            record["error"] = str(error)
+        record["seconds"] = round(time.perf_counter() - start, 3)
+
+        print(f"Flattened {nodegroup.name}: {record}")
+        records.append(record)
+
+    return records
+
+def batch_main(argv):
+    """Entry point for: blender --background file.blend --python flattener.py -- --output DIR"""
+    parser = argparse.ArgumentParser(prog="flattener.py", description="Flatten every PhotoStack in the open .blend file")
+    parser.add_argument("--output", required=True, help="Directory the flattened images are written to")
+    parser.add_argument("--format", default='PNG', choices=['PNG', 'OPEN_EXR'], help="File format of the flattened images")
+    parser.add_argument("--threads", type=int, default=1, help="Threads blending row bands per stack")
+    parser.add_argument("--precision", default='FLOAT32', choices=list(PRECISION_DTYPES), help="Working precision of the flatten")
+    parser.add_argument("--report", help="Write the timing records to this JSON file")
+    args = parser.parse_args(argv)
+
+    records = flatten_blend_file(args.output, args.format, max(args.threads, 1), args.precision)
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(records, report_file, indent=2)
 
 class NODE_OT_flatten_images(bpy.types.Operator):
     bl_idname = "node.flatten_images"
@@ -68,29 +720,27 @@ class NODE_OT_flatten_images(bpy.types.Operator):
 
         # Get selected nodes from the node tree
         selected_nodes = [node for node in nodes if node.select]
-        
-        # Debug print to verify selected nodes
-        print("Selected nodes:", [(node.name, node.type) for node in selected_nodes])
-
         image_nodes = [node for node in selected_nodes if node.type == 'TEX_IMAGE']
         mix_nodes = [node for node in selected_nodes if node.type == 'MIX']
 
-        # Debug print to verify filtered nodes
-        print("Selected image nodes:", [node.name for node in image_nodes])
-        print("Selected mix nodes:", [node.name for node in mix_nodes])
-
-        # Debug print the actual types of all selected nodes to diagnose the issue
-        for node in selected_nodes:
-            print(f"Node {node.name} has type {node.type}")
-
         if len(image_nodes) != 2 or len(mix_nodes) != 1:
-            self.report({'ERROR'}, "Select exactly two image nodes and one mix node")
+            self.report({'ERROR'}, f"Select exactly two image nodes and one mix node, "
+                                   f"{len(image_nodes)} image and {len(mix_nodes)} mix nodes are selected")
             return {'CANCELLED'}
 
-        image_node1, image_node2 = image_nodes
         mix_node = mix_nodes[0]
+        image_node1, image_node2 = get_mix_inputs(mix_node, image_nodes)
+        layer = photostack_ir.make_layer(image_node2, mix_node)
+        try:
+            check_layer_factor(layer)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
 
         blend_mode = mix_node.blend_type
+        if blend_mode not in BLEND_KERNELS:
+            self.report({'ERROR'}, f"Unsupported blend mode: {blend_mode}")
+            return {'CANCELLED'}
 
         image1 = image_node1.image
         image2 = image_node2.image
@@ -106,11 +756,18 @@ class NODE_OT_flatten_images(bpy.types.Operator):
             self.report({'ERROR'}, "Images must be the same size")
             return {'CANCELLED'}
 
-        render_width, render_height = width1, height1
-        create_compositor_node_tree(image1, image2, blend_mode)
-        combined_image = render_and_extract_image("CombinedImage", render_width, render_height)
+        cache_key = flatten_cache_key([image1, image2], get_mix_settings(layer))
+        combined_image = flatten_cache.get(cache_key)
 
-        bpy.context.area.ui_type = 'ShaderNodeTree'
+        # Unchanged inputs reuse the image of the earlier flatten
+        if not combined_image:
+            # Blend in memory, no render and no round trip through disk
+            base_pixels = read_image_pixels(image1)
+            layer_pixels = read_image_pixels(image2)
+            factor = get_mix_factor(layer, layer_pixels)
+            combined_pixels = flatten_pixels(base_pixels, layer_pixels, blend_mode, factor, layer.clamp)
+            combined_image = write_image_pixels("CombinedImage", combined_pixels)
+            flatten_cache.put(cache_key, combined_image)
 
         # Create a group from the selected nodes
         bpy.ops.node.group_make()
@@ -133,6 +790,241 @@ class NODE_OT_flatten_images(bpy.types.Operator):
 
         return {'FINISHED'}
 
+def get_active_stack(context):
+    """Return (material, group node, base image, layers) of the active object's PhotoStack.
+
+    Raises ValueError describing why the stack cannot be flattened.
+    """
+    obj = context.active_object
+    if not obj:
+        raise ValueError("No active object")
+
+    material = obj.active_material
+    if not material or not material.use_nodes:
+        raise ValueError("Active object has no node based material")
+
+    group_node = find_photostack_group(material.node_tree)
+    if not group_node:
+        raise ValueError("No PhotoStack group found in the active material")
+
+    base, layers = collect_stack_layers(group_node.node_tree)
+
+    images = [base.image] + [layer.image for layer in layers]
+    if any(image is None or not image.has_data for image in images):
+        raise ValueError("One or more stack images are not loaded")
+
+    if len({stack_image_size(image) for image in images}) != 1:
+        raise ValueError("All stack images must be the same size")
+
+    unsupported = {layer.blend_type for layer in layers} - set(BLEND_KERNELS)
+    if unsupported:
+        raise ValueError(f"Unsupported blend modes: {', '.join(sorted(unsupported))}")
+
+    return material, group_node, base.image, layers
+
+# Bumped on undo, redo and file load, which free every bpy reference a running flatten holds
+flatten_generation = 0
+
+@bpy.app.handlers.persistent
+def invalidate_running_flattens(*args):
+    global flatten_generation
+    flatten_generation += 1
+
+def stack_fingerprint(material, group_node, base_image, layers):
+    """Names, addresses and sizes of everything a flatten job reads, to check it between timer ticks."""
+    images = [base_image] + [layer.image for layer in layers]
+    return (
+        (material.name, material.as_pointer()),
+        (group_node.name, group_node.as_pointer()),
+        (group_node.node_tree.name, group_node.node_tree.as_pointer()),
+        tuple((layer.mix_node.name, layer.mix_node.as_pointer()) for layer in layers),
+        tuple((image.name, image.as_pointer(), tuple(image.size)) for image in images),
+    )
+
+def resolve_stack_fingerprint(fingerprint):
+    """Look everything in a stack_fingerprint() up again by name, returning the fingerprint it has now.
+
+    Returns None when something was deleted or renamed, so the caller never
+    has to touch a reference that might have been freed.
+    """
+    (material_name, material_pointer), (group_node_name, group_pointer), (nodegroup_name, nodegroup_pointer), mix_nodes, images = fingerprint
+    material = bpy.data.materials.get(material_name)
+    group_node = material.node_tree.nodes.get(group_node_name) if material and material.node_tree else None
+    nodegroup = bpy.data.node_groups.get(nodegroup_name)
+    if not group_node or not nodegroup or group_node.node_tree != nodegroup:
+        return None
+
+    resolved_mix_nodes = [nodegroup.nodes.get(name) for name, pointer in mix_nodes]
+    resolved_images = [bpy.data.images.get(name) for name, pointer, size in images]
+    if None in resolved_mix_nodes or None in resolved_images:
+        return None
+
+    return (
+        (material.name, material.as_pointer()),
+        (group_node.name, group_node.as_pointer()),
+        (nodegroup.name, nodegroup.as_pointer()),
+        tuple((node.name, node.as_pointer()) for node in resolved_mix_nodes),
+        tuple((image.name, image.as_pointer(), tuple(image.size)) for image in resolved_images),
+    )
+
+class NODE_OT_flatten_stack(bpy.types.Operator):
+    bl_idname = "node.flatten_stack"
+    bl_label = "Flatten PhotoStack"
+    bl_description = "Composite every layer of the PhotoStack group into one image in a single pass"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    _timer = None
+    _job = None
+    _stack = None
+    _fingerprint = None
+    _generation = None
+
+    def prepare(self, context):
+        """Find the stack to flatten, returning (material, group node, base image, layers) or None."""
+        try:
+            return get_active_stack(context)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return None
+
+    def finish(self, material, group_node, combined_image, layer_count, how):
+        nodes = material.node_tree.nodes
+
+        # A re-flatten patches the existing result, only add a node the first time
+        if not any(node.type == 'TEX_IMAGE' and node.image == combined_image for node in nodes):
+            new_image_node = nodes.new('ShaderNodeTexImage')
+            new_image_node.image = combined_image
+            new_image_node.label = "Flatten result"
+            new_image_node.location = group_node.location.x + 300, group_node.location.y
+
+        self.report({'INFO'}, f"Flattened {layer_count} layers ({how})")
+
+    def execute(self, context):
+        stack = self.prepare(context)
+        if not stack:
+            return {'CANCELLED'}
+
+        material, group_node, base_image, layers = stack
+        combined_image, how = flatten_photostack(group_node.node_tree, base_image, layers, context.scene.flatten_workers, context.scene.flatten_precision)
+        self.finish(material, group_node, combined_image, len(layers) + 1, how)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        stack = self.prepare(context)
+        if not stack:
+            return {'CANCELLED'}
+
+        self._stack = stack
+        self._fingerprint = stack_fingerprint(*stack)
+        self._generation = flatten_generation
+        material, group_node, base_image, layers = stack
+        self._job = iter_flatten_photostack(group_node.node_tree, base_image, layers, context.scene.flatten_workers, context.scene.flatten_precision)
+
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            # The job only writes to bpy.data on its last step, closing it leaves nothing behind
+            self._job.close()
+            self.stop(context)
+            self.report({'WARNING'}, "Flatten cancelled")
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        # The job holds bpy references across ticks, stop before touching any that an
+        # undo, a file load or a deletion in between may have freed
+        if flatten_generation != self._generation or resolve_stack_fingerprint(self._fingerprint) != self._fingerprint:
+            self._job.close()
+            self._stack = None
+            self.stop(context)
+            self.report({'WARNING'}, "Flatten cancelled, the PhotoStack changed while it ran")
+            return {'CANCELLED'}
+
+        # Work for one time slice, then hand control back to the UI
+        deadline = time.perf_counter() + FLATTEN_MODAL_SLICE
+        progress = 0.0
+        try:
+            while time.perf_counter() < deadline:
+                progress = next(self._job)
+        except StopIteration as done:
+            self.stop(context)
+            material, group_node, base_image, layers = self._stack
+            combined_image, how = done.value
+            self.finish(material, group_node, combined_image, len(layers) + 1, how)
+            return {'FINISHED'}
+        except Exception as error:
+            # Without this the timer and progress bar would outlive the failed job
+            self._job.close()
+            self._stack = None
+            self.stop(context)
+            self.report({'ERROR'}, f"Flatten failed: {error}")
+            return {'CANCELLED'}
+
+        context.window_manager.progress_update(int(progress * 100))
+        return {'RUNNING_MODAL'}
+
+    def stop(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+
+class NODE_OT_flatten_precision_report(bpy.types.Operator):
+    bl_idname = "node.flatten_precision_report"
+    bl_label = "Compare Flatten Precisions"
+    bl_description = "Flatten the PhotoStack at every precision and report peak memory and error against float32"
+
+    def execute(self, context):
+        try:
+            material, group_node, base_image, layers = get_active_stack(context)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+
+        report = compare_flatten_precisions(base_image, layers, context.scene.flatten_workers)
+        for precision, result in report.items():
+            message = f"{precision}: peak {result['peak_bytes'] / 2 ** 20:.0f} MiB, max error {result['max_error']:.6f}"
+            print(message)
+            self.report({'INFO'}, message)
+
+        return {'FINISHED'}
+
+class NODE_OT_flatten_live_preview(bpy.types.Operator):
+    bl_idname = "node.flatten_live_preview"
+    bl_label = "Live Preview"
+    bl_description = "Keep a reduced-resolution composite of the PhotoStack up to date for the Image Editor, or stop it"
+
+    def execute(self, context):
+        global stack_preview
+        if stack_preview is not None:
+            stack_preview = None
+            self.report({'INFO'}, "Live preview stopped")
+            return {'FINISHED'}
+
+        try:
+            material, group_node, base_image, layers = get_active_stack(context)
+            preview = StackPreview(group_node.node_tree.name)
+            preview.refresh(int(context.scene.flatten_preview_factor))
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+
+        # Show the preview in the first Image Editor of the screen
+        for area in context.screen.areas:
+            if area.type == 'IMAGE_EDITOR':
+                area.spaces.active.image = bpy.data.images[preview.image_name]
+                break
+
+        stack_preview = preview
+        if not bpy.app.timers.is_registered(refresh_stack_preview):
+            bpy.app.timers.register(refresh_stack_preview, first_interval=FLATTEN_PREVIEW_INTERVAL)
+        return {'FINISHED'}
+
 class NODE_PT_flattener_panel(bpy.types.Panel):
     bl_label = "Flattener"
     bl_idname = "NODE_PT_flattener_panel"
@@ -147,14 +1039,67 @@ class NODE_PT_flattener_panel(bpy.types.Panel):
     def draw(self, context):
         layout = self.layout
         layout.operator("node.flatten_images")
+        layout.operator("node.flatten_stack")
+        layout.prop(context.scene, "flatten_workers")
+        layout.prop(context.scene, "flatten_precision")
+        layout.operator("node.flatten_precision_report")
+        row = layout.row(align=True)
+        row.operator("node.flatten_live_preview", text="Stop Live Preview" if stack_preview else "Live Preview")
+        row.prop(context.scene, "flatten_preview_factor", text="")
+        layout.label(text=f"Cache: {flatten_cache.hits} hits, {flatten_cache.misses} misses")
 
 def register():
+    photostack_ir.register("flattener")
     bpy.utils.register_class(NODE_OT_flatten_images)
+    bpy.utils.register_class(NODE_OT_flatten_stack)
+    bpy.utils.register_class(NODE_OT_flatten_precision_report)
+    bpy.utils.register_class(NODE_OT_flatten_live_preview)
     bpy.utils.register_class(NODE_PT_flattener_panel)
+    photostack_ir.add_handler(bpy.app.handlers.depsgraph_update_post, mark_painted_images)
+    for handlers in (bpy.app.handlers.undo_pre, bpy.app.handlers.redo_pre, bpy.app.handlers.load_pre):
+        photostack_ir.add_handler(handlers, invalidate_running_flattens)
+
+    bpy.types.Scene.flatten_workers = bpy.props.IntProperty(
+        name="Worker Threads",
+        default=min(os.cpu_count() or 1, 8),
+        min=1,
+        max=64,
+        description="Number of threads blending row bands when flattening a PhotoStack"
+    )
+
+    bpy.types.Scene.flatten_precision = bpy.props.EnumProperty(
+        name="Precision",
+        items=PRECISION_ITEMS,
+        default='FLOAT32',
+        description="Working precision of the PhotoStack flatten, lower precisions use less memory"
+    )
+
+    bpy.types.Scene.flatten_preview_factor = bpy.props.EnumProperty(
+        name="Preview Size",
+        items=PREVIEW_FACTOR_ITEMS,
+        default='4',
+        description="Downsample factor of the live preview"
+    )
 
 def unregister():
     bpy.utils.unregister_class(NODE_OT_flatten_images)
+    bpy.utils.unregister_class(NODE_OT_flatten_stack)
+    bpy.utils.unregister_class(NODE_OT_flatten_precision_report)
+    bpy.utils.unregister_class(NODE_OT_flatten_live_preview)
     bpy.utils.unregister_class(NODE_PT_flattener_panel)
+    photostack_ir.remove_handler(bpy.app.handlers.depsgraph_update_post, mark_painted_images)
+    for handlers in (bpy.app.handlers.undo_pre, bpy.app.handlers.redo_pre, bpy.app.handlers.load_pre):
+        photostack_ir.remove_handler(handlers, invalidate_running_flattens)
+    if bpy.app.timers.is_registered(refresh_stack_preview):
+        bpy.app.timers.unregister(refresh_stack_preview)
+    photostack_ir.unregister("flattener")
+
+    del bpy.types.Scene.flatten_workers
+    del bpy.types.Scene.flatten_precision
+    del bpy.types.Scene.flatten_preview_factor
 
 if __name__ == "__main__":
-    register()
+    if bpy.app.background and "--" in sys.argv:
+        batch_main(sys.argv[sys.argv.index("--") + 1:])
+    else:
+        register()
@@ -1,4 +1,58 @@
 import bpy
+import numpy as np
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+script_text = bpy.data.texts.get(os.path.basename(__file__))
+script_path = __file__ if os.path.isfile(__file__) or not script_text else bpy.path.abspath(script_text.filepath)
+script_dir = os.path.dirname(os.path.abspath(script_path))
+if script_dir not in sys.path:
+    sys.path.append(script_dir)
+
+try:
+    import photostack_ir
+    from blend_kernels import blend_rgba, linear_to_srgb, srgb_to_linear
+    from photostack_ir import (CHAIN_TIP_KEY, get_group_output, get_linked_socket, get_socket, get_stack_ir,
+                               get_stack_tip, invalidate_stack_ir)
+    from stack_pixels import (conform_proxy_band, encode_png, merge_over, pack_rectangles, paint_bounds, painted_tiles,
+                              pixels_checksum, place_crop, reduce_proxy_pixels)
+except ImportError as error:
+    raise ImportError(f"{error}. Keep blend_kernels.py, photostack_ir.py and stack_pixels.py next to photostack4.py and open it from disk to run it in the Text Editor") from error
+
+# OpenImageIO ships with Blender's Python from 4.0, it writes the multi-part stack EXRs
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+# Edge length of the placeholder image a sparse layer starts as
+SPARSE_PLACEHOLDER_SIZE = 1
+
+# Blend modes whose runs of layers can be regrouped into a balanced tree
+ASSOCIATIVE_BLENDS = {'MIX', 'MULTIPLY', 'ADD', 'SUBTRACT'}
+
+# Shortest run of one blend mode worth compiling into a tree
+MIN_TREE_RUN = 3
+
+# Edge length of the alpha tiles the stack optimizer checks for paint
+OPTIMIZE_TILE_SIZE = 64
+
+# Layers whose painted tiles cover at most this share of their storage get cropped
+OPTIMIZE_CROP_FILL = 0.5
+
+# Proxy rows conformed per streamed band of a full-resolution master
+PROXY_BAND_ROWS = 64
+
+# Largest share of the stack area a layer may store and still go into an atlas
+ATLAS_MAX_FILL = 0.25
+
+# Transparent border around every layer in an atlas, so clamped lookups fade to nothing
+ATLAS_PADDING = 1
 
 class PhotoStackProperties(bpy.types.PropertyGroup):
     uv_map_name: bpy.props.StringProperty(
@@ -7,210 +61,2382 @@ class PhotoStackProperties(bpy.types.PropertyGroup):
     )
 
 
-class PhotoStack(bpy.types.Operator):
-    """Add or extend a 'Photostack' with Multiple Image Textures inside a Node Group"""
-    bl_idname = "object.add_photostack"
-    bl_label = "Add to or Create Photostack"
+def update_layer_visibility(self, context):
+    """Hide or show a registered layer by muting its Mix node, which then passes A through."""
+    material = self.id_data
+    nodegroup = material.photostack_group
+    mix_node = nodegroup.nodes.get(self.mix_node) if nodegroup and self.mix_node else None
+    if not mix_node or mix_node.mute != self.visible:
+        return
+
+    mix_node.mute = not self.visible
+    invalidate_stack_ir(nodegroup)
+    if CHAIN_TIP_KEY in nodegroup:
+        compile_stack(nodegroup)
+
+
+class PhotoStackLayer(bpy.types.PropertyGroup):
+    """One layer of a material's PhotoStack, as recorded in its layer registry."""
+    image: bpy.props.PointerProperty(name="Image", type=bpy.types.Image)
+    texture_node: bpy.props.StringProperty(name="Texture Node")
+    mix_node: bpy.props.StringProperty(name="Mix Node")
+    blend_type: bpy.props.StringProperty(name="Blend Mode", default='MIX')
+    visible: bpy.props.BoolProperty(name="Visible", default=True, update=update_layer_visibility)
+    order: bpy.props.IntProperty(name="Order")
+
+
+def index_nodes(nodes):
+    """Group nodes by type in one pass, so lookups do not rescan the tree."""
+    index = {}
+    for node in nodes:
+        index.setdefault(node.type, []).append(node)
+    return index
+
+
+def get_color_output(node):
+    """Return the color output of a stack node (image texture or Mix)."""
+    if node.type == 'MIX':
+        return get_socket(node.outputs, 'Result_Color')
+    for name in ('Color', 'Result', 'RGBA'):
+        if name in node.outputs:
+            return node.outputs[name]
+    return None
+
+
+def get_photostack_group(material):
+    """Return the '_photostack' node group used by the material, or None."""
+    for node in material.node_tree.nodes:
+        if node.type == 'GROUP' and node.node_tree and "_photostack" in node.node_tree.name:
+            return node.node_tree
+    return None
+
+
+def is_sparse_layer(image):
+    """True when a paint layer is stored smaller than the stack, as a placeholder or crop."""
+    return "photostack_size" in image and tuple(image.size) != tuple(image["photostack_size"])
+
+
+def adopt_stack_size(image):
+    """Record the stack size on a layer made before layers carried photostack_size.
+
+    Those layers were never cropped, so they are stored at the stack size.
+    """
+    if "photostack_size" not in image:
+        image["photostack_size"] = tuple(image.size)
+
+
+def set_layer_offset(nodegroup, img_tex, offset=None):
+    """Place a cropped layer at offset (pixels) with a Mapping node, or remove the mapping.
+
+    The crop is sampled with CLIP extension so everything outside it is transparent
+    and the Mix node passes the layers below through.
+    """
+    mapping_node = img_tex.inputs['Vector'].links[0].from_node if img_tex.inputs['Vector'].is_linked else None
+    if mapping_node and mapping_node.type != 'MAPPING':
+        mapping_node = None
+
+    if offset is None:
+        if mapping_node:
+            uv_socket = mapping_node.inputs['Vector'].links[0].from_socket if mapping_node.inputs['Vector'].is_linked else None
+            nodegroup.nodes.remove(mapping_node)
+            if uv_socket:
+                nodegroup.links.new(uv_socket, img_tex.inputs['Vector'])
+        img_tex.extension = 'REPEAT'
+        return
+
+    if not mapping_node:
+        uv_socket = img_tex.inputs['Vector'].links[0].from_socket if img_tex.inputs['Vector'].is_linked else None
+        mapping_node = nodegroup.nodes.new(type='ShaderNodeMapping')
+        mapping_node.location = (img_tex.location.x - 180, img_tex.location.y - 120)
+        mapping_node.hide = True
+        if uv_socket:
+            nodegroup.links.new(uv_socket, mapping_node.inputs['Vector'])
+        nodegroup.links.new(mapping_node.outputs['Vector'], img_tex.inputs['Vector'])
+
+    # uv' = (uv * full - offset) / crop, so the crop lands back where it was painted
+    full_width, full_height = img_tex.image["photostack_size"]
+    width, height = img_tex.image.size
+    mapping_node.inputs['Scale'].default_value = (full_width / width, full_height / height, 1.0)
+    mapping_node.inputs['Location'].default_value = (-offset[0] / width, -offset[1] / height, 0.0)
+    img_tex.extension = 'CLIP'
+
+
+def find_layer_nodes(image):
+    """Yield (nodegroup, texture node) for every PhotoStack node showing image."""
+    for nodegroup in bpy.data.node_groups:
+        if "_photostack" not in nodegroup.name:
+            continue
+        for node in nodegroup.nodes:
+            if node.type == 'TEX_IMAGE' and node.image == image:
+                yield nodegroup, node
+
+
+def expand_sparse_layer(image):
+    """Give a placeholder or cropped layer its full-resolution storage back."""
+    full_width, full_height = image["photostack_size"]
+    pixels = np.zeros((full_height, full_width, 4), dtype=np.float32)
+
+    if "photostack_offset" in image:
+        # Put the cropped content back where it came from
+        place_crop(read_layer_pixels(image), image["photostack_offset"], (full_width, full_height), out=pixels)
+        del image["photostack_offset"]
+
+    image.scale(full_width, full_height)
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+
+    for nodegroup, img_tex in find_layer_nodes(image):
+        set_layer_offset(nodegroup, img_tex, None)
+
+
+def read_layer_pixels(image):
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+
+def shrink_layer(image, pixels=None):
+    """Crop a layer to the bounding box of its painted pixels, or to a placeholder if empty.
+
+    Works on the stored pixels, so an already cropped layer is cropped further
+    without being expanded first. pixels, when given, are the stored pixels
+    already read. Returns the number of bytes of pixel storage saved, as
+    image_memory() counts them.
+    """
+    if is_sparse_layer(image) and "photostack_offset" not in image:
+        return 0  # Already a placeholder
+
+    offset_x, offset_y = image.get("photostack_offset", (0, 0))
+    width, height = image.size
+    before = image_memory(image)
+    if pixels is None:
+        pixels = read_layer_pixels(image)
+
+    bounds = paint_bounds(pixels)
+    if bounds is None:
+        image.scale(SPARSE_PLACEHOLDER_SIZE, SPARSE_PLACEHOLDER_SIZE)
+        image.pixels.foreach_set(np.zeros(SPARSE_PLACEHOLDER_SIZE ** 2 * 4, dtype=np.float32))
+        image.update()
+        if "photostack_offset" in image:
+            del image["photostack_offset"]
+        for nodegroup, img_tex in find_layer_nodes(image):
+            set_layer_offset(nodegroup, img_tex, None)
+        return before - image_memory(image)
+
+    x0, y0, x1, y1 = bounds
+    if (x1 - x0, y1 - y0) == (width, height):
+        return 0
+
+    crop = np.ascontiguousarray(pixels[y0:y1, x0:x1])
+    image.scale(x1 - x0, y1 - y0)
+    image.pixels.foreach_set(crop.ravel())
+    image.update()
+    image["photostack_offset"] = (offset_x + x0, offset_y + y0)
+
+    for nodegroup, img_tex in find_layer_nodes(image):
+        set_layer_offset(nodegroup, img_tex, (offset_x + x0, offset_y + y0))
+
+    return before - image_memory(image)
+
+
+def get_group_input(nodegroup):
+    for node in nodegroup.nodes:
+        if node.type == 'GROUP_INPUT':
+            return node
+    group_input = nodegroup.nodes.new("NodeGroupInput")
+    group_input.location = (-500, 0)
+    return group_input
+
+
+def get_uv_input(nodegroup, uv_map):
+    """Return the Group Input socket carrying uv_map, adding it to the interface the first time.
+
+    All layers painted on the same UV map share this one input instead of each
+    having its own UV Map node.
+    """
+    name = uv_map or "UV"
+    if not any(item.item_type == 'SOCKET' and item.in_out == 'INPUT' and item.name == name
+               for item in nodegroup.interface.items_tree):
+        socket = nodegroup.interface.new_socket(name=name, socket_type='NodeSocketVector', in_out='INPUT')
+        socket.hide_value = True
+    return get_group_input(nodegroup).outputs[name]
+
+
+def feed_uv_inputs(nodegroup):
+    """Connect one UV Map node per UV input to every instance of the group, in every material."""
+    uv_names = [item.name for item in nodegroup.interface.items_tree
+                if item.item_type == 'SOCKET' and item.in_out == 'INPUT' and item.socket_type == 'NodeSocketVector']
+
+    for material in bpy.data.materials:
+        if not material.use_nodes:
+            continue
+
+        tree = material.node_tree
+        uv_nodes = {node.uv_map or "UV": node for node in tree.nodes if node.type == 'UVMAP'}
+        for group_node in tree.nodes:
+            if group_node.type != 'GROUP' or group_node.node_tree != nodegroup:
+                continue
+
+            for name in uv_names:
+                socket = group_node.inputs.get(name)
+                if socket is None or socket.is_linked:
+                    continue
+
+                uv_node = uv_nodes.get(name)
+                if not uv_node:
+                    uv_node = tree.nodes.new(type='ShaderNodeUVMap')
+                    uv_node.uv_map = "" if name == "UV" else name
+                    uv_node.location = (group_node.location.x - 200, group_node.location.y - 120 * len(uv_nodes))
+                    uv_nodes[name] = uv_node
+                tree.links.new(uv_node.outputs['UV'], socket)
+
+
+def add_stack_layers(nodegroup, previous_socket, first_number, count, width, height, sparse=False, uv_sockets=None):
+    """Append count blank paint layers on top of previous_socket.
+
+    Returns the new top socket and the (texture node, Mix node) of every new layer.
+
+    Images and nodes are created in bulk first and linked afterwards, with sockets
+    looked up once per node rather than by name for every link. Sparse layers
+    start as placeholders and get full-resolution storage when painted on.
+    uv_sockets gives the UV input of each new layer, without it the layers use
+    the default UV map.
+    """
+    nodes = nodegroup.nodes
+    links = nodegroup.links
+
+    # Create new blank images for painting with unique names (RGBA 0,0,0,0 for transparency)
+    image_width, image_height = (SPARSE_PLACEHOLDER_SIZE, SPARSE_PLACEHOLDER_SIZE) if sparse else (width, height)
+    new_images = []
+    for number in range(first_number, first_number + count):
+        new_image = bpy.data.images.new(f"PaintLayer_{number}", width=image_width, height=image_height, alpha=True)
+        new_image.generated_color = (0, 0, 0, 0)
+        new_image["photostack_size"] = (width, height)
+        new_images.append(new_image)
+
+    # Layers are stacked downwards from the original image at y = 400
+    layer_nodes = []
+    for i, new_image in enumerate(new_images):
+        y = 400 - 200 * (first_number + i - 1)
+        x = 200 * (first_number + i)
+
+        img_tex = nodes.new(type='ShaderNodeTexImage')
+        img_tex.location = (-100, y)
+        img_tex.image = new_image
+
+        # Mix the new image over the previous layer, its alpha is the factor
+        mix_node = nodes.new(type='ShaderNodeMix')
+        mix_node.location = (x, y)
+        mix_node.data_type = 'RGBA'
+        get_socket(mix_node.inputs, 'Factor_Float').default_value = 1.0
+
+        layer_nodes.append((img_tex, mix_node))
+
+    for i, (img_tex, mix_node) in enumerate(layer_nodes):
+        if uv_sockets:
+            links.new(uv_sockets[i], img_tex.inputs['Vector'])
+        links.new(previous_socket, get_socket(mix_node.inputs, 'A_Color'))
+        links.new(img_tex.outputs['Color'], get_socket(mix_node.inputs, 'B_Color'))
+        links.new(img_tex.outputs['Alpha'], get_socket(mix_node.inputs, 'Factor_Float'))
+        previous_socket = get_socket(mix_node.outputs, 'Result_Color')
+
+    return previous_socket, layer_nodes
+
+
+def get_stack_layers(nodegroup):
+    """The layers of nodegroup's shared StackIR, base first, or [] when its chain is broken."""
+    try:
+        return get_stack_ir(nodegroup).layers
+    except ValueError:
+        return []
+
+
+def new_compiled_mix(nodegroup, blend_type, location, data_type='RGBA'):
+    mix_node = nodegroup.nodes.new(type='ShaderNodeMix')
+    mix_node.data_type = data_type
+    mix_node.blend_type = blend_type
+    mix_node.location = location
+    mix_node.hide = True
+    mix_node["photostack_compiled"] = True
+    suffix = 'Color' if data_type == 'RGBA' else 'Float'
+    return (mix_node,
+            get_socket(mix_node.inputs, 'Factor_Float'),
+            get_socket(mix_node.inputs, f'A_{suffix}'),
+            get_socket(mix_node.inputs, f'B_{suffix}'),
+            get_socket(mix_node.outputs, f'Result_{suffix}'))
+
+
+def remove_compiled_nodes(nodegroup):
+    for node in [node for node in nodegroup.nodes if node.get("photostack_compiled")]:
+        nodegroup.nodes.remove(node)
+
+
+def compile_stack(nodegroup):
+    """Rebuild the group output as a balanced reduction of the layer chain.
+
+    Runs of MIX, MULTIPLY, ADD or SUBTRACT layers are regrouped pairwise:
+    MIX layers as premultiplied 'over', MULTIPLY as a product of
+    lerp(1, color, alpha) and ADD/SUBTRACT as a sum of color * alpha, which
+    gives the same result as the chain with a depth of log2 of the run length.
+    Other layers stay sequential. The chain itself is kept, unconnected, so
+    the stack can be edited, flattened or linearized again.
+    """
+    group_output_node = get_group_output(nodegroup)
+    stack_layers = get_stack_layers(nodegroup)
+    if not group_output_node or len(stack_layers) < 2:
+        return False
+    base, layers = stack_layers[0], stack_layers[1:]
+
+    remove_compiled_nodes(nodegroup)
+    links = nodegroup.links
+    position = [1000, -800]
+
+    def place():
+        position[0] += 160
+        return tuple(position)
+
+    def layer_sockets(mix_node):
+        return get_linked_socket(mix_node, 'B'), get_linked_socket(mix_node, 'Factor')
+
+    def leaf(blend_type, color, factor):
+        if blend_type == 'MIX':
+            # Premultiplied color and alpha of one layer
+            node, fac, a, b, result = new_compiled_mix(nodegroup, 'MULTIPLY', place())
+            fac.default_value = 1.0
+            links.new(color, a)
+            links.new(factor, b)
+            return result, factor
+        if blend_type == 'MULTIPLY':
+            node, fac, a, b, result = new_compiled_mix(nodegroup, 'MIX', place())
+            a.default_value = (1.0, 1.0, 1.0, 1.0)
+            links.new(factor, fac)
+            links.new(color, b)
+            return result, None
+        node, fac, a, b, result = new_compiled_mix(nodegroup, 'MULTIPLY', place())
+        fac.default_value = 1.0
+        links.new(color, a)
+        links.new(factor, b)
+        return result, None
+
+    def merge(blend_type, lower, upper):
+        if blend_type == 'MIX':
+            # upper over lower: C = Cu + Cl * (1 - au), a = au + al * (1 - au)
+            node, fac, a, b, faded = new_compiled_mix(nodegroup, 'MIX', place())
+            b.default_value = (0.0, 0.0, 0.0, 1.0)
+            links.new(upper[1], fac)
+            links.new(lower[0], a)
+            node, fac, a, b, color = new_compiled_mix(nodegroup, 'ADD', place())
+            fac.default_value = 1.0
+            links.new(faded, a)
+            links.new(upper[0], b)
+            node, fac, a, b, alpha = new_compiled_mix(nodegroup, 'MIX', place(), data_type='FLOAT')
+            b.default_value = 1.0
+            links.new(upper[1], fac)
+            links.new(lower[1], a)
+            return color, alpha
+        node, fac, a, b, result = new_compiled_mix(nodegroup, 'MULTIPLY' if blend_type == 'MULTIPLY' else 'ADD', place())
+        fac.default_value = 1.0
+        links.new(lower[0], a)
+        links.new(upper[0], b)
+        return result, None
+
+    def apply(blend_type, running, operand):
+        if blend_type == 'MIX':
+            node, fac, a, b, faded = new_compiled_mix(nodegroup, 'MIX', place())
+            b.default_value = (0.0, 0.0, 0.0, 1.0)
+            links.new(operand[1], fac)
+            links.new(running, a)
+            node, fac, a, b, result = new_compiled_mix(nodegroup, 'ADD', place())
+            fac.default_value = 1.0
+            links.new(faded, a)
+            links.new(operand[0], b)
+            return result
+        node, fac, a, b, result = new_compiled_mix(nodegroup, blend_type, place())
+        fac.default_value = 1.0
+        links.new(running, a)
+        links.new(operand[0], b)
+        return result
+
+    def sequential(mix_node, running):
+        node, fac, a, b, result = new_compiled_mix(nodegroup, mix_node.blend_type, place())
+        color, factor = layer_sockets(mix_node)
+        links.new(running, a)
+        if color:
+            links.new(color, b)
+        if factor:
+            links.new(factor, fac)
+        else:
+            fac.default_value = get_socket(mix_node.inputs, 'Factor_Float').default_value
+        node.clamp_result = mix_node.clamp_result
+        return result
+
+    def associative(mix_node):
+        color, factor = layer_sockets(mix_node)
+        return mix_node.blend_type in ASSOCIATIVE_BLENDS and color and factor and not mix_node.clamp_result
+
+    # Split the chain into runs of the same associative blend mode, hidden layers are left out
+    runs = []
+    for layer in layers:
+        if not layer.visible:
+            continue
+        mix_node = layer.mix_node
+        if runs and associative(mix_node) and runs[-1][0] == mix_node.blend_type:
+            runs[-1][1].append(mix_node)
+        else:
+            runs.append((mix_node.blend_type if associative(mix_node) else None, [mix_node]))
+
+    running = get_color_output(base.image_node)
+    for blend_type, run in runs:
+        if blend_type is None or len(run) < MIN_TREE_RUN:
+            for mix_node in run:
+                running = sequential(mix_node, running)
+            continue
+
+        operands = [leaf(blend_type, *layer_sockets(mix_node)) for mix_node in run]
+        while len(operands) > 1:
+            merged = [merge(blend_type, operands[i], operands[i + 1]) for i in range(0, len(operands) - 1, 2)]
+            if len(operands) % 2:
+                merged.append(operands[-1])
+            operands = merged
+        running = apply(blend_type, running, operands[0])
+
+    nodegroup[CHAIN_TIP_KEY] = layers[-1].mix_node.name
+    links.new(running, group_output_node.inputs[0])
+    return True
+
+
+def linearize_stack(nodegroup):
+    """Drop the compiled tree and drive the Group Output from the layer chain again."""
+    tip_node = get_stack_tip(nodegroup)
+    remove_compiled_nodes(nodegroup)
+    if CHAIN_TIP_KEY in nodegroup:
+        del nodegroup[CHAIN_TIP_KEY]
+
+    group_output_node = get_group_output(nodegroup)
+    if tip_node and group_output_node:
+        nodegroup.links.new(get_color_output(tip_node), group_output_node.inputs[0])
+    invalidate_stack_ir(nodegroup)
+
+
+def add_registry_entry(material, img_tex, mix_node):
+    """Record a layer on top of the material's registry."""
+    layers = material.photostack_layers
+    entry = layers.add()
+    entry.order = len(layers) - 1
+    entry.texture_node = img_tex.name if img_tex else ""
+    entry.image = img_tex.image if img_tex and img_tex.type == 'TEX_IMAGE' else None
+    entry.mix_node = mix_node.name if mix_node else ""
+    entry.blend_type = mix_node.blend_type if mix_node else 'MIX'
+    entry.visible = not mix_node.mute if mix_node else True
+    return entry
+
+
+def rebuild_layer_registry(material, nodegroup):
+    """Refill the material's layer registry from one walk of the layer chain."""
+    layers = material.photostack_layers
+    layers.clear()
+    material.photostack_group = nodegroup
+
+    for layer in get_stack_layers(nodegroup):
+        add_registry_entry(material, layer.image_node, layer.mix_node)
+
+    material.photostack_layer_index = min(material.photostack_layer_index, max(len(layers) - 1, 0))
+
+
+def registry_entry_nodes(material, entry):
+    """Return (texture node, Mix node) of a registry entry, or None when the tree no longer matches it."""
+    nodegroup = material.photostack_group
+    img_tex = nodegroup.nodes.get(entry.texture_node) if nodegroup else None
+    if not img_tex or img_tex.type != 'TEX_IMAGE' or img_tex.image != entry.image:
+        return None
+    if not entry.mix_node:
+        return img_tex, None
+
+    mix_node = nodegroup.nodes.get(entry.mix_node)
+    color_socket = get_socket(mix_node.inputs, 'B_Color') if mix_node and mix_node.type == 'MIX' else None
+    if not color_socket or not color_socket.is_linked or color_socket.links[0].from_node != img_tex:
+        return None
+    return img_tex, mix_node
+
+
+def layer_registry_is_stale(material, nodegroup):
+    """Cheap check of the registry against the tree: same group and the top entry is the chain tip."""
+    layers = material.photostack_layers
+    if material.photostack_group != nodegroup or not layers:
+        return True
+
+    top_nodes = registry_entry_nodes(material, layers[-1])
+    if top_nodes is None:
+        return True
+    return get_stack_tip(nodegroup) != (top_nodes[1] or top_nodes[0])
+
+
+def get_layer_registry(material):
+    """Return (node group, layers) of the material's PhotoStack, rebuilding the registry only when stale."""
+    nodegroup = get_photostack_group(material) if material and material.use_nodes else None
+    if nodegroup and layer_registry_is_stale(material, nodegroup):
+        rebuild_layer_registry(material, nodegroup)
+    return nodegroup, material.photostack_layers if material else None
+
+
+def get_layer_nodes(material, index):
+    """Return (texture node, Mix node) of layer index, rebuilding the registry if its entry is stale."""
+    layers = material.photostack_layers
+    nodes = registry_entry_nodes(material, layers[index])
+    if nodes is None:
+        rebuild_layer_registry(material, material.photostack_group)
+        nodes = registry_entry_nodes(material, layers[index]) if index < len(layers) else None
+    return nodes or (None, None)
+
+
+def swap_layers(material, lower, upper):
+    """Swap the content of two layers. Their Mix nodes keep their place in the chain
+    and trade textures, factors and blend settings instead."""
+    lower_tex, lower_mix = get_layer_nodes(material, lower)
+    upper_tex, upper_mix = get_layer_nodes(material, upper)
+    if not lower_mix or not upper_mix:
+        return False
+
+    links = material.photostack_group.links
+    for identifier in ('B_Color', 'Factor_Float'):
+        lower_socket = get_socket(lower_mix.inputs, identifier)
+        upper_socket = get_socket(upper_mix.inputs, identifier)
+        lower_from = lower_socket.links[0].from_socket if lower_socket.is_linked else None
+        upper_from = upper_socket.links[0].from_socket if upper_socket.is_linked else None
+        for socket, from_socket in ((lower_socket, upper_from), (upper_socket, lower_from)):
+            if socket.is_linked:
+                links.remove(socket.links[0])
+            if from_socket:
+                links.new(from_socket, socket)
+
+    lower_factor = get_socket(lower_mix.inputs, 'Factor_Float')
+    upper_factor = get_socket(upper_mix.inputs, 'Factor_Float')
+    lower_factor.default_value, upper_factor.default_value = upper_factor.default_value, lower_factor.default_value
+    for attribute in ('blend_type', 'clamp_result', 'mute'):
+        lower_value = getattr(lower_mix, attribute)
+        setattr(lower_mix, attribute, getattr(upper_mix, attribute))
+        setattr(upper_mix, attribute, lower_value)
+    # Same node and link counts as before, so the cached IR can't notice on its own
+    invalidate_stack_ir(material.photostack_group)
+
+    layers = material.photostack_layers
+    for attribute in ('image', 'texture_node', 'blend_type', 'visible'):
+        lower_value = getattr(layers[lower], attribute)
+        setattr(layers[lower], attribute, getattr(layers[upper], attribute))
+        setattr(layers[upper], attribute, lower_value)
+    return True
+
+
+def delete_layer(material, index):
+    """Remove a layer's texture and Mix nodes and link the layers around it together."""
+    img_tex, mix_node = get_layer_nodes(material, index)
+    if not mix_node:
+        return False
+
+    nodegroup = material.photostack_group
+    below_socket = get_linked_socket(mix_node, 'A')
+    for link in list(get_socket(mix_node.outputs, 'Result_Color').links):
+        if below_socket:
+            nodegroup.links.new(below_socket, link.to_socket)
+    if nodegroup.get(CHAIN_TIP_KEY) == mix_node.name and below_socket:
+        nodegroup[CHAIN_TIP_KEY] = below_socket.node.name
+
+    image = img_tex.image
+    set_layer_offset(nodegroup, img_tex, None)
+    nodegroup.nodes.remove(mix_node)
+    nodegroup.nodes.remove(img_tex)
+    invalidate_stack_ir(nodegroup)
+
+    layers = material.photostack_layers
+    layers.remove(index)
+    for entry in layers[index:]:
+        entry.order -= 1
+    material.photostack_layer_index = min(index, len(layers) - 1)
+
+    # The registry entry held a user too, so check only once it is gone
+    if image and image.users == 0:
+        bpy.data.images.remove(image)
+    return True
+
+
+def optimize_stack(material, remove_empty=True, crop=True, crop_fill=OPTIMIZE_CROP_FILL):
+    """Delete the empty layers of the material's PhotoStack and crop the ones with little paint.
+
+    Each layer's alpha is checked in tiles: a layer without painted tiles is
+    deleted with its Mix node, and one whose painted tiles span at most
+    crop_fill of its storage is cropped to its paint. Returns (layers removed,
+    layers cropped, bytes saved, nodes saved).
+    """
+    nodegroup, layers = get_layer_registry(material)
+    if not nodegroup:
+        raise ValueError("No PhotoStack found on the material")
+
+    bytes_before = stack_memory_report(nodegroup)["bytes"]
+    nodes_before = len(nodegroup.nodes)
+    removed = cropped = 0
+
+    # Top down, so deleting a layer leaves the indices still to visit alone
+    for index in range(len(layers) - 1, 0, -1):
+        img_tex, mix_node = get_layer_nodes(material, index)
+        image = img_tex.image if img_tex else None
+        if not image or "photostack_atlas_rect" in img_tex:
+            continue
+        adopt_stack_size(image)
+
+        if is_sparse_layer(image) and "photostack_offset" not in image:
+            tiles = None  # A placeholder was never painted on
+        else:
+            pixels = read_layer_pixels(image)
+            tiles = painted_tiles(pixels[..., 3], OPTIMIZE_TILE_SIZE)
+
+        if tiles is None or not tiles.any():
+            if remove_empty and delete_layer(material, index):
+                removed += 1
+            continue
+
+        rows = np.flatnonzero(tiles.any(axis=1))
+        columns = np.flatnonzero(tiles.any(axis=0))
+        span = (rows[-1] - rows[0] + 1) * (columns[-1] - columns[0] + 1)
+        if crop and span <= crop_fill * tiles.size and shrink_layer(image, pixels):
+            cropped += 1
+
+    if CHAIN_TIP_KEY in nodegroup:
+        compile_stack(nodegroup)
+
+    return removed, cropped, bytes_before - stack_memory_report(nodegroup)["bytes"], nodes_before - len(nodegroup.nodes)
+
+
+def refresh_layer_registries(nodegroup):
+    """Rebuild the registry of every material showing nodegroup after its layers changed."""
+    for material in bpy.data.materials:
+        if material.photostack_group == nodegroup:
+            rebuild_layer_registry(material, nodegroup)
+
+
+def get_texture_coordinates(nodegroup):
+    for node in nodegroup.nodes:
+        if node.type == 'TEX_COORD' and node.get("photostack_atlas"):
+            return node
+    coords_node = nodegroup.nodes.new(type='ShaderNodeTexCoord')
+    coords_node.location = (-700, 400)
+    coords_node.hide = True
+    coords_node["photostack_atlas"] = True
+    return coords_node
+
+
+def set_atlas_mapping(nodegroup, img_tex, atlas_size, rect, full_size, offset):
+    """Point a layer's texture node at its rectangle of an atlas.
+
+    uv' = (uv * full + rect position - offset) / atlas, clamped to the transparent
+    border around the rectangle so the rest of the atlas never shows through.
+    """
+    set_layer_offset(nodegroup, img_tex, None)
+    vector_input = img_tex.inputs['Vector']
+    uv_socket = vector_input.links[0].from_socket if vector_input.is_linked else get_texture_coordinates(nodegroup).outputs['UV']
+
+    atlas_width, atlas_height = atlas_size
+    x, y, width, height = rect
+    location = img_tex.location
+
+    mapping_node = nodegroup.nodes.new(type='ShaderNodeMapping')
+    mapping_node.inputs['Scale'].default_value = (full_size[0] / atlas_width, full_size[1] / atlas_height, 1.0)
+    mapping_node.inputs['Location'].default_value = ((x - offset[0]) / atlas_width, (y - offset[1]) / atlas_height, 0.0)
+
+    lower_node = nodegroup.nodes.new(type='ShaderNodeVectorMath')
+    lower_node.operation = 'MAXIMUM'
+    lower_node.inputs[1].default_value = ((x - 0.5) / atlas_width, (y - 0.5) / atlas_height, 0.0)
+
+    upper_node = nodegroup.nodes.new(type='ShaderNodeVectorMath')
+    upper_node.operation = 'MINIMUM'
+    upper_node.inputs[1].default_value = ((x + width + 0.5) / atlas_width, (y + height + 0.5) / atlas_height, 0.0)
+
+    for i, node in enumerate((mapping_node, lower_node, upper_node)):
+        node.location = (location.x - 540 + 180 * i, location.y - 120)
+        node.hide = True
+        node["photostack_atlas"] = True
+
+    links = nodegroup.links
+    links.new(uv_socket, mapping_node.inputs['Vector'])
+    links.new(mapping_node.outputs['Vector'], lower_node.inputs[0])
+    links.new(lower_node.outputs['Vector'], upper_node.inputs[0])
+    links.new(upper_node.outputs['Vector'], vector_input)
+    img_tex.extension = 'EXTEND'
+
+
+def pack_layer_atlas(nodegroup, max_fill=ATLAS_MAX_FILL):
+    """Move the small or mostly empty layers of a stack into one shared atlas image.
+
+    Layers are cropped to their painted area first; those storing at most
+    max_fill of the stack area are packed. Their texture nodes then sample the
+    atlas, and the layer images are removed. Returns (layers packed, atlas).
+    """
+    candidates = []
+    for node in nodegroup.nodes:
+        image = node.image if node.type == 'TEX_IMAGE' else None
+        if (not image or "photostack_size" not in image or "photostack_atlas_rect" in node
+                or image.is_float or image.channels != 4):
+            continue
+        if not is_sparse_layer(image):
+            shrink_layer(image)
+        full_width, full_height = image["photostack_size"]
+        if image.size[0] * image.size[1] <= max_fill * full_width * full_height:
+            candidates.append(node)
+
+    # A single layer gains nothing from an atlas
+    if len(candidates) < 2:
+        return 0, None
+
+    sizes = [tuple(node.image.size) for node in candidates]
+    positions, (atlas_width, atlas_height) = pack_rectangles(sizes, ATLAS_PADDING)
+    pixels = np.zeros((atlas_height, atlas_width, 4), dtype=np.float32)
+    for node, (x, y), (width, height) in zip(candidates, positions, sizes):
+        crop = np.empty(width * height * 4, dtype=np.float32)
+        node.image.pixels.foreach_get(crop)
+        pixels[y:y + height, x:x + width] = crop.reshape(height, width, 4)
+
+    atlas = bpy.data.images.new(f"{nodegroup.name}_atlas", width=atlas_width, height=atlas_height, alpha=True)
+    atlas.pixels.foreach_set(pixels.ravel())
+    atlas.update()
+
+    # Everything needed to unpack lives on the texture node
+    packed_images = set()
+    for node, (x, y), (width, height) in zip(candidates, positions, sizes):
+        image = node.image
+        offset = tuple(image.get("photostack_offset", (0, 0)))
+        node["photostack_atlas_layer"] = image.name
+        node["photostack_atlas_rect"] = (x, y, width, height)
+        node["photostack_atlas_size"] = tuple(image["photostack_size"])
+        if "photostack_offset" in image:
+            node["photostack_atlas_offset"] = offset
+        set_atlas_mapping(nodegroup, node, (atlas_width, atlas_height), (x, y, width, height), image["photostack_size"], offset)
+        node.image = atlas
+        packed_images.add(image)
+
+    invalidate_stack_ir(nodegroup)
+    refresh_layer_registries(nodegroup)
+    for image in packed_images:
+        if image.users == 0:
+            bpy.data.images.remove(image)
+
+    return len(candidates), atlas
+
+
+def unpack_layer_atlas(nodegroup):
+    """Give every atlas layer of a stack its own image again. Returns the number of layers unpacked."""
+    atlas_pixels = {}
+    atlases = set()
+    unpacked = 0
+    # Collected first: the loop removes atlas lookup nodes, and touching a removed node crashes
+    for node in [node for node in nodegroup.nodes if node.type == 'TEX_IMAGE' and "photostack_atlas_rect" in node]:
+        atlas = node.image
+        if atlas.name not in atlas_pixels:
+            atlas_width, atlas_height = atlas.size
+            buffer = np.empty(atlas_width * atlas_height * 4, dtype=np.float32)
+            atlas.pixels.foreach_get(buffer)
+            atlas_pixels[atlas.name] = buffer.reshape(atlas_height, atlas_width, 4)
+        x, y, width, height = node["photostack_atlas_rect"]
+
+        image = bpy.data.images.new(node["photostack_atlas_layer"], width=width, height=height, alpha=True)
+        image.generated_color = (0, 0, 0, 0)
+        image.pixels.foreach_set(atlas_pixels[atlas.name][y:y + height, x:x + width].ravel())
+        image.update()
+        image["photostack_size"] = tuple(node["photostack_atlas_size"])
+
+        # Drop the atlas lookup and read the UV the layer had before
+        vector_input = node.inputs['Vector']
+        uv_socket = vector_input.links[0].from_socket if vector_input.is_linked else None
+        while uv_socket and uv_socket.node.get("photostack_atlas") and uv_socket.node.type != 'TEX_COORD':
+            atlas_node = uv_socket.node
+            uv_socket = atlas_node.inputs[0].links[0].from_socket if atlas_node.inputs[0].is_linked else None
+            nodegroup.nodes.remove(atlas_node)
+        if uv_socket and not uv_socket.node.get("photostack_atlas"):
+            nodegroup.links.new(uv_socket, vector_input)
+
+        node.image = image
+        node.extension = 'REPEAT'
+        if "photostack_atlas_offset" in node:
+            image["photostack_offset"] = tuple(node["photostack_atlas_offset"])
+            set_layer_offset(nodegroup, node, image["photostack_offset"])
+
+        for key in ("photostack_atlas_layer", "photostack_atlas_rect", "photostack_atlas_size", "photostack_atlas_offset"):
+            if key in node:
+                del node[key]
+        atlases.add(atlas)
+        unpacked += 1
+
+    for node in [node for node in nodegroup.nodes if node.type == 'TEX_COORD' and node.get("photostack_atlas")]:
+        nodegroup.nodes.remove(node)
+
+    invalidate_stack_ir(nodegroup)
+    refresh_layer_registries(nodegroup)
+    for atlas in atlases:
+        if atlas.users == 0:
+            bpy.data.images.remove(atlas)
+
+    return unpacked
+
+
+def write_stack_exr(material, filepath):
+    """Write every layer of the material's PhotoStack to one multi-part OpenEXR, bottom layer first.
+
+    Each layer is a part named after its image, holding only the pixels the
+    layer stores: a cropped layer keeps its crop, placed by the data window
+    inside a display window of the stack size. Byte layers are linearized and
+    stored as half floats, float layers keep full float precision. Blend mode
+    and visibility go into part attributes so the stack can be rebuilt.
+    Returns the number of layers written.
+    """
+    if oiio is None:
+        raise ValueError("OpenImageIO is not available in this Blender")
+
+    nodegroup, layers = get_layer_registry(material)
+    if not nodegroup:
+        raise ValueError("No PhotoStack found on the material")
+
+    images, specs = [], []
+    for index, entry in enumerate(layers):
+        img_tex, mix_node = get_layer_nodes(material, index)
+        if not img_tex or not img_tex.image:
+            raise ValueError(f"Layer {index} has no image")
+        if "photostack_atlas_rect" in img_tex:
+            raise ValueError(f"Layer {img_tex.name} is packed into an atlas, unpack the stack first")
+
+        image = img_tex.image
+        width, height = image.size
+        full_width, full_height = image.get("photostack_size", image.size)
+        offset_x, offset_y = image.get("photostack_offset", (0, 0))
+
+        spec = oiio.ImageSpec(width, height, 4, "float" if image.is_float else "half")
+        spec.channelnames = tuple(f"{image.name}.{channel}" for channel in "RGBA")
+        spec.alpha_channel = 3
+        # OpenEXR windows count rows from the top, Blender from the bottom
+        spec.x, spec.y = offset_x, full_height - offset_y - height
+        spec.full_x, spec.full_y = 0, 0
+        spec.full_width, spec.full_height = full_width, full_height
+        spec.attribute("oiio:subimagename", image.name)
+        spec.attribute("compression", "zip")
+        spec.attribute("photostack:blend_type", entry.blend_type if mix_node else "")
+        spec.attribute("photostack:visible", int(entry.visible))
+        spec.attribute("photostack:cropped", int("photostack_offset" in image))
+        images.append(image)
+        specs.append(spec)
+
+    output = oiio.ImageOutput.create(filepath)
+    if not output or not output.open(filepath, specs):
+        raise ValueError(f"Can't write {filepath}: {oiio.geterror()}")
+
+    # One layer in memory at a time
+    try:
+        for i, (image, spec) in enumerate(zip(images, specs)):
+            if i and not output.open(filepath, spec, "AppendSubimage"):
+                raise ValueError(output.geterror())
+            width, height = image.size
+            pixels = np.empty(width * height * 4, dtype=np.float32)
+            image.pixels.foreach_get(pixels)
+            pixels = pixels.reshape(height, width, 4)[::-1]
+            if not image.is_float and image.colorspace_settings.name == 'sRGB':
+                pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+            if not output.write_image(np.ascontiguousarray(pixels)):
+                raise ValueError(output.geterror())
+    finally:
+        output.close()
+
+    return len(images)
+
+
+def write_layer_file(path, pixels, is_float):
+    """Encode and write one layer copy, off the main thread. Returns the seconds it took.
+
+    Byte layers go to PNG, float layers to full float OpenEXR. The file is
+    written next to its target and renamed over it, so a failed save never
+    leaves a half-written layer behind.
+    """
+    start = time.perf_counter()
+    temp_path = path + ".tmp"
+    if is_float:
+        if oiio is None:
+            raise ValueError("OpenImageIO is needed to save float layers")
+        height, width, channels = pixels.shape
+        output = oiio.ImageOutput.create("exr")
+        if not output or not output.open(temp_path, oiio.ImageSpec(width, height, channels, "float")):
+            raise ValueError(f"Can't write {path}: {oiio.geterror()}")
+        written = output.write_image(np.ascontiguousarray(pixels[::-1]))
+        output.close()
+        if not written:
+            raise ValueError(f"Can't write {path}")
+    else:
+        with open(temp_path, "wb") as layer_file:
+            layer_file.write(encode_png(pixels))
+
+    os.replace(temp_path, path)
+    return time.perf_counter() - start
+
+
+def save_layer_copy(path, pixels, is_float):
+    """Write a layer copy and checksum it, off the main thread. Returns (seconds, checksum)."""
+    return write_layer_file(path, pixels, is_float), pixels_checksum(pixels)
+
+
+def layer_save_path(image, directory):
+    """Where a dirty layer is saved: its own file if that has the right format, else directory.
+
+    A proxy is never saved over the file of the layer it stands in for.
+    """
+    file_format = 'OPEN_EXR' if image.is_float else 'PNG'
+    if (image.source == 'FILE' and image.filepath and image.file_format == file_format and not image.library
+            and "photostack_proxy_master" not in image):
+        return bpy.path.abspath(image.filepath)
+    extension = ".exr" if image.is_float else ".png"
+    return os.path.join(bpy.path.abspath(directory), bpy.path.clean_name(image.name) + extension)
+
+
+def photostack_groups():
+    for nodegroup in bpy.data.node_groups:
+        if nodegroup.bl_idname == 'ShaderNodeTree' and "_photostack" in nodegroup.name:
+            yield nodegroup
+
+
+def dirty_layer_images():
+    """Dirty, unpacked layer images of every PhotoStack, each once.
+
+    Proxies are left out: their full-resolution pixels live in the master
+    and reach the layer by conforming, not by saving.
+    """
+    images = {}
+    for nodegroup in photostack_groups():
+        for node in nodegroup.nodes:
+            image = node.image if node.type == 'TEX_IMAGE' else None
+            if (image and image.is_dirty and not image.packed_file and image.source in {'FILE', 'GENERATED'}
+                    and "photostack_proxy_master" not in image):
+                images[image.name] = image
+    return list(images.values())
+
+
+def copy_layer_pixels(image):
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, image.channels)
+
+
+# Image updates the depsgraph reported, by image name, so a save can tell a
+# layer was painted on after its pixels were copied without reading them again.
+# None counts the updates that name no image, which could be any layer.
+image_edit_counts = {}
+
+
+@bpy.app.handlers.persistent
+def count_image_edits(scene, depsgraph):
+    if not depsgraph.id_type_updated('IMAGE'):
+        return
+    names = {update.id.name for update in depsgraph.updates if isinstance(update.id, bpy.types.Image)}
+    for name in names or [None]:
+        image_edit_counts[name] = image_edit_counts.get(name, 0) + 1
+
+
+def image_edit_stamp(image):
+    """Changes whenever the depsgraph reports an update that may have touched image."""
+    return image_edit_counts.get(image.name, 0), image_edit_counts.get(None, 0)
+
+
+def finish_layer_save(image, path, stamp, checksum):
+    """Point image at the file just written and reload it, which clears is_dirty.
+
+    Returns the seconds the reload took, or None, leaving the image dirty, if
+    it was updated since its pixels were copied under stamp or they no longer
+    match checksum. The depsgraph doesn't report every paint stroke, so the
+    stamp only rules out a read; the pixels are compared before the reload
+    throws them away. Reloading is the only way to clear is_dirty short of
+    saving again on the main thread. It just frees the buffer: Blender decodes
+    the saved file again the next time the image is drawn or read, a cost this
+    timing doesn't include.
+    """
+    if image_edit_stamp(image) != stamp or pixels_checksum(copy_layer_pixels(image)) != checksum:
+        return None
+
+    start = time.perf_counter()
+    image.filepath_raw = bpy.path.relpath(path) if bpy.data.filepath else path
+    image.file_format = 'OPEN_EXR' if image.is_float else 'PNG'
+    if image.source != 'FILE':
+        image.source = 'FILE'
+    image.reload()
+    return time.perf_counter() - start
+
+
+def image_memory(image):
+    """Estimated bytes of an image's pixel buffer, 4 bytes a channel for float and 1 for byte."""
+    width, height = image.size
+    return width * height * image.channels * (4 if image.is_float else 1)
+
+
+def stack_memory_report(nodegroup, load=True):
+    """Memory record of every layer image of a stack, bottom to top, and the stack total.
+
+    An image shown by several layers, like an atlas, is counted once. Reading
+    an image's size loads its pixels, so with load=False images not in memory
+    are reported as not loaded, using no bytes, instead of being loaded.
+    """
+    layers = []
+    counted = set()
+    for layer in get_stack_layers(nodegroup):
+        image = layer.image
+        if not image or image.name in counted:
+            continue
+        counted.add(image.name)
+
+        loaded = image.has_data
+        if not loaded and not load:
+            layers.append({
+                "name": image.name,
+                "loaded": False,
+                "bytes": 0,
+                "dirty": image.is_dirty,
+                "packed": image.packed_file is not None,
+            })
+            continue
+
+        width, height = image.size
+        layers.append({
+            "name": image.name,
+            "loaded": loaded,
+            "width": width,
+            "height": height,
+            "stack_size": list(image.get("photostack_size", image.size)),
+            "channels": image.channels,
+            "float": image.is_float,
+            "bytes": image_memory(image),
+            "dirty": image.is_dirty,
+            "packed": image.packed_file is not None,
+        })
+
+    return {"group": nodegroup.name, "layers": layers, "bytes": sum(layer["bytes"] for layer in layers)}
+
+
+def file_memory_report(load=True):
+    """Memory records of every PhotoStack in the file, with a total over all their images."""
+    stacks = [stack_memory_report(nodegroup, load) for nodegroup in photostack_groups()]
+    images = {layer["name"]: layer["bytes"] for stack in stacks for layer in stack["layers"]}
+    return {"file": bpy.data.filepath, "stacks": stacks, "bytes": sum(images.values())}
+
+
+def format_bytes(size):
+    return f"{size / 2 ** 20:.1f} MiB"
+
+
+def make_proxy_layer(image, factor, directory):
+    """Write a layer's full-resolution pixels to a master file and keep a 1/factor proxy to paint on.
+
+    The master is an OpenEXR of the stored values, half floats for byte
+    layers and full floats for float ones. The proxy as first made is kept
+    next to it, so conforming can tell which proxy pixels were painted. A
+    sparse layer is expanded to the stack size first, so every proxy of a
+    stack, and the stack size it reports, is the same size. A layer loaded
+    from a file, like the base photo, isn't scaled in place, where saving
+    would write the proxy over its file: its texture nodes show a new proxy
+    image instead. Returns the bytes of image memory freed.
+    """
+    if oiio is None:
+        raise ValueError("OpenImageIO is needed to write proxy masters")
+
+    if is_sparse_layer(image):
+        expand_sparse_layer(image)
+    width, height = image.size
+    if image.channels == 4:
+        pixels = read_layer_pixels(image)
+    else:
+        # A gray or RGB photo gets an opaque RGBA master and proxy
+        pixels = np.ones((height, width, 4), dtype=np.float32)
+        pixels[..., :3] = copy_layer_pixels(image)[..., :3]
+    master_path = os.path.join(bpy.path.abspath(directory), bpy.path.clean_name(image.name) + "_master.exr")
+
+    output = oiio.ImageOutput.create(master_path)
+    spec = oiio.ImageSpec(width, height, 4, "float" if image.is_float else "half")
+    spec.attribute("compression", "zip")
+    if not output or not output.open(master_path, spec):
+        raise ValueError(f"Can't write {master_path}: {oiio.geterror()}")
+    written = output.write_image(np.ascontiguousarray(pixels[::-1]))
+    output.close()
+    if not written:
+        raise ValueError(f"Can't write {master_path}")
+
+    proxy = reduce_proxy_pixels(pixels, factor)
+    memory_before = image_memory(image)
+
+    proxy_height, proxy_width = proxy.shape[:2]
+    if image.source == 'FILE':
+        source = image
+        image = bpy.data.images.new(f"{source.name}_proxy", width=proxy_width, height=proxy_height,
+                                    alpha=True, float_buffer=source.is_float)
+        image.colorspace_settings.name = source.colorspace_settings.name
+        image["photostack_proxy_source"] = source.name
+        if "photostack_size" in source:
+            image["photostack_size"] = tuple(source["photostack_size"])
+        for nodegroup, img_tex in find_layer_nodes(source):
+            img_tex.image = image
+            invalidate_stack_ir(nodegroup)
+            refresh_layer_registries(nodegroup)
+        # Unsaved painting on the source has to stay in memory, anything else reloads from its file
+        if source.is_dirty:
+            memory_before = 0
+        else:
+            source.buffers_free()
+    else:
+        image.scale(proxy_width, proxy_height)
+    image.pixels.foreach_set(proxy.ravel())
+    image.update()
+    # Read back, a byte layer stores the proxy quantized
+    np.save(master_path + ".proxy.npy", read_layer_pixels(image))
+
+    image["photostack_proxy_master"] = master_path
+    image["photostack_proxy_factor"] = factor
+    image["photostack_master_size"] = (width, height)
+    # Proxies are the stack resolution while they exist, so they aren't taken for sparse layers
+    if "photostack_size" in image:
+        image["photostack_size"] = (proxy_width, proxy_height)
+
+    return memory_before - image_memory(image)
+
+
+def conform_proxy_layer(image, restore=False, band_rows=PROXY_BAND_ROWS):
+    """Apply the painting done on a proxy to its full-resolution master.
+
+    The master is streamed through in bands of band_rows proxy rows and only
+    bands with painted proxy pixels are changed. What the painting changed,
+    the proxy minus the proxy as first made, is upsampled bilinearly and added
+    to the master, so strokes keep soft edges and the full-resolution detail
+    under them stays. With restore the image goes back to full resolution
+    afterwards and stops being a proxy; a proxy of a file-backed layer hands
+    its texture nodes back to that layer, which only gets the master's pixels
+    if painting changed them. Returns the bands changed.
+    """
+    if oiio is None:
+        raise ValueError("OpenImageIO is needed to read proxy masters")
+
+    master_path = image["photostack_proxy_master"]
+    factor = image["photostack_proxy_factor"]
+    width, height = image["photostack_master_size"]
+    baseline_path = master_path + ".proxy.npy"
+    proxy = read_layer_pixels(image)
+    baseline = np.load(baseline_path)
+    if proxy.shape != baseline.shape:
+        raise ValueError(f"Proxy of {image.name} was resized, it can't be conformed")
+    delta = proxy - baseline
+
+    master_input = oiio.ImageInput.open(master_path)
+    if not master_input:
+        raise ValueError(f"Can't read {master_path}: {oiio.geterror()}")
+    spec = master_input.spec()
+    temp_path = master_path + ".tmp.exr"
+    output = oiio.ImageOutput.create(temp_path)
+    if not output or not output.open(temp_path, spec):
+        master_input.close()
+        raise ValueError(f"Can't write {temp_path}: {oiio.geterror()}")
+
+    # OpenEXR stores the top row first, so bands run from the top of the image down
+    changed = 0
+    rows = band_rows * factor
+    try:
+        for bottom in reversed(range(0, height, rows)):
+            top = min(bottom + rows, height)
+            band = master_input.read_scanlines(0, 0, height - top, height - bottom, 0, 0, 4, "float")[::-1].copy()
+
+            if conform_proxy_band(band, delta, factor, bottom, clip=not image.is_float):
+                changed += 1
+
+            if not output.write_scanlines(height - top, height - bottom, 0, np.ascontiguousarray(band[::-1])):
+                raise ValueError(output.geterror())
+    finally:
+        master_input.close()
+        output.close()
+
+    os.replace(temp_path, master_path)
+    np.save(baseline_path, proxy)
+    if changed:
+        image["photostack_master_edited"] = True
+
+    source = bpy.data.images.get(image.get("photostack_proxy_source", ""))
+    if restore and source:
+        if image.get("photostack_master_edited"):
+            master_input = oiio.ImageInput.open(master_path)
+            pixels = master_input.read_image(0, 4, "float")[::-1]
+            master_input.close()
+            source.pixels.foreach_set(np.ascontiguousarray(pixels[..., :source.channels], dtype=np.float32).ravel())
+            source.update()
+        for nodegroup, img_tex in find_layer_nodes(image):
+            img_tex.image = source
+            invalidate_stack_ir(nodegroup)
+            refresh_layer_registries(nodegroup)
+        bpy.data.images.remove(image)
+    elif restore:
+        master_input = oiio.ImageInput.open(master_path)
+        pixels = master_input.read_image(0, 4, "float")[::-1]
+        master_input.close()
+        image.scale(width, height)
+        image.pixels.foreach_set(np.ascontiguousarray(pixels, dtype=np.float32).ravel())
+        image.update()
+        if "photostack_size" in image:
+            image["photostack_size"] = (width, height)
+        for key in ("photostack_proxy_master", "photostack_proxy_factor", "photostack_master_size",
+                    "photostack_proxy_source", "photostack_master_edited"):
+            if key in image:
+                del image[key]
+
+    return changed
+
+
+def read_canvas_pixels(image):
+    """A layer's pixels on a canvas of the stack size, as linear float32 (height, width, 4)."""
+    full_width, full_height = image.get("photostack_size", image.size)
+    stored = read_layer_pixels(image)
+    if stored.shape[:2] == (full_height, full_width):
+        pixels = stored
+    elif "photostack_offset" in image:
+        pixels = place_crop(stored, image["photostack_offset"], (full_width, full_height))
+    else:
+        pixels = np.zeros((full_height, full_width, 4), dtype=np.float32)
+
+    if not image.is_float and image.colorspace_settings.name == 'sRGB':
+        pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+    return pixels
+
+
+def write_canvas_pixels(image, pixels):
+    """Store stack-size linear pixels in a layer, cropping it to its paint again if it was sparse.
+
+    A layer stored at full size stays full size, whatever it holds.
+    """
+    was_sparse = is_sparse_layer(image)
+    if not image.is_float and image.colorspace_settings.name == 'sRGB':
+        pixels[..., :3] = linear_to_srgb(pixels[..., :3])
+
+    height, width = pixels.shape[:2]
+    if tuple(image.size) != (width, height):
+        image.scale(width, height)
+    image.pixels.foreach_set(np.ascontiguousarray(pixels, dtype=np.float32).ravel())
+    image.update()
+
+    if "photostack_offset" in image:
+        del image["photostack_offset"]
+        for nodegroup, img_tex in find_layer_nodes(image):
+            set_layer_offset(nodegroup, img_tex, None)
+    if was_sparse:
+        shrink_layer(image)
+
+
+def layer_factor(mix_node, img_tex, pixels):
+    """The Mix factor of a layer as the shader sees it: the layer alpha when linked, else the value."""
+    factor_input = get_socket(mix_node.inputs, 'Factor_Float')
+    if not factor_input.is_linked:
+        return np.full(pixels.shape[:2], factor_input.default_value, dtype=np.float32)
+
+    from_socket = factor_input.links[0].from_socket
+    if from_socket.node != img_tex or from_socket.name != 'Alpha':
+        raise ValueError(f"Layer {img_tex.name} is mixed by something other than its alpha")
+    return pixels[..., 3]
+
+
+def collapse_layers(material, indices):
+    """Merge the registry layers at indices (ascending) into the first of them, with NumPy.
+
+    Into the base image every blend mode merges exactly, keeping the base
+    alpha as the shader does. Above the base only visible MIX layers merge:
+    they are composited 'over', premultiplied, into one layer whose alpha
+    drives its Mix factor. The consumed layers are deleted with their images
+    and Mix nodes and the chain is relinked. Returns the layers merged.
+    """
+    nodegroup, layers = get_layer_registry(material)
+    if not nodegroup:
+        raise ValueError("No PhotoStack found on the material")
+    if len(indices) < 2 or indices[0] < 0 or indices[-1] >= len(layers):
+        raise ValueError("Nothing to merge")
+
+    stack_layers = [get_layer_nodes(material, index) for index in indices]
+    for img_tex, mix_node in stack_layers:
+        if not img_tex or not img_tex.image:
+            raise ValueError("Layers no longer match the PhotoStack")
+        if "photostack_atlas_rect" in img_tex:
+            raise ValueError(f"Layer {img_tex.name} is packed into an atlas, unpack the stack first")
+    for img_tex, mix_node in stack_layers[1:] if indices[0] == 0 else stack_layers:
+        if mix_node.mute:
+            raise ValueError(f"Layer {img_tex.image.name} is hidden")
+        if indices[0] > 0 and mix_node.blend_type != 'MIX':
+            raise ValueError("Only MIX layers can be merged above the base image")
+
+    target_tex, target_mix = stack_layers[0]
+    result = read_canvas_pixels(target_tex.image)
+    if indices[0] == 0:
+        for img_tex, mix_node in stack_layers[1:]:
+            layer_pixels = read_canvas_pixels(img_tex.image)
+            if layer_pixels.shape != result.shape:
+                raise ValueError(f"Layer {img_tex.image.name} is not the size of the stack")
+            factor = layer_factor(mix_node, img_tex, layer_pixels)
+            result = blend_rgba(mix_node.blend_type, result, layer_pixels, factor, clamp=mix_node.clamp_result)
+    else:
+        def merged_layers():
+            # Read one at a time as the merge consumes them
+            for img_tex, mix_node in stack_layers[1:]:
+                layer_pixels = read_canvas_pixels(img_tex.image)
+                if layer_pixels.shape != result.shape:
+                    raise ValueError(f"Layer {img_tex.image.name} is not the size of the stack")
+                yield layer_pixels, layer_factor(mix_node, img_tex, layer_pixels)
+
+        result = merge_over(result, layer_factor(target_mix, target_tex, result), merged_layers())
+        nodegroup.links.new(target_tex.outputs['Alpha'], get_socket(target_mix.inputs, 'Factor_Float'))
+
+    write_canvas_pixels(target_tex.image, result)
+
+    # Top down, so the indices still to delete stay valid
+    for index in reversed(indices[1:]):
+        delete_layer(material, index)
+    material.photostack_layer_index = indices[0]
+
+    if CHAIN_TIP_KEY in nodegroup:
+        compile_stack(nodegroup)
+    return len(indices) - 1
+
+
+def append_stack_layer(material, nodegroup, name, width, height):
+    """Add one blank layer called name on top of the stack and return its (texture node, Mix node)."""
+    tip_node = get_stack_tip(nodegroup)
+    number = sum(1 for node in nodegroup.nodes if node.type == 'TEX_IMAGE') + 1
+    top_socket, layer_nodes = add_stack_layers(nodegroup, get_color_output(tip_node), number, 1, width, height)
+    img_tex, mix_node = layer_nodes[0]
+    img_tex.image.name = name
+
+    if CHAIN_TIP_KEY in nodegroup:
+        nodegroup[CHAIN_TIP_KEY] = mix_node.name
+    else:
+        nodegroup.links.new(top_socket, get_group_output(nodegroup).inputs[0])
+    invalidate_stack_ir(nodegroup)
+    add_registry_entry(material, img_tex, mix_node)
+    return img_tex, mix_node
+
+
+def read_stack_exr(material, filepath):
+    """Refresh the material's PhotoStack from a file written by write_stack_exr.
+
+    Parts are matched to layers by image name and overwrite their pixels, crop,
+    blend mode and visibility. Parts with no matching layer are added on top of
+    the stack in file order. Returns (layers refreshed, layers added).
+    """
+    if oiio is None:
+        raise ValueError("OpenImageIO is not available in this Blender")
+
+    nodegroup, layers = get_layer_registry(material)
+    if not nodegroup:
+        raise ValueError("No PhotoStack found on the material")
+
+    stack_input = oiio.ImageInput.open(filepath)
+    if not stack_input:
+        raise ValueError(f"Can't read {filepath}: {oiio.geterror()}")
+
+    indices = {entry.image.name: index for index, entry in enumerate(layers) if entry.image}
+    refreshed = added = 0
+    subimage = 0
+    try:
+        while stack_input.seek_subimage(subimage, 0):
+            spec = stack_input.spec()
+            name = spec.getattribute("oiio:subimagename") or f"PaintLayer_{subimage + 1}"
+            pixels = stack_input.read_image(0, 4, "float")[::-1]
+            height, width = pixels.shape[:2]
+            subimage += 1
+
+            if name in indices:
+                index = indices[name]
+                img_tex, mix_node = get_layer_nodes(material, index)
+                refreshed += 1
+            else:
+                img_tex, mix_node = append_stack_layer(material, nodegroup, name, spec.full_width, spec.full_height)
+                index = len(layers) - 1
+                if spec.format == oiio.TypeFloat:
+                    img_tex.image.use_generated_float = True
+                added += 1
+            if not img_tex:
+                continue
+
+            image = img_tex.image
+            if not image.is_float and image.colorspace_settings.name == 'sRGB':
+                pixels[..., :3] = linear_to_srgb(pixels[..., :3])
+            if tuple(image.size) != (width, height):
+                image.scale(width, height)
+            image.pixels.foreach_set(np.ascontiguousarray(pixels, dtype=np.float32).ravel())
+            image.update()
+
+            offset = None
+            if "photostack_size" in image or (width, height) != (spec.full_width, spec.full_height):
+                image["photostack_size"] = (spec.full_width, spec.full_height)
+            if spec.getattribute("photostack:cropped"):
+                offset = (spec.x, spec.full_height - spec.y - height)
+                image["photostack_offset"] = offset
+            elif "photostack_offset" in image:
+                del image["photostack_offset"]
+            set_layer_offset(nodegroup, img_tex, offset)
+
+            blend_type = spec.getattribute("photostack:blend_type")
+            if mix_node and blend_type:
+                mix_node.blend_type = blend_type
+                layers[index].blend_type = blend_type
+            visible = spec.getattribute("photostack:visible")
+            if mix_node and visible is not None:
+                layers[index].visible = bool(visible)
+    finally:
+        stack_input.close()
+
+    invalidate_stack_ir(nodegroup)
+    if CHAIN_TIP_KEY in nodegroup:
+        compile_stack(nodegroup)
+    return refreshed, added
+
+
+def benchmark_stack_exr(layer_counts=(10, 30), size=1024):
+    """Compare writing and reading a stack as one multi-part EXR with a PNG per layer.
+
+    Run from Blender's Python console. Layers are filled with noise so neither
+    format gets an easy compression ratio.
+    """
+    rng = np.random.default_rng(0)
+    for layer_count in layer_counts:
+        material = bpy.data.materials.new(".benchmark_stack_exr")
+        material.use_nodes = True
+        nodegroup = bpy.data.node_groups.new(type='ShaderNodeTree', name=".benchmark_stack_exr_photostack")
+        nodegroup.nodes.new("NodeGroupOutput")
+        nodegroup.interface.new_socket(name="Result", socket_type='NodeSocketColor', in_out='OUTPUT')
+        material.node_tree.nodes.new(type="ShaderNodeGroup").node_tree = nodegroup
+
+        base_image = bpy.data.images.new(".benchmark_exr_base", width=size, height=size, alpha=True)
+        img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
+        img_tex.image = base_image
+        top_socket, layer_nodes = add_stack_layers(nodegroup, img_tex.outputs['Color'], 2, layer_count - 1, size, size)
+        nodegroup.links.new(top_socket, get_group_output(nodegroup).inputs[0])
+        images = [base_image] + [node.image for node, mix_node in layer_nodes]
+        for image in images:
+            image.pixels.foreach_set(rng.random(size * size * 4, dtype=np.float32))
+
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                start = time.perf_counter()
+                for image in images:
+                    image.filepath_raw = os.path.join(directory, f"{image.name}.png")
+                    image.file_format = 'PNG'
+                    image.save()
+                png_save = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for image in images:
+                    loaded = bpy.data.images.load(os.path.join(directory, f"{image.name}.png"))
+                    loaded.pixels.foreach_get(np.empty(size * size * 4, dtype=np.float32))
+                    bpy.data.images.remove(loaded)
+                png_load = time.perf_counter() - start
+
+                exr_path = os.path.join(directory, "stack.exr")
+                start = time.perf_counter()
+                write_stack_exr(material, exr_path)
+                exr_save = time.perf_counter() - start
+
+                start = time.perf_counter()
+                read_stack_exr(material, exr_path)
+                exr_load = time.perf_counter() - start
+
+                png_size = sum(os.path.getsize(os.path.join(directory, f"{image.name}.png")) for image in images)
+                exr_size = os.path.getsize(exr_path)
+
+            print(f"{layer_count} layers: PNG save {png_save:.2f}s load {png_load:.2f}s {png_size / 2 ** 20:.0f} MiB, "
+                  f"EXR save {exr_save:.2f}s load {exr_load:.2f}s {exr_size / 2 ** 20:.0f} MiB")
+        finally:
+            for image in images:
+                bpy.data.images.remove(image)
+            bpy.data.node_groups.remove(nodegroup)
+            bpy.data.materials.remove(material)
+
+
+class PhotoStack(bpy.types.Operator):
+    """Add or extend a 'Photostack' with Multiple Image Textures inside a Node Group"""
+    bl_idname = "object.add_photostack"
+    bl_label = "Add to or Create Photostack"
+
+    def execute(self, context):
+        scene = context.scene
+        num_textures = scene.num_textures
+        obj = context.object
+
+        # Ensure the object has a material
+        if not obj.data.materials:
+            self.report({'ERROR'}, "Object has no material.")
+            return {'CANCELLED'}
+
+        material = obj.active_material
+        if not material.use_nodes:
+            material.use_nodes = True
+
+        nodes = material.node_tree.nodes
+
+        # Index the material once instead of scanning it for every lookup
+        material_index = index_nodes(nodes)
+
+        # The first Image Texture node is the active image node to copy
+        image_nodes = material_index.get('TEX_IMAGE', [])
+        image_node = image_nodes[0] if image_nodes else None
+
+        if not image_node or not image_node.image:
+            self.report({'ERROR'}, "No valid image texture node found.")
+            return {'CANCELLED'}
+
+        original_image = image_node.image  # This is the original image to copy
+
+        # UV map of each new layer, from the per-layer settings
+        settings = scene.texture_settings
+        layer_uv_maps = [settings[i].uv_map_name if i < len(settings) else "UVMap" for i in range(num_textures)]
+
+        # Check if a '_photostack' group node already exists in the material
+        group_node = None
+        for node in material_index.get('GROUP', []):
+            if node.node_tree and "_photostack" in node.node_tree.name:
+                group_node = node
+                break
+
+        # If no group node exists, create a new one
+        if not group_node:
+            nodegroup_name = f"{original_image.name}_photostack"
+            nodegroup = bpy.data.node_groups.new(type='ShaderNodeTree', name=nodegroup_name)
+
+            # Create input and output nodes in the node group
+            group_input = nodegroup.nodes.new("NodeGroupInput")
+            group_input.location = (-500, 0)
+            group_output_node = nodegroup.nodes.new("NodeGroupOutput")
+            group_output_node.location = (600, 0)
+
+            # Add an output socket to the node group interface in Blender 4.0+
+            nodegroup.interface.new_socket(name="Result", socket_type='NodeSocketColor', in_out='OUTPUT')
+
+            # Create a new group node in the material
+            group_node = nodes.new(type="ShaderNodeGroup")
+            group_node.node_tree = nodegroup
+
+            # Copy the first image node to the node group as the first layer
+            img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
+            img_tex.location = (-100, 400)
+            img_tex.image = original_image
+
+            # The original image reads the first layer's UV map through the group input
+            nodegroup.links.new(get_uv_input(nodegroup, layer_uv_maps[0]), img_tex.inputs['Vector'])
+
+            previous_socket = img_tex.outputs['Color']
+            num_existing_textures = 1
+
+            # Start the material's layer registry with the base layer
+            material.photostack_layers.clear()
+            material.photostack_group = nodegroup
+            add_registry_entry(material, img_tex, None)
+
+        else:
+            # If the group node already exists, retrieve it and index it once
+            nodegroup = group_node.node_tree
+            group_index = index_nodes(nodegroup.nodes)
+
+            output_nodes = group_index.get('GROUP_OUTPUT', [])
+            if not output_nodes:
+                self.report({'ERROR'}, "Group output node not found.")
+                return {'CANCELLED'}
+            group_output_node = output_nodes[0]
+
+            # Find the top of the layer chain (the node feeding the Group Output unless compiled)
+            tip_node = get_stack_tip(nodegroup)
+            if tip_node:
+                previous_socket = get_color_output(tip_node)
+            else:
+                # If there's no Mix node or connection to the Group Output, fallback to the original image node
+                previous_socket = None
+                for node in group_index.get('TEX_IMAGE', []):
+                    if node.image == original_image:
+                        previous_socket = node.outputs['Color']
+                        break
+
+                if not previous_socket:
+                    self.report({'ERROR'}, "No valid previous node found.")
+                    return {'CANCELLED'}
+
+            # Keep track of existing textures to avoid name conflicts
+            num_existing_textures = len(group_index.get('TEX_IMAGE', []))
+
+            # Bring the registry up to date before the chain changes
+            if layer_registry_is_stale(material, nodegroup):
+                rebuild_layer_registry(material, nodegroup)
+
+        # Add new blank image textures and mix them, one shared UV input per UV map
+        uv_sockets = [get_uv_input(nodegroup, uv_map) for uv_map in layer_uv_maps]
+        previous_socket, layer_nodes = add_stack_layers(
+            nodegroup, previous_socket, num_existing_textures + 1, num_textures,
+            original_image.size[0], original_image.size[1], scene.sparse_layers, uv_sockets)
+        feed_uv_inputs(nodegroup)
+        for img_tex, mix_node in layer_nodes:
+            add_registry_entry(material, img_tex, mix_node)
+
+        # Final output connection to the Group Output node, through the tree if compiled
+        if CHAIN_TIP_KEY in nodegroup:
+            nodegroup[CHAIN_TIP_KEY] = previous_socket.node.name
+        else:
+            nodegroup.links.new(previous_socket, group_output_node.inputs['Result'])
+
+        if CHAIN_TIP_KEY in nodegroup or scene.compile_stacks:
+            compile_stack(nodegroup)
+
+        # Connect the group output to the Material Output's surface
+        material_output_nodes = material_index.get('OUTPUT_MATERIAL', [])
+        if material_output_nodes:
+            material_output_node = material_output_nodes[0]
+        else:
+            material_output_node = nodes.new(type='ShaderNodeOutputMaterial')
+            material_output_node.location = (800, 0)
+
+        # Connect the group output to the material output
+        links = material.node_tree.links
+        links.new(group_node.outputs['Result'], material_output_node.inputs['Surface'])
+
+        return {'FINISHED'}
+
+
+def benchmark_compiled_stack(layer_counts=(5, 20, 50), samples=16, resolution=128, size=256):
+    """Compare Cycles CPU cost per sample of the linear chain and the compiled tree.
+
+    Renders a throwaway plane at samples and twice that many, so the difference
+    leaves out shader compile and scene sync. Run from Blender's Python console.
+    """
+    rng = np.random.default_rng(0)
+    scene = bpy.data.scenes.new(".benchmark_compiled_stack")
+    scene.render.engine = 'CYCLES'
+    scene.cycles.device = 'CPU'
+    scene.cycles.use_denoising = False
+    scene.render.resolution_x = scene.render.resolution_y = resolution
+
+    mesh = bpy.data.meshes.new(".benchmark_plane")
+    mesh.from_pydata([(-1, -1, 0), (1, -1, 0), (1, 1, 0), (-1, 1, 0)], [], [(0, 1, 2, 3)])
+    uv_layer = mesh.uv_layers.new(name="UVMap")
+    for loop, uv in zip(uv_layer.data, [(0, 0), (1, 0), (1, 1), (0, 1)]):
+        loop.uv = uv
+    plane = bpy.data.objects.new(".benchmark_plane", mesh)
+    scene.collection.objects.link(plane)
+
+    camera_data = bpy.data.cameras.new(".benchmark_camera")
+    camera_data.type = 'ORTHO'
+    camera_data.ortho_scale = 2.0
+    camera = bpy.data.objects.new(".benchmark_camera", camera_data)
+    camera.location = (0, 0, 2)
+    scene.collection.objects.link(camera)
+    scene.camera = camera
+
+    material = bpy.data.materials.new(".benchmark_material")
+    material.use_nodes = True
+    mesh.materials.append(material)
+    material_output_node = material.node_tree.nodes.get("Material Output")
+    images_before = set(bpy.data.images)
+
+    def time_render(sample_count):
+        scene.cycles.samples = sample_count
+        start = time.perf_counter()
+        bpy.ops.render.render(scene=scene.name)
+        return time.perf_counter() - start
+
+    def per_sample_ms():
+        return (time_render(samples * 2) - time_render(samples)) * 1000 / samples
+
+    try:
+        for layer_count in layer_counts:
+            nodegroup = bpy.data.node_groups.new(type='ShaderNodeTree', name=".benchmark_photostack")
+            nodegroup.interface.new_socket(name="Result", socket_type='NodeSocketColor', in_out='OUTPUT')
+            group_output_node = nodegroup.nodes.new("NodeGroupOutput")
+            base_image = bpy.data.images.new(".benchmark_base", width=size, height=size, alpha=True)
+            img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
+            img_tex.image = base_image
+
+            top_socket, layer_nodes = add_stack_layers(nodegroup, img_tex.outputs['Color'], 2, layer_count - 1, size, size)
+            nodegroup.links.new(top_socket, group_output_node.inputs[0])
+            for node in nodegroup.nodes:
+                if node.type == 'TEX_IMAGE':
+                    node.image.pixels.foreach_set(rng.random(size * size * 4, dtype=np.float32))
+
+            group_node = material.node_tree.nodes.new(type="ShaderNodeGroup")
+            group_node.node_tree = nodegroup
+            material.node_tree.links.new(group_node.outputs[0], material_output_node.inputs['Surface'])
+
+            linear = per_sample_ms()
+            compile_stack(nodegroup)
+            compiled = per_sample_ms()
+            print(f"{layer_count} layers: linear {linear:.2f} ms/sample, compiled {compiled:.2f} ms/sample")
+
+            material.node_tree.nodes.remove(group_node)
+            bpy.data.node_groups.remove(nodegroup)
+    finally:
+        for image in set(bpy.data.images) - images_before:
+            bpy.data.images.remove(image)
+        bpy.data.materials.remove(material)
+        bpy.data.objects.remove(plane)
+        bpy.data.objects.remove(camera)
+        bpy.data.meshes.remove(mesh)
+        bpy.data.cameras.remove(camera_data)
+        bpy.data.scenes.remove(scene)
+
+
+def benchmark_photostack(batch_size=10, batches=20, size=64):
+    """Time adding layers to a throwaway stack, batch after batch.
+
+    Run from Blender's Python console; the milliseconds per added layer should
+    stay flat as the stack grows.
+    """
+    nodegroup = bpy.data.node_groups.new(type='ShaderNodeTree', name=".benchmark_photostack")
+    base_image = bpy.data.images.new(".benchmark_base", width=size, height=size, alpha=True)
+    img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
+    img_tex.image = base_image
+    previous_socket = img_tex.outputs['Color']
+    images_before = set(bpy.data.images)
+
+    try:
+        for i in range(batches):
+            start = time.perf_counter()
+            previous_socket, layer_nodes = add_stack_layers(nodegroup, previous_socket, i * batch_size + 2, batch_size, size, size)
+            elapsed = time.perf_counter() - start
+            print(f"{(i + 1) * batch_size} layers: {elapsed * 1000 / batch_size:.2f} ms per layer")
+    finally:
+        for image in set(bpy.data.images) - images_before:
+            bpy.data.images.remove(image)
+        bpy.data.images.remove(base_image)
+        bpy.data.node_groups.remove(nodegroup)
+
+
+class PhotoStackShrinkLayers(bpy.types.Operator):
+    """Crop every paint layer of the active PhotoStack to its painted area"""
+    bl_idname = "object.photostack_shrink_layers"
+    bl_label = "Shrink PhotoStack Layers"
+    bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        scene = context.scene
-        num_textures = scene.num_textures
         obj = context.object
-
-        # Ensure the object has a material
-        if not obj.data.materials:
-            self.report({'ERROR'}, "Object has no material.")
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
             return {'CANCELLED'}
 
-        material = obj.active_material
-        if not material.use_nodes:
-            material.use_nodes = True
+        saved = 0
+        for index in range(1, len(layers)):
+            img_tex, mix_node = get_layer_nodes(material, index)
+            image = img_tex.image if img_tex else None
+            if image and "photostack_atlas_rect" not in img_tex:
+                adopt_stack_size(image)
+                saved += shrink_layer(image)
 
-        nodes = material.node_tree.nodes
+        self.report({'INFO'}, f"Freed {saved / 2 ** 20:.1f} MiB of layer storage")
+        return {'FINISHED'}
 
-        # Find the first Image Texture node (this is the active image node to copy)
-        image_node = None
-        for node in nodes:
-            if node.type == 'TEX_IMAGE':
-                image_node = node
-                break
 
-        if not image_node or not image_node.image:
-            self.report({'ERROR'}, "No valid image texture node found.")
+@bpy.app.handlers.persistent
+def expand_sparse_paint_target(scene, depsgraph):
+    """Give a sparse layer full-resolution storage as soon as it becomes the paint target."""
+    obj = bpy.context.active_object
+    if not obj or obj.mode != 'TEXTURE_PAINT':
+        return
+
+    image_paint = scene.tool_settings.image_paint
+    image = image_paint.canvas if image_paint.mode == 'IMAGE' else None
+    material = obj.active_material
+    if image is None and material and material.texture_paint_images:
+        image = material.texture_paint_images[min(material.paint_active_slot, len(material.texture_paint_images) - 1)]
+
+    if image and is_sparse_layer(image):
+        expand_sparse_layer(image)
+
+
+class PhotoStackCompile(bpy.types.Operator):
+    """Rebuild the active PhotoStack as a balanced tree of Mix nodes, or back as a linear chain"""
+    bl_idname = "object.photostack_compile"
+    bl_label = "Compile PhotoStack"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    linearize: bpy.props.BoolProperty(
+        name="Linearize",
+        description="Remove the compiled tree and use the linear chain again",
+        default=False
+    )
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup = get_photostack_group(material) if material and material.use_nodes else None
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
             return {'CANCELLED'}
 
-        original_image = image_node.image  # This is the original image to copy
+        if self.linearize:
+            linearize_stack(nodegroup)
+        elif not compile_stack(nodegroup):
+            self.report({'ERROR'}, "PhotoStack has no layers to compile.")
+            return {'CANCELLED'}
 
-        # Check if a '_photostack' group node already exists in the material
-        group_node = None
-        for node in nodes:
-            if node.type == 'GROUP' and "_photostack" in node.node_tree.name:
-                group_node = node
-                break
+        return {'FINISHED'}
 
-        # If no group node exists, create a new one
-        if not group_node:
-            nodegroup_name = f"{original_image.name}_photostack"
-            nodegroup = bpy.data.node_groups.new(type='ShaderNodeTree', name=nodegroup_name)
 
-            # Prepare links for adding more layers
-            links = nodegroup.links  # Initialize the links for the nodegroup here
+class PhotoStackCollapseUVNodes(bpy.types.Operator):
+    """Replace the per-layer UV Map nodes of every PhotoStack with one shared group input per UV map"""
+    bl_idname = "object.photostack_collapse_uv_nodes"
+    bl_label = "Collapse PhotoStack UV Nodes"
+    bl_options = {'REGISTER', 'UNDO'}
 
-            # Create input and output nodes in the node group
-            group_input = nodegroup.nodes.new("NodeGroupInput")
-            group_output = nodegroup.nodes.new("NodeGroupOutput")
-            group_output.location = (600, 0)
+    def execute(self, context):
+        removed = 0
+        for nodegroup in bpy.data.node_groups:
+            if nodegroup.bl_idname != 'ShaderNodeTree' or "_photostack" not in nodegroup.name:
+                continue
 
-            # Add an output socket to the node group interface in Blender 4.0+
-            nodegroup.interface.new_socket(name="Result", socket_type='NodeSocketColor', in_out='OUTPUT')
+            uv_nodes = [node for node in nodegroup.nodes if node.type == 'UVMAP']
+            for uv_node in uv_nodes:
+                uv_socket = get_uv_input(nodegroup, uv_node.uv_map)
+                for link in list(uv_node.outputs['UV'].links):
+                    nodegroup.links.new(uv_socket, link.to_socket)
+                nodegroup.nodes.remove(uv_node)
 
-            # Create a new group node in the material
-            group_node = nodes.new(type="ShaderNodeGroup")
-            group_node.node_tree = nodegroup
+            if uv_nodes:
+                feed_uv_inputs(nodegroup)
+                removed += len(uv_nodes)
 
-            ### Add a UV Map node for the first image (original image) ###
-            uv_node = nodegroup.nodes.new(type='ShaderNodeUVMap')
-            uv_node.location = (-300, 400)  # Position for the UV node
-            uv_node.uv_map = "UVMap"  # Assuming "UVMap", but this could be dynamic
+        self.report({'INFO'}, f"Removed {removed} UV Map nodes")
+        return {'FINISHED'}
 
-            # Copy the first image node to the node group as the first layer
-            img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
-            img_tex.location = (-100, 400)
-            img_tex.image = original_image
 
-            # Connect the UV map to the original image texture node
-            links.new(uv_node.outputs['UV'], img_tex.inputs['Vector'])
+class PhotoStackPackAtlas(bpy.types.Operator):
+    """Pack the small or mostly empty layers of the active PhotoStack into one atlas image, or unpack them"""
+    bl_idname = "object.photostack_pack_atlas"
+    bl_label = "Pack PhotoStack Atlas"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    unpack: bpy.props.BoolProperty(
+        name="Unpack",
+        description="Give every atlas layer its own image again",
+        default=False
+    )
 
-            previous_node = img_tex  # Track the first image node
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup = get_photostack_group(material) if material and material.use_nodes else None
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
 
+        if self.unpack:
+            unpacked = unpack_layer_atlas(nodegroup)
+            self.report({'INFO'}, f"Unpacked {unpacked} layers")
         else:
-            # If the group node already exists, retrieve it
-            nodegroup = group_node.node_tree  # This retrieves the existing nodegroup
-            links = nodegroup.links  # Initialize the links for the existing nodegroup
+            packed, atlas = pack_layer_atlas(nodegroup)
+            if not packed:
+                self.report({'INFO'}, "No layers small enough to pack")
+                return {'CANCELLED'}
+            self.report({'INFO'}, f"Packed {packed} layers into {atlas.size[0]}x{atlas.size[1]} atlas {atlas.name}")
 
-            # Locate the Group Output node
-            group_output_node = None
-            for node in nodegroup.nodes:
-                if node.type == 'GROUP_OUTPUT':
-                    group_output_node = node
-                    break
+        if CHAIN_TIP_KEY in nodegroup:
+            compile_stack(nodegroup)
+        return {'FINISHED'}
 
-            if not group_output_node:
-                self.report({'ERROR'}, "Group output node not found.")
-                return {'CANCELLED'}
 
-            # Find the last node connected to the Group Output node
-            if group_output_node.inputs[0].is_linked:
-                last_link = group_output_node.inputs[0].links[0]
-                previous_node = last_link.from_node  # Set the last connected node as previous_node
-            else:
-                # If there's no Mix node or connection to the Group Output, fallback to the original image node
-                previous_node = None
-                for node in nodegroup.nodes:
-                    if node.type == 'TEX_IMAGE' and node.image == original_image:
-                        previous_node = node
-                        break
+class PhotoStackSaveEXR(bpy.types.Operator):
+    """Save every layer of the active PhotoStack to one multilayer OpenEXR file"""
+    bl_idname = "object.photostack_save_exr"
+    bl_label = "Save PhotoStack EXR"
 
-                if not previous_node:
-                    self.report({'ERROR'}, "No valid previous node found.")
-                    return {'CANCELLED'}
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob: bpy.props.StringProperty(default="*.exr", options={'HIDDEN'})
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = bpy.path.ensure_ext(bpy.path.display_name_from_filepath(bpy.data.filepath) or "photostack", ".exr")
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        if not material:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        start = time.perf_counter()
+        try:
+            count = write_stack_exr(material, bpy.path.abspath(self.filepath))
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
 
+        self.report({'INFO'}, f"Saved {count} layers in {time.perf_counter() - start:.2f}s")
+        return {'FINISHED'}
 
-        # Start adding additional blank images (RGBA 0,0,0,0)
-        uv_y_offset = 200
-        img_y_offset = 400
-        mix_x_offset = 200
 
-        # Find the Group Output node
-        group_output_node = None
-        for node in nodegroup.nodes:
-            if node.type == 'GROUP_OUTPUT':
-                group_output_node = node
-                break
+class PhotoStackLoadEXR(bpy.types.Operator):
+    """Refresh the active PhotoStack from a multilayer OpenEXR file, adding layers it doesn't have"""
+    bl_idname = "object.photostack_load_exr"
+    bl_label = "Load PhotoStack EXR"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        if not group_output_node:
-            self.report({'ERROR'}, "Group output node not found.")
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob: bpy.props.StringProperty(default="*.exr", options={'HIDDEN'})
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        if not material:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
             return {'CANCELLED'}
 
-        # Keep track of existing textures to avoid name conflicts
-        num_existing_textures = len([n for n in nodegroup.nodes if n.type == 'TEX_IMAGE'])
+        try:
+            refreshed, added = read_stack_exr(material, bpy.path.abspath(self.filepath))
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Refreshed {refreshed} layers, added {added}")
+        return {'FINISHED'}
 
-        # Add new blank image textures and mix them
-        for i in range(num_textures):
-            # Create a new blank image for painting with a unique name
-            new_image_name = f"PaintLayer_{num_existing_textures + i + 1}"
-            new_image = bpy.data.images.new(new_image_name, width=original_image.size[0], height=original_image.size[1], alpha=True)
-            new_image.generated_color = (0, 0, 0, 0)  # RGBA 0,0,0,0 for transparency
 
-            # Create a new UV Map node and Image Texture node for the blank image
-            uv_node = nodegroup.nodes.new(type='ShaderNodeUVMap')
-            uv_node.location = (-300, uv_y_offset)
-            uv_node.uv_map = "UVMap"  # Assuming "UVMap", but this could be dynamic
+class PhotoStackSaveDirtyLayers(bpy.types.Operator):
+    """Save every dirty PhotoStack layer, encoding on worker threads while Blender stays responsive
 
-            img_tex = nodegroup.nodes.new(type='ShaderNodeTexImage')
-            img_tex.location = (-100, img_y_offset)
-            img_tex.image = new_image
-
-            # Connect the UV map to the Image Texture
-            links.new(uv_node.outputs['UV'], img_tex.inputs['Vector'])
-
-            # Create a mix node to blend the new image with the previous layer
-            mix_node = nodegroup.nodes.new(type='ShaderNodeMix')
-            mix_node.location = (mix_x_offset, img_y_offset)
-            mix_node.data_type = 'RGBA'  # Mix colors with alpha
-            mix_node.inputs["Factor"].default_value = 1.0  # Can be adjusted for blending
-
-            # Connect the previous node (last mix node or first image) to the new mix node
-            if previous_node.type == 'ShaderNodeMix':
-                # For ShaderNodeMix, use the 'Result' output
-                links.new(previous_node.outputs['Result'], mix_node.inputs['A'])  # Previous mix Result goes to A
+    Only as many layers as there are workers are copied at a time; the next
+    one is copied when one of them is written.
+    """
+    bl_idname = "object.photostack_save_dirty_layers"
+    bl_label = "Save Dirty Layers"
+
+    directory: bpy.props.StringProperty(
+        name="Directory",
+        description="Where layers without a file of their own are saved",
+        default="//photostack_layers",
+        subtype='DIR_PATH'
+    )
+    workers: bpy.props.IntProperty(
+        name="Workers",
+        description="Layers encoded at the same time",
+        default=4,
+        min=1,
+        max=64
+    )
+
+    _timer = None
+    _executor = None
+    _queued = None
+    _pending = None
+    _results = None
+
+    def start(self):
+        """Queue every dirty layer and start encoding the first ones, returning the layer count."""
+        if self.directory.startswith("//") and not bpy.data.filepath:
+            raise ValueError("Save the .blend file first or choose an absolute directory")
+
+        images = dirty_layer_images()
+        if images:
+            os.makedirs(bpy.path.abspath(self.directory), exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._queued = [(image.name, layer_save_path(image, self.directory)) for image in reversed(images)]
+        self._pending = []
+        self._results = []
+        self.submit()
+        return len(images)
+
+    def submit(self):
+        """Copy queued layers until every worker has one; only the worker keeps the copy."""
+        while self._queued and len(self._pending) < self.workers:
+            name, path = self._queued.pop()
+            image = bpy.data.images.get(name)
+            if not image:
+                self._results.append((name, None, "failed: removed before it was saved", None))
+                continue
+            stamp = image_edit_stamp(image)
+            future = self._executor.submit(save_layer_copy, path, copy_layer_pixels(image), image.is_float)
+            self._pending.append((name, path, stamp, future))
+
+    def collect(self, wait=False):
+        """Finish the layers whose files are written, on the main thread, and copy the next ones."""
+        still_pending = []
+        for name, path, stamp, future in self._pending:
+            if not wait and not future.done():
+                still_pending.append((name, path, stamp, future))
+                continue
+
+            image = bpy.data.images.get(name)
+            try:
+                seconds, checksum = future.result()
+            except Exception as error:
+                self._results.append((name, None, f"failed: {error}", None))
+                continue
+            reload_seconds = finish_layer_save(image, path, stamp, checksum) if image else None
+            if reload_seconds is not None:
+                self._results.append((name, seconds, "saved", reload_seconds))
             else:
-                # Check if the 'Color' output exists, else use 'Result' or another output
-                if 'Color' in previous_node.outputs:
-                    links.new(previous_node.outputs['Color'], mix_node.inputs['A'])  # Previous image's Color goes to A
-                elif 'Result' in previous_node.outputs:
-                    links.new(previous_node.outputs['Result'], mix_node.inputs['A'])  # Fallback to 'Result' if no 'Color'
-                elif 'RGBA' in previous_node.outputs:
-                    links.new(previous_node.outputs['RGBA'], mix_node.inputs['A'])  # Some nodes may have 'RGBA'
-                else:
-                    # If none of these outputs exist, raise an error
-                    self.report({'ERROR'}, f"No suitable output found on previous node: {previous_node.name}")
-                    return {'CANCELLED'}
+                self._results.append((name, seconds, "saved, but painted on since, still dirty", None))
+        self._pending = still_pending
+        self.submit()
 
+    def finish(self):
+        self._executor.shutdown(wait=False)
+        for name, seconds, status, reload_seconds in self._results:
+            timing = f" in {seconds:.2f}s" if seconds is not None else ""
+            if reload_seconds is not None:
+                timing += f", reloaded in {reload_seconds:.3f}s"
+            print(f"{name}: {status}{timing}")
+            self.report({'INFO'} if seconds is not None else {'WARNING'}, f"{name}: {status}{timing}")
 
-            # Connect new image's Color and Alpha to the new mix node
-            links.new(img_tex.outputs['Color'], mix_node.inputs['B'])  # New image's Color goes to B
-            links.new(img_tex.outputs['Alpha'], mix_node.inputs['Factor'])  # Alpha controls the mix factor
+        saved = sum(1 for name, seconds, status, reload_seconds in self._results if status == "saved")
+        self.report({'INFO'}, f"Saved {saved} of {len(self._results)} dirty layers")
 
-            # Update previous_node to the new mix node for the next iteration
-            previous_node = mix_node
+    def execute(self, context):
+        try:
+            self.start()
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
 
-            # Adjust positions for the next iteration
-            uv_y_offset -= 200
-            img_y_offset -= 200
-            mix_x_offset += 200
+        while self._pending:
+            self.collect(wait=True)
+        self.finish()
+        return {'FINISHED'}
 
-        # Final output connection to the Group Output node
-        links.new(previous_node.outputs['Result'], group_output_node.inputs['Result'])  # Connect final mix Result to Group Output
+    def invoke(self, context, event):
+        try:
+            count = self.start()
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
 
-        # Connect the group output to the Material Output's surface
-        material_output_node = None
-        for node in nodes:
-            if node.type == 'OUTPUT_MATERIAL':
-                material_output_node = node
-                break
+        if not count:
+            self.report({'INFO'}, "No dirty layers to save")
+            return {'CANCELLED'}
 
-        if not material_output_node:
-            material_output_node = nodes.new(type='ShaderNodeOutputMaterial')
-            material_output_node.location = (800, 0)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.05, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
 
-        # Connect the group output to the material output
-        links = material.node_tree.links
-        links.new(group_node.outputs['Result'], material_output_node.inputs['Surface'])
+    def modal(self, context, event):
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        self.collect()
+        if self._pending:
+            return {'RUNNING_MODAL'}
+
+        context.window_manager.event_timer_remove(self._timer)
+        self.finish()
+        return {'FINISHED'}
+
+
+class PhotoStackExportMemoryReport(bpy.types.Operator):
+    """Write the memory use of every PhotoStack in the file to a JSON report"""
+    bl_idname = "object.photostack_export_memory_report"
+    bl_label = "Export Memory Report"
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = bpy.path.ensure_ext(bpy.path.display_name_from_filepath(bpy.data.filepath) or "photostack", "_memory.json")
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        report = file_memory_report(load=False)
+        with open(bpy.path.abspath(self.filepath), "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+        self.report({'INFO'}, f"{len(report['stacks'])} stacks use {format_bytes(report['bytes'])}")
+        return {'FINISHED'}
+
+
+class PhotoStackOptimize(bpy.types.Operator):
+    """Delete the empty layers of the active PhotoStack and crop the ones with little paint"""
+    bl_idname = "object.photostack_optimize"
+    bl_label = "Optimize PhotoStack"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    remove_empty: bpy.props.BoolProperty(
+        name="Remove Empty Layers",
+        description="Delete layers without any paint, with their Mix nodes",
+        default=True
+    )
+    crop: bpy.props.BoolProperty(
+        name="Crop Layers",
+        description="Crop layers whose paint fits in a small part of the image",
+        default=True
+    )
 
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        try:
+            removed, cropped, saved_bytes, saved_nodes = optimize_stack(material, self.remove_empty, self.crop)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Removed {removed} empty layers, cropped {cropped}, "
+                              f"saved {format_bytes(saved_bytes)} and {saved_nodes} nodes")
+        return {'FINISHED'}
+
+
+class PhotoStackMakeProxies(bpy.types.Operator):
+    """Keep the full-resolution layers of the active PhotoStack on disk and paint on reduced proxies"""
+    bl_idname = "object.photostack_make_proxies"
+    bl_label = "Make Proxy Layers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    factor: bpy.props.EnumProperty(
+        name="Proxy Size",
+        items=[('2', "1/2", "Half resolution"), ('4', "1/4", "Quarter resolution"), ('8', "1/8", "Eighth resolution")],
+        default='4'
+    )
+    directory: bpy.props.StringProperty(
+        name="Directory",
+        description="Where the full-resolution masters are written",
+        default="//photostack_masters",
+        subtype='DIR_PATH'
+    )
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+        if self.directory.startswith("//") and not bpy.data.filepath:
+            self.report({'ERROR'}, "Save the .blend file first or choose an absolute directory")
+            return {'CANCELLED'}
+        os.makedirs(bpy.path.abspath(self.directory), exist_ok=True)
+
+        # Every layer, the base and sparse ones included, goes to the proxy size,
+        # so the flatten and preview still see one stack size. Layers loaded from
+        # a file get a separate RGBA proxy, so they may have any channel count.
+        images = {entry.image.name: entry.image for entry in layers
+                  if entry.image and (entry.image.channels == 4 or entry.image.source == 'FILE')
+                  and "photostack_proxy_master" not in entry.image}
+        saved = 0
+        try:
+            for image in images.values():
+                saved += make_proxy_layer(image, int(self.factor), self.directory)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Made {len(images)} proxy layers, freed {format_bytes(saved)}")
+        return {'FINISHED'}
+
+
+class PhotoStackConform(bpy.types.Operator):
+    """Apply the painting on the proxy layers of the active PhotoStack to their full-resolution masters"""
+    bl_idname = "object.photostack_conform"
+    bl_label = "Conform Proxy Layers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    restore: bpy.props.BoolProperty(
+        name="Restore Full Resolution",
+        description="Load the conformed masters back and stop using proxies",
+        default=False
+    )
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        images = {entry.image.name: entry.image for entry in layers
+                  if entry.image and "photostack_proxy_master" in entry.image}
+        start = time.perf_counter()
+        changed = 0
+        try:
+            for image in images.values():
+                changed += conform_proxy_layer(image, self.restore)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Conformed {len(images)} layers, {changed} bands changed in {time.perf_counter() - start:.1f}s")
+        return {'FINISHED'}
+
+
+class PhotoStackMergeDown(bpy.types.Operator):
+    """Merge the active PhotoStack layer into the layer below it"""
+    bl_idname = "object.photostack_merge_down"
+    bl_label = "Merge Down"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        index = material.photostack_layer_index if material else 0
+        try:
+            collapse_layers(material, [index - 1, index])
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
+class PhotoStackMergeVisible(bpy.types.Operator):
+    """Merge every visible layer of the active PhotoStack into its base image"""
+    bl_idname = "object.photostack_merge_visible"
+    bl_label = "Merge Visible"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        indices = [0] + [index for index, entry in enumerate(layers) if index and entry.visible]
+        try:
+            merged = collapse_layers(material, indices)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Merged {merged} layers into the base image")
+        return {'FINISHED'}
+
+
+class PhotoStackCollapseRange(bpy.types.Operator):
+    """Merge a range of PhotoStack layers into the lowest of them"""
+    bl_idname = "object.photostack_collapse_range"
+    bl_label = "Collapse Layers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    first: bpy.props.IntProperty(
+        name="First Layer",
+        description="Lowest layer of the range, 0 is the base image",
+        default=0,
+        min=0
+    )
+    last: bpy.props.IntProperty(
+        name="Last Layer",
+        description="Highest layer of the range, -1 for the active layer",
+        default=-1,
+        min=-1
+    )
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        last = self.last if self.last >= 0 or not material else material.photostack_layer_index
+        try:
+            merged = collapse_layers(material, list(range(self.first, last + 1)))
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, f"Collapsed {merged + 1} layers into one")
+        return {'FINISHED'}
+
+
+class PhotoStackRefreshLayers(bpy.types.Operator):
+    """Rebuild the layer registry of the active material from its PhotoStack"""
+    bl_idname = "object.photostack_refresh_layers"
+    bl_label = "Refresh PhotoStack Layers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup = get_photostack_group(material) if material and material.use_nodes else None
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        rebuild_layer_registry(material, nodegroup)
+        return {'FINISHED'}
+
+
+class PhotoStackMoveLayer(bpy.types.Operator):
+    """Move the active PhotoStack layer up or down the stack"""
+    bl_idname = "object.photostack_move_layer"
+    bl_label = "Move PhotoStack Layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    direction: bpy.props.EnumProperty(
+        name="Direction",
+        items=[('UP', "Up", "Move the layer above the next one"), ('DOWN', "Down", "Move the layer below the previous one")],
+        default='UP'
+    )
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        index = material.photostack_layer_index
+        other = index + 1 if self.direction == 'UP' else index - 1
+        # The base image stays at the bottom
+        if min(index, other) < 1 or max(index, other) >= len(layers):
+            return {'CANCELLED'}
+
+        if not swap_layers(material, min(index, other), max(index, other)):
+            self.report({'ERROR'}, "Layers no longer match the PhotoStack.")
+            return {'CANCELLED'}
+
+        material.photostack_layer_index = other
+        if CHAIN_TIP_KEY in nodegroup:
+            compile_stack(nodegroup)
         return {'FINISHED'}
 
 
+class PhotoStackDeleteLayer(bpy.types.Operator):
+    """Delete the active PhotoStack layer and its nodes"""
+    bl_idname = "object.photostack_delete_layer"
+    bl_label = "Delete PhotoStack Layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup, layers = get_layer_registry(material)
+        if not nodegroup:
+            self.report({'ERROR'}, "No PhotoStack found on the active object.")
+            return {'CANCELLED'}
+
+        index = material.photostack_layer_index
+        if index < 1 or index >= len(layers):
+            self.report({'ERROR'}, "The base image can't be deleted.")
+            return {'CANCELLED'}
+
+        if not delete_layer(material, index):
+            self.report({'ERROR'}, "Layer no longer matches the PhotoStack.")
+            return {'CANCELLED'}
+
+        if CHAIN_TIP_KEY in nodegroup:
+            compile_stack(nodegroup)
+        return {'FINISHED'}
+
+
+class PHOTOSTACK_UL_layers(bpy.types.UIList):
+    """Layers of the active material's PhotoStack, base image first"""
+
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align=True)
+        if item.mix_node:
+            row.prop(item, "visible", text="", emboss=False, icon='HIDE_OFF' if item.visible else 'HIDE_ON')
+        row.label(text=item.image.name if item.image else item.texture_node, icon='IMAGE_DATA')
+        row.label(text=item.blend_type.replace('_', ' ').title() if item.mix_node else "Base")
+
+
 class PhotoPaintPanel(bpy.types.Panel):
     """Creates a Panel in the 3D View's Tool Shelf"""
     bl_label = "PhotoStack Generator"
@@ -226,8 +2452,107 @@ class PhotoPaintPanel(bpy.types.Panel):
         # Number of textures input
         layout.prop(scene, "num_textures")
 
+        # UV map of each new layer
+        obj = context.object
+        if obj and obj.type == 'MESH':
+            for i, setting in enumerate(scene.texture_settings):
+                layout.prop_search(setting, "uv_map_name", obj.data, "uv_layers", text=f"Layer {i + 1} UV")
+        layout.prop(scene, "sparse_layers")
+        layout.prop(scene, "compile_stacks")
+
         # Add material button
         layout.operator("object.add_photostack", text="Generate/Extend Photostack")
+        layout.operator("object.photostack_shrink_layers")
+        layout.operator("object.photostack_optimize")
+        row = layout.row(align=True)
+        row.operator("object.photostack_compile", text="Compile")
+        row.operator("object.photostack_compile", text="Linearize").linearize = True
+        layout.operator("object.photostack_collapse_uv_nodes")
+        row = layout.row(align=True)
+        row.operator("object.photostack_pack_atlas", text="Pack Atlas")
+        row.operator("object.photostack_pack_atlas", text="Unpack").unpack = True
+        row = layout.row(align=True)
+        row.operator("object.photostack_save_exr", text="Save EXR")
+        row.operator("object.photostack_load_exr", text="Load EXR")
+        layout.operator("object.photostack_save_dirty_layers")
+        row = layout.row(align=True)
+        row.operator("object.photostack_make_proxies", text="Make Proxies")
+        row.operator("object.photostack_conform", text="Conform")
+        row.operator("object.photostack_conform", text="Restore").restore = True
+
+        # Layers from the material's registry
+        material = obj.active_material if obj else None
+        if material:
+            layout.label(text="Layers")
+            row = layout.row()
+            row.template_list("PHOTOSTACK_UL_layers", "", material, "photostack_layers", material, "photostack_layer_index", rows=4)
+            col = row.column(align=True)
+            col.operator("object.photostack_move_layer", text="", icon='TRIA_UP').direction = 'UP'
+            col.operator("object.photostack_move_layer", text="", icon='TRIA_DOWN').direction = 'DOWN'
+            col.operator("object.photostack_delete_layer", text="", icon='X')
+            col.operator("object.photostack_refresh_layers", text="", icon='FILE_REFRESH')
+            row = layout.row(align=True)
+            row.operator("object.photostack_merge_down")
+            row.operator("object.photostack_merge_visible")
+            row.operator("object.photostack_collapse_range")
+
+
+class PhotoStackRefreshMemoryReport(bpy.types.Operator):
+    """Measure the memory the PhotoStacks of the file use now, without loading any layer"""
+    bl_idname = "object.photostack_refresh_memory_report"
+    bl_label = "Refresh"
+
+    def execute(self, context):
+        global panel_memory_report
+        panel_memory_report = file_memory_report(load=False)
+        self.report({'INFO'}, f"{len(panel_memory_report['stacks'])} stacks use {format_bytes(panel_memory_report['bytes'])}")
+        return {'FINISHED'}
+
+
+# The report the Memory panel shows. It is only made by the Refresh operator:
+# the panel redraws constantly, and walking every stack each time would be too slow.
+panel_memory_report = None
+
+
+class PhotoStackMemoryPanel(bpy.types.Panel):
+    """Memory used by the layers of the active PhotoStack and of every stack in the file"""
+    bl_label = "Memory"
+    bl_idname = "VIEW3D_PT_photostack_memory"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Paint'
+    bl_parent_id = "VIEW3D_PT_simple_material"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw(self, context):
+        layout = self.layout
+        report = panel_memory_report
+        if report is None or report["file"] != bpy.data.filepath:
+            layout.operator("object.photostack_refresh_memory_report", text="Measure Memory")
+            return
+
+        obj = context.object
+        material = obj.active_material if obj else None
+        nodegroup = get_photostack_group(material) if material and material.use_nodes else None
+        stack = next((stack for stack in report["stacks"] if nodegroup and stack["group"] == nodegroup.name), None)
+
+        if stack:
+            col = layout.column(align=True)
+            for layer in stack["layers"]:
+                row = col.row(align=True)
+                row.label(text=layer["name"], icon='IMAGE_DATA')
+                if not layer["loaded"]:
+                    row.label(text="not loaded")
+                    continue
+                row.label(text=f"{layer['width']}x{layer['height']} {layer['channels']}ch {'float' if layer['float'] else 'byte'}")
+                flags = [flag for flag in ("dirty", "packed") if layer[flag]]
+                row.label(text=f"{format_bytes(layer['bytes'])} {', '.join(flags)}")
+            layout.label(text=f"Stack: {format_bytes(stack['bytes'])}")
+
+        layout.label(text=f"All stacks: {format_bytes(report['bytes'])}")
+        row = layout.row(align=True)
+        row.operator("object.photostack_refresh_memory_report")
+        row.operator("object.photostack_export_memory_report")
 
 
 def update_texture_settings(self, context):
@@ -248,15 +2573,56 @@ def update_texture_settings(self, context):
 
 
 def register():
+    photostack_ir.register("photostack4")
     bpy.utils.register_class(PhotoStackProperties)
+    bpy.utils.register_class(PhotoStackLayer)
     bpy.utils.register_class(PhotoStack)
+    bpy.utils.register_class(PhotoStackShrinkLayers)
+    bpy.utils.register_class(PhotoStackCompile)
+    bpy.utils.register_class(PhotoStackCollapseUVNodes)
+    bpy.utils.register_class(PhotoStackPackAtlas)
+    bpy.utils.register_class(PhotoStackSaveEXR)
+    bpy.utils.register_class(PhotoStackLoadEXR)
+    bpy.utils.register_class(PhotoStackSaveDirtyLayers)
+    bpy.utils.register_class(PhotoStackExportMemoryReport)
+    bpy.utils.register_class(PhotoStackRefreshMemoryReport)
+    bpy.utils.register_class(PhotoStackOptimize)
+    bpy.utils.register_class(PhotoStackMakeProxies)
+    bpy.utils.register_class(PhotoStackConform)
+    bpy.utils.register_class(PhotoStackMergeDown)
+    bpy.utils.register_class(PhotoStackMergeVisible)
+    bpy.utils.register_class(PhotoStackCollapseRange)
+    bpy.utils.register_class(PhotoStackRefreshLayers)
+    bpy.utils.register_class(PhotoStackMoveLayer)
+    bpy.utils.register_class(PhotoStackDeleteLayer)
+    bpy.utils.register_class(PHOTOSTACK_UL_layers)
     bpy.utils.register_class(PhotoPaintPanel)
+    bpy.utils.register_class(PhotoStackMemoryPanel)
+
+    # Per-material layer registry, kept in step with the node group by the stack operators
+    bpy.types.Material.photostack_layers = bpy.props.CollectionProperty(type=PhotoStackLayer)
+    bpy.types.Material.photostack_layer_index = bpy.props.IntProperty(name="Active Layer", default=0)
+    bpy.types.Material.photostack_group = bpy.props.PointerProperty(type=bpy.types.NodeTree)
+
+    bpy.types.Scene.sparse_layers = bpy.props.BoolProperty(
+        name="Sparse Layers",
+        default=False,
+        description="Start new layers as tiny placeholders that get full resolution when painted on"
+    )
+    bpy.types.Scene.compile_stacks = bpy.props.BoolProperty(
+        name="Compile Stacks",
+        default=False,
+        description="Drive the group output from a balanced tree of Mix nodes instead of the linear chain"
+    )
+    photostack_ir.add_handler(bpy.app.handlers.depsgraph_update_post, expand_sparse_paint_target)
+    photostack_ir.add_handler(bpy.app.handlers.depsgraph_update_post, count_image_edits)
 
     bpy.types.Scene.num_textures = bpy.props.IntProperty(
         name="Number of Textures",
         default=1,  # Set default to 1
         min=1,
-        max=10,
+        max=256,
+        soft_max=50,
         description="Number of image textures to add",
         update=update_texture_settings  # Ensure we update texture settings on change
     )
@@ -268,13 +2634,68 @@ def register():
 
 
 def unregister():
+    photostack_ir.unregister("photostack4")
     bpy.utils.unregister_class(PhotoStackProperties)
+    bpy.utils.unregister_class(PhotoStackLayer)
     bpy.utils.unregister_class(PhotoStack)
+    bpy.utils.unregister_class(PhotoStackShrinkLayers)
+    bpy.utils.unregister_class(PhotoStackCompile)
+    bpy.utils.unregister_class(PhotoStackCollapseUVNodes)
+    bpy.utils.unregister_class(PhotoStackPackAtlas)
+    bpy.utils.unregister_class(PhotoStackSaveEXR)
+    bpy.utils.unregister_class(PhotoStackLoadEXR)
+    bpy.utils.unregister_class(PhotoStackSaveDirtyLayers)
+    bpy.utils.unregister_class(PhotoStackExportMemoryReport)
+    bpy.utils.unregister_class(PhotoStackRefreshMemoryReport)
+    bpy.utils.unregister_class(PhotoStackOptimize)
+    bpy.utils.unregister_class(PhotoStackMakeProxies)
+    bpy.utils.unregister_class(PhotoStackConform)
+    bpy.utils.unregister_class(PhotoStackMergeDown)
+    bpy.utils.unregister_class(PhotoStackMergeVisible)
+    bpy.utils.unregister_class(PhotoStackCollapseRange)
+    bpy.utils.unregister_class(PhotoStackRefreshLayers)
+    bpy.utils.unregister_class(PhotoStackMoveLayer)
+    bpy.utils.unregister_class(PhotoStackDeleteLayer)
+    bpy.utils.unregister_class(PHOTOSTACK_UL_layers)
+    bpy.utils.unregister_class(PhotoStackMemoryPanel)
     bpy.utils.unregister_class(PhotoPaintPanel)
 
+    del bpy.types.Material.photostack_layers
+    del bpy.types.Material.photostack_layer_index
+    del bpy.types.Material.photostack_group
+
+    del bpy.types.Scene.sparse_layers
+    del bpy.types.Scene.compile_stacks
+    photostack_ir.remove_handler(bpy.app.handlers.depsgraph_update_post, expand_sparse_paint_target)
+    photostack_ir.remove_handler(bpy.app.handlers.depsgraph_update_post, count_image_edits)
+
     del bpy.types.Scene.num_textures
     del bpy.types.Scene.texture_settings
 
 
+def memory_report_main(argv):
+    """Entry point for: blender --background file.blend --python photostack4.py -- --memory-report FILE
+
+    Returns 1 when the stacks use more than --budget MiB, so a render farm can
+    refuse the job before it is submitted.
+    """
+    parser = argparse.ArgumentParser(prog="photostack4.py", description="Report the memory used by every PhotoStack in the open .blend file")
+    parser.add_argument("--memory-report", required=True, help="JSON file the report is written to")
+    parser.add_argument("--budget", type=float, help="Fail when all stacks together use more MiB than this")
+    args = parser.parse_args(argv)
+
+    report = file_memory_report()
+    if args.budget is not None:
+        report["budget"] = int(args.budget * 2 ** 20)
+    with open(args.memory_report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print(f"{len(report['stacks'])} stacks use {format_bytes(report['bytes'])}")
+    return 1 if args.budget is not None and report["bytes"] > report["budget"] else 0
+
+
 if __name__ == "__main__":
-    register()
+    if bpy.app.background and "--" in sys.argv:
+        sys.exit(memory_report_main(sys.argv[sys.argv.index("--") + 1:]))
+    else:
+        register()
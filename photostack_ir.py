@@ -0,0 +1,215 @@
+"""Ordered description of a PhotoStack group, shared by the scripts that read one.
+
+A PhotoStack is a chain of Mix nodes walked down from the Group Output, or from
+the recorded tip of a compiled stack, to the base image. build_stack_ir()
+walks it once and returns the layers bottom to top with what each consumer
+needs: image, blend mode, factor source and UV map. get_stack_ir() caches the
+result per node tree until the tree is edited, so the flattener, the compositor
+copier and any exporter analyse the graph once between them.
+"""
+
+from collections import namedtuple
+
+import bpy
+
+# One layer of a stack; the base layer has no mix_node and blends with nothing.
+# factor_source is 'ALPHA' when the layer's own alpha drives the Mix factor,
+# 'LINK' for any other linked factor and 'VALUE' for the unlinked factor value.
+StackLayer = namedtuple("StackLayer", [
+    "image_node", "image", "mix_node", "blend_type",
+    "factor_source", "factor", "factor_socket", "uv_map", "clamp", "visible",
+])
+
+# layers[0] is the base image, layers[-1] the top of the stack
+StackIR = namedtuple("StackIR", ["node_tree", "layers"])
+
+# Group property naming the top Mix node of the layer chain once the stack is compiled
+CHAIN_TIP_KEY = "photostack_chain_tip"
+
+# Node types a UV lookup can pass through on its way to the texture
+UV_PASSTHROUGH_TYPES = {'MAPPING', 'VECT_MATH'}
+
+_cache = {}
+
+# Scripts that registered the IR and have not unregistered it yet
+_clients = set()
+
+
+def get_socket(sockets, identifier):
+    """Find a socket by identifier. ShaderNodeMix reuses the names A, B and Result
+    for its float, vector and color sockets, so names alone pick the wrong one."""
+    for socket in sockets:
+        if socket.identifier == identifier:
+            return socket
+    return None
+
+
+def get_linked_socket(node, name):
+    """Return the socket feeding the first linked input called name (any A/B/Factor variant)."""
+    for socket in node.inputs:
+        if socket.name == name and socket.is_linked:
+            return socket.links[0].from_socket
+    return None
+
+
+def get_group_output(node_tree):
+    for node in node_tree.nodes:
+        if node.type == 'GROUP_OUTPUT':
+            return node
+    return None
+
+
+def get_stack_tip(node_tree):
+    """Return the top node of the layer chain.
+
+    A compiled stack keeps its linear chain as the source of truth, disconnected
+    from the Group Output, and records its top node on the group.
+    """
+    tip_node = node_tree.nodes.get(node_tree.get(CHAIN_TIP_KEY, ""))
+    if tip_node:
+        return tip_node
+
+    group_output_node = get_group_output(node_tree)
+    if group_output_node and group_output_node.inputs[0].is_linked:
+        return group_output_node.inputs[0].links[0].from_node
+    return None
+
+
+def find_uv_map(image_node):
+    """Name of the UV map an image texture reads, "" for the default one."""
+    vector_input = image_node.inputs.get('Vector')
+    while vector_input and vector_input.is_linked:
+        from_socket = vector_input.links[0].from_socket
+        node = from_socket.node
+        if node.type == 'UVMAP':
+            return node.uv_map
+        if node.type == 'GROUP_INPUT':
+            # PhotoStack UV inputs are named after their UV map, "UV" is the default
+            return "" if from_socket.name == "UV" else from_socket.name
+        if node.type not in UV_PASSTHROUGH_TYPES:
+            return ""
+        vector_input = node.inputs[0]
+    return ""
+
+
+def make_layer(image_node, mix_node):
+    image = image_node.image if image_node and image_node.type == 'TEX_IMAGE' else None
+    uv_map = find_uv_map(image_node) if image else ""
+    if mix_node is None:
+        return StackLayer(image_node, image, None, 'MIX', 'VALUE', 1.0, None, uv_map, False, True)
+
+    factor_socket = get_linked_socket(mix_node, 'Factor')
+    if factor_socket is None:
+        factor_source = 'VALUE'
+    elif factor_socket.node == image_node and factor_socket.name == 'Alpha':
+        factor_source = 'ALPHA'
+    else:
+        factor_source = 'LINK'
+    factor = get_socket(mix_node.inputs, 'Factor_Float').default_value
+
+    return StackLayer(image_node, image, mix_node, mix_node.blend_type, factor_source, factor,
+                      factor_socket, uv_map, mix_node.clamp_result, not mix_node.mute)
+
+
+def build_stack_ir(node_tree):
+    """Walk a PhotoStack group once and return its StackIR.
+
+    Layers whose B input is not an image texture keep that node as image_node
+    with image None, so each consumer decides whether it can use them.
+    """
+    node = get_stack_tip(node_tree)
+    if not node:
+        raise ValueError("Group output is not connected")
+
+    layers = []
+    while node.type == 'MIX':
+        color_socket = get_linked_socket(node, 'B')
+        layers.append(make_layer(color_socket.node if color_socket else None, node))
+
+        a_socket = get_linked_socket(node, 'A')
+        if not a_socket:
+            raise ValueError(f"Mix node {node.name} has nothing linked to A")
+        node = a_socket.node
+
+    layers.append(make_layer(node, None))
+    layers.reverse()
+    return StackIR(node_tree, layers)
+
+
+def get_stack_ir(node_tree):
+    """Return the cached StackIR of node_tree, building it when missing or stale.
+
+    Edits invalidate the cache through a depsgraph handler. The node and link
+    counts are checked too, for edits made by a script since the last update.
+    A script that relinks layers without changing those counts, like a swap,
+    or only changes settings such as a blend mode, must call
+    invalidate_stack_ir() before the stack is read again.
+    """
+    signature = (len(node_tree.nodes), len(node_tree.links))
+    cached = _cache.get(node_tree.session_uid)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    stack_ir = build_stack_ir(node_tree)
+    _cache[node_tree.session_uid] = (signature, stack_ir)
+    return stack_ir
+
+
+def invalidate_stack_ir(node_tree=None):
+    """Forget the StackIR of node_tree, or of every tree."""
+    if node_tree is None:
+        _cache.clear()
+    else:
+        _cache.pop(node_tree.session_uid, None)
+
+
+@bpy.app.handlers.persistent
+def invalidate_edited_stacks(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.NodeTree):
+            _cache.pop(update.id.session_uid, None)
+
+
+@bpy.app.handlers.persistent
+def invalidate_all_stacks(*args):
+    _cache.clear()
+
+
+def add_handler(handlers, function):
+    """Append a handler once, dropping the copy an earlier run of a script left behind.
+
+    Running a script again in the Text Editor, or reloading this module, makes
+    new function objects, so a plain membership test would let the old handler
+    keep firing.
+    """
+    remove_handler(handlers, function)
+    handlers.append(function)
+
+
+def remove_handler(handlers, function):
+    """Remove every handler named like function, including stale copies."""
+    for handler in [handler for handler in handlers if getattr(handler, "__name__", None) == function.__name__]:
+        handlers.remove(handler)
+
+
+def register(client):
+    """Install the invalidation handlers for the script called client.
+
+    Every script using the IR registers under its own name, and the handlers
+    stay until the last of them unregisters. A name rather than a count, so
+    running a script again without unregistering it first isn't counted twice.
+    """
+    _clients.add(client)
+    add_handler(bpy.app.handlers.depsgraph_update_post, invalidate_edited_stacks)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        add_handler(handlers, invalidate_all_stacks)
+
+
+def unregister(client):
+    _clients.discard(client)
+    if _clients:
+        return
+    remove_handler(bpy.app.handlers.depsgraph_update_post, invalidate_edited_stacks)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        remove_handler(handlers, invalidate_all_stacks)
+    _cache.clear()
@@ -0,0 +1,343 @@
+"""Pixel math of the PhotoStack scripts that needs no Blender.
+
+Crops of sparse layers, tile bookkeeping of incremental flattens, working
+precisions, PNG encoding, proxy reduction and conforming and the premultiplied
+merge all work on NumPy arrays of (height, width, channels) pixels, bottom row
+first as Blender stores them. Like blend_kernels.py this module has no bpy
+dependency, so it can be imported by any of the image scripts, or from a
+plain Python shell and the tests.
+"""
+
+import hashlib
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from blend_kernels import blend_rgba, linear_to_srgb, srgb_to_linear
+
+# Working precisions of the flatten accumulator
+PRECISION_DTYPES = {
+    'FLOAT32': np.float32,
+    'FLOAT16': np.float16,
+    'UINT8': np.uint8,
+}
+
+# Rows blended per band when streaming a whole stack
+FLATTEN_BAND_ROWS = 256
+
+# Edge length in pixels of the tiles tracked for incremental re-flattens
+FLATTEN_TILE_SIZE = 256
+
+# PNG color type of each channel count: gray, gray and alpha, RGB, RGBA
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+def run_job(job):
+    """Drive a flatten generator to the end and return its result."""
+    try:
+        while True:
+            next(job)
+    except StopIteration as done:
+        return done.value
+
+def scale_progress(job, start, end):
+    """Re-yield the progress of a sub job mapped into [start, end], returning its result."""
+    while True:
+        try:
+            progress = next(job)
+        except StopIteration as done:
+            return done.value
+        yield start + (end - start) * progress
+
+def decode_pixels(stored, precision, out=None, scratch=None):
+    """Return stored pixels as linear float32, a view when already float32.
+
+    Pass out, and for 8 bits a scratch array shaped like out[..., :3], to
+    decode without allocating.
+    """
+    if precision == 'FLOAT32':
+        return stored
+    if out is None:
+        out = np.empty(stored.shape, dtype=np.float32)
+    np.copyto(out, stored)
+    if precision == 'UINT8':
+        out /= 255.0
+        srgb_to_linear(out[..., :3], out[..., :3], scratch)
+    return out
+
+def encode_pixels(pixels, precision, out, scratch=None):
+    """Store linear float32 pixels into out at the given precision.
+
+    Encoding to 8 bits works in place and leaves pixels overwritten.
+    """
+    if precision != 'UINT8':
+        out[...] = pixels
+        return
+
+    np.clip(pixels, 0.0, 1.0, out=pixels)
+    linear_to_srgb(pixels[..., :3], pixels[..., :3], scratch)
+    pixels *= 255.0
+    np.rint(pixels, out=pixels)
+    out[...] = pixels
+
+class BandScratch(threading.local):
+    """Float32 work arrays each thread reuses for every band it blends."""
+
+    def get(self, name, shape):
+        size = int(np.prod(shape))
+        array = getattr(self, name, None)
+        if array is None or array.size < size:
+            array = np.empty(size, dtype=np.float32)
+            setattr(self, name, array)
+        return array[:size].reshape(shape)
+
+def get_mix_factor(layer, layer_pixels):
+    """The factor of a StackLayer: its alpha when that drives the Mix node, else the factor value."""
+    if layer.factor_source == 'ALPHA':
+        return layer_pixels[..., 3]
+    return layer.factor
+
+def blend_layer_into(result, layer_pixels, kernel, factor, clamp=False, band_rows=FLATTEN_BAND_ROWS, executor=None, precision='FLOAT32', scratch=None):
+    """Blend one layer into result in place, one row band at a time.
+
+    With an executor the bands are blended on its worker threads. NumPy releases
+    the GIL inside its array loops and every band writes to its own rows of the
+    shared result, so no pixels are copied or pickled between workers. A result
+    stored below float32 is decoded and re-encoded one band at a time, into the
+    BandScratch arrays of the thread doing the band.
+    """
+    if scratch is None:
+        scratch = BandScratch()
+
+    def blend_band(row):
+        rows = slice(row, row + band_rows)
+        stored = result[rows]
+        if precision == 'FLOAT32':
+            band = stored
+        else:
+            curve = scratch.get("curve", stored.shape[:-1] + (3,))
+            band = decode_pixels(stored, precision, scratch.get("band", stored.shape), curve)
+        fac = factor[rows, :, np.newaxis] if isinstance(factor, np.ndarray) else factor
+        band[..., :3] = kernel(band[..., :3], layer_pixels[rows, :, :3], fac)
+        if clamp:
+            np.clip(band[..., :3], 0.0, 1.0, out=band[..., :3])
+        if precision != 'FLOAT32':
+            encode_pixels(band, precision, stored, curve)
+
+    rows = range(0, result.shape[0], band_rows)
+    if executor is None:
+        for row in rows:
+            blend_band(row)
+    else:
+        list(executor.map(blend_band, rows))
+
+def tile_checksums(pixels, tile_size=FLATTEN_TILE_SIZE):
+    """Position-weighted 64-bit checksum of every tile_size square of pixels."""
+    return run_job(iter_tile_checksums(pixels, tile_size))
+
+def iter_tile_checksums(pixels, tile_size=FLATTEN_TILE_SIZE):
+    """tile_checksums() as a job, yielding the fraction done after each row of tiles."""
+    height, width, channels = pixels.shape
+    words = pixels.view(np.uint32)
+    col_weights = (np.arange(width * channels, dtype=np.uint64) * np.uint64(2654435761) + np.uint64(1)).reshape(width, channels)
+    row_weights = np.arange(tile_size, dtype=np.uint64) * np.uint64(40503) + np.uint64(1)
+    col_starts = np.arange(0, width, tile_size)
+
+    rows = []
+    for row in range(0, height, tile_size):
+        band = words[row:row + tile_size].astype(np.uint64)
+        band *= col_weights
+        band *= row_weights[:band.shape[0], np.newaxis, np.newaxis]
+        rows.append(np.add.reduceat(band.sum(axis=(0, 2)), col_starts))
+        yield min(row + tile_size, height) / height
+    return np.array(rows)
+
+def cut_tiles(pixels, tile_indices, tile_size=FLATTEN_TILE_SIZE):
+    """Copies of the tiles of pixels at (row, column) tile_indices, keyed by their (y, x) corner."""
+    return {(ty * tile_size, tx * tile_size): pixels[ty * tile_size:(ty + 1) * tile_size, tx * tile_size:(tx + 1) * tile_size].copy()
+            for ty, tx in tile_indices}
+
+def iter_reflatten_dirty_tiles(result, layers, tiles, precision='FLOAT32'):
+    """Re-blend the dirty tiles of a stack, patching result in place.
+
+    tiles[0] holds the base image tiles and tiles[1:] those of each layer.
+    Between layers a tile is stored at the working precision, as the full
+    flatten stores its bands, so both paths give the same pixels. Yields the
+    fraction done after each tile.
+    """
+    for count, ((y, x), base) in enumerate(tiles[0].items(), 1):
+        stored = np.empty(base.shape, dtype=PRECISION_DTYPES[precision])
+        encode_pixels(base.copy(), precision, stored)
+        for layer, layer_tiles in zip(layers, tiles[1:]):
+            layer_pixels = layer_tiles[y, x]
+            factor = get_mix_factor(layer, layer_pixels)
+            tile = blend_rgba(layer.blend_type, decode_pixels(stored, precision), layer_pixels, factor, clamp=layer.clamp)
+            encode_pixels(tile, precision, stored)
+        result[y:y + base.shape[0], x:x + base.shape[1]] = decode_pixels(stored, precision)
+        yield count / len(tiles[0])
+
+def reflatten_dirty_tiles(result, layers, tiles, precision='FLOAT32'):
+    run_job(iter_reflatten_dirty_tiles(result, layers, tiles, precision))
+
+def paint_bounds(pixels):
+    """(x0, y0, x1, y1) bounding box of the pixels with any alpha, or None when nothing is painted."""
+    painted = pixels[..., 3] > 0.0
+    rows = np.flatnonzero(painted.any(axis=1))
+    cols = np.flatnonzero(painted.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def place_crop(crop, offset, size, out=None):
+    """Put a crop stored at (x, y) offset back on a transparent canvas of (width, height) size."""
+    width, height = size
+    if out is None:
+        out = np.zeros((height, width, crop.shape[2]), dtype=np.float32)
+    else:
+        out[...] = 0.0
+    x, y = offset
+    out[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+    return out
+
+def painted_tiles(alpha, tile_size):
+    """Boolean (rows, columns) map of the tiles of an alpha channel holding any paint."""
+    height, width = alpha.shape
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    padded = np.zeros((rows * tile_size, columns * tile_size), dtype=bool)
+    padded[:height, :width] = alpha > 0.0
+    return padded.reshape(rows, tile_size, columns, tile_size).any(axis=(1, 3))
+
+def pack_rectangles(sizes, padding):
+    """Shelf-pack (width, height) rectangles, tallest first, padding pixels around each.
+
+    Returns the lower left corner of every rectangle and the atlas size.
+    """
+    padded = [(width + 2 * padding, height + 2 * padding) for width, height in sizes]
+    atlas_width = max(max(width for width, height in padded),
+                      int(np.ceil(np.sqrt(sum(width * height for width, height in padded)))))
+
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -padded[i][1]):
+        width, height = padded[i]
+        if x + width > atlas_width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        positions[i] = (x + padding, y + padding)
+        x += width
+        shelf_height = max(shelf_height, height)
+
+    return positions, (atlas_width, y + shelf_height)
+
+def encode_png(pixels):
+    """Encode (height, width, channels) pixels in [0, 1], bottom row first as Blender
+    stores them, to 8-bit PNG bytes of the matching color type.
+
+    Rows use the Sub filter, computed with NumPy. zlib releases the GIL while it
+    compresses, so layers encode in parallel on a thread pool.
+    """
+    height, width, channels = pixels.shape
+    rows = np.round(np.clip(pixels[::-1], 0.0, 1.0) * 255.0).astype(np.uint8).reshape(height, width * channels)
+
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    filtered[:, 0] = 1
+    filtered[:, 1:channels + 1] = rows[:, :channels]
+    np.subtract(rows[:, channels:], rows[:, :-channels], out=filtered[:, channels + 1:])
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(filtered.tobytes(), 6))
+            + chunk(b"IEND", b""))
+
+def pixels_checksum(pixels):
+    return hashlib.blake2b(np.ascontiguousarray(pixels), digest_size=16).digest()
+
+def reduce_crop_pixels(stored, offset, size, factor):
+    """Box-reduce a crop stored at (x, y) offset to 1/factor of its (width, height) canvas size.
+
+    The crop is aligned to the reduction grid first, so the result matches
+    reducing the full canvas. Colors are averaged premultiplied so transparent
+    pixels do not darken painted edges.
+    """
+    full_width, full_height = size
+    reduced = np.zeros((-(-full_height // factor), -(-full_width // factor), 4), dtype=np.float32)
+    x, y = offset
+    height, width = stored.shape[:2]
+    pad_x, pad_y = x % factor, y % factor
+    aligned = np.zeros((-(-(pad_y + height) // factor) * factor, -(-(pad_x + width) // factor) * factor, 4), dtype=np.float32)
+    aligned[pad_y:pad_y + height, pad_x:pad_x + width] = stored
+    aligned[..., :3] *= aligned[..., 3:]
+
+    blocks = aligned.reshape(aligned.shape[0] // factor, factor, aligned.shape[1] // factor, factor, 4).mean(axis=(1, 3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        blocks[..., :3] = np.where(blocks[..., 3:] > 0.0, blocks[..., :3] / blocks[..., 3:], 0.0)
+
+    top, left = y // factor, x // factor
+    rows = min(blocks.shape[0], reduced.shape[0] - top)
+    columns = min(blocks.shape[1], reduced.shape[1] - left)
+    reduced[top:top + rows, left:left + columns] = blocks[:rows, :columns]
+    return reduced
+
+def reduce_proxy_pixels(pixels, factor):
+    """Box-reduce (height, width, 4) pixels by factor, repeating the edge where the size doesn't divide."""
+    height, width = pixels.shape[:2]
+    proxy_height, proxy_width = -(-height // factor), -(-width // factor)
+    padded = np.pad(pixels, ((0, proxy_height * factor - height), (0, proxy_width * factor - width), (0, 0)), mode='edge')
+    return padded.reshape(proxy_height, factor, proxy_width, factor, 4).mean(axis=(1, 3), dtype=np.float32)
+
+def upsample_proxy_rows(proxy, factor, bottom, top, width):
+    """Bilinearly upsample (height, width, 4) proxy pixels to master rows bottom to top.
+
+    Pixel centers are aligned, and the proxy edge is repeated past its border.
+    """
+    proxy_height, proxy_width = proxy.shape[:2]
+
+    def taps(start, stop, size):
+        position = (np.arange(start, stop) + 0.5) / factor - 0.5
+        lower = np.floor(position).astype(np.intp)
+        weight = (position - lower).astype(np.float32)
+        return np.clip(lower, 0, size - 1), np.clip(lower + 1, 0, size - 1), weight
+
+    y0, y1, wy = taps(bottom, top, proxy_height)
+    x0, x1, wx = taps(0, width, proxy_width)
+    rows = proxy[y0] * (1.0 - wy)[:, None, None] + proxy[y1] * wy[:, None, None]
+    return rows[:, x0] * (1.0 - wx)[None, :, None] + rows[:, x1] * wx[None, :, None]
+
+def conform_proxy_band(band, delta, factor, bottom, clip=False):
+    """Add what painting changed on a proxy, delta, to master rows bottom up of band in place.
+
+    Bands no painted proxy pixel reaches are left alone, bit for bit. clip
+    keeps a byte layer in [0, 1]. Returns whether band was changed.
+    """
+    top = bottom + band.shape[0]
+    # The bilinear taps reach one proxy row past the band
+    if not delta[max(bottom // factor - 1, 0):-(-top // factor) + 1].any():
+        return False
+    band += upsample_proxy_rows(delta, factor, bottom, top, band.shape[1])
+    if clip:
+        np.clip(band, 0.0, 1.0, out=band)
+    return True
+
+def merge_over(pixels, alpha, layers):
+    """Composite (pixels, factor) MIX layers 'over' pixels whose coverage is alpha.
+
+    Colors are accumulated premultiplied, so the merged layer shows through
+    its alpha as the stacked layers did through their factors. Returns the
+    straight-alpha (height, width, 4) result.
+    """
+    alpha = alpha.copy()
+    color = pixels[..., :3] * alpha[..., np.newaxis]
+    for layer_pixels, factor in layers:
+        color *= (1.0 - factor)[..., np.newaxis]
+        color += layer_pixels[..., :3] * factor[..., np.newaxis]
+        alpha *= 1.0 - factor
+        alpha += factor
+
+    result = np.empty(pixels.shape[:2] + (4,), dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result[..., :3] = np.where(alpha[..., np.newaxis] > 0.0, color / alpha[..., np.newaxis], 0.0)
+    result[..., 3] = alpha
+    return result
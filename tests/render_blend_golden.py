@@ -0,0 +1,144 @@
+"""Render the reference arrays of test_blend_kernels.py with Blender's Mix node.
+
+Needs Blender 5.0 or later, whose compositor uses the shader Mix node:
+
+    blender --background --factory-startup --python tests/render_blend_golden.py
+
+Every blend mode is rendered four times: with a per-pixel factor, with the
+factor scaled by the layer alpha (use_alpha), with clamp_result and with an
+unlinked factor value. The inputs and results are written to
+golden/blend_kernels.npz next to this script.
+"""
+
+import os
+import sys
+import tempfile
+
+import bpy
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+
+from blend_kernels import BLEND_KERNELS
+
+GOLDEN_PATH = os.path.join(script_dir, "golden", "blend_kernels.npz")
+
+# Unlinked factor of the 'value' renders
+FACTOR_VALUE = 0.37
+
+def make_inputs(width=16, height=8):
+    """Base, layer and factor arrays covering 0, 1, 0.5, mid tones and values above 1."""
+    rng = np.random.default_rng(4)
+    a = rng.random((height, width, 4), dtype=np.float32)
+    b = rng.random((height, width, 4), dtype=np.float32)
+    fac = rng.random((height, width), dtype=np.float32)
+
+    a[:, 0, :3], b[:, 1, :3] = 0.0, 0.0
+    a[:, 2, :3], b[:, 3, :3] = 1.0, 1.0
+    a[:, 4, :3], b[:, 4, :3] = 0.5, 0.5
+    a[:, 5, :3] = b[:, 5, :3]
+    # Grays, for the HSV modes
+    a[:, 6, :3] = a[:, 6, :1]
+    b[:, 7, :3] = b[:, 7, :1]
+    fac[0], fac[1] = 0.0, 1.0
+    # A row of HDR colors
+    a[-1, :, :3] += 1.0
+    b[-2, :, :3] += 1.0
+    return a, b, fac
+
+def get_socket(sockets, identifier):
+    for socket in sockets:
+        if socket.identifier == identifier:
+            return socket
+    return None
+
+def new_image(name, pixels):
+    height, width = pixels.shape[:2]
+    image = bpy.data.images.new(name, width=width, height=height, alpha=True, float_buffer=True)
+    image.pixels.foreach_set(pixels.ravel())
+    return image
+
+def render_mix(scene, blend_mode, factor, use_alpha=False, clamp=False):
+    """Render one Mix node setup through the compositor and return its pixels."""
+    tree = scene.compositing_node_group
+    mix_node = tree.nodes["Mix"]
+    mix_node.blend_type = blend_mode
+    mix_node.clamp_result = clamp
+
+    factor_input = get_socket(mix_node.inputs, 'Factor_Float')
+    for link in list(factor_input.links):
+        tree.links.remove(link)
+    if factor == 'VALUE':
+        factor_input.default_value = FACTOR_VALUE
+    elif use_alpha:
+        tree.links.new(tree.nodes["Use Alpha"].outputs[0], factor_input)
+    else:
+        tree.links.new(tree.nodes["Factor"].outputs['Alpha'], factor_input)
+
+    bpy.ops.render.render(write_still=True, scene=scene.name)
+    result = bpy.data.images.load(scene.render.filepath)
+    width, height = result.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    result.pixels.foreach_get(pixels)
+    bpy.data.images.remove(result)
+    return pixels.reshape(height, width, 4)
+
+def build_scene(a, b, fac):
+    height, width = a.shape[:2]
+    scene = bpy.context.scene
+    scene.render.resolution_x = width
+    scene.render.resolution_y = height
+    scene.render.resolution_percentage = 100
+    scene.render.image_settings.file_format = 'OPEN_EXR'
+    scene.render.image_settings.color_depth = '32'
+    scene.render.filepath = os.path.join(tempfile.gettempdir(), "blend_golden.exr")
+    scene.view_settings.view_transform = 'Standard'
+    scene.view_settings.look = 'None'
+
+    tree = bpy.data.node_groups.new("Blend Golden", 'CompositorNodeTree')
+    tree.interface.new_socket("Image", in_out='OUTPUT', socket_type='NodeSocketColor')
+    scene.compositing_node_group = tree
+
+    factor_pixels = np.zeros(a.shape, dtype=np.float32)
+    factor_pixels[..., 3] = fac
+    nodes = {}
+    for name, pixels in (("Base", a), ("Layer", b), ("Factor", factor_pixels)):
+        nodes[name] = tree.nodes.new('CompositorNodeImage')
+        nodes[name].name = name
+        nodes[name].image = new_image(name, pixels)
+
+    use_alpha = tree.nodes.new('ShaderNodeMath')
+    use_alpha.name = "Use Alpha"
+    use_alpha.operation = 'MULTIPLY'
+    tree.links.new(nodes["Factor"].outputs['Alpha'], use_alpha.inputs[0])
+    tree.links.new(nodes["Layer"].outputs['Alpha'], use_alpha.inputs[1])
+
+    mix_node = tree.nodes.new('ShaderNodeMix')
+    mix_node.name = "Mix"
+    mix_node.data_type = 'RGBA'
+    output_node = tree.nodes.new('NodeGroupOutput')
+    tree.links.new(nodes["Base"].outputs['Image'], get_socket(mix_node.inputs, 'A_Color'))
+    tree.links.new(nodes["Layer"].outputs['Image'], get_socket(mix_node.inputs, 'B_Color'))
+    tree.links.new(get_socket(mix_node.outputs, 'Result_Color'), output_node.inputs[0])
+    return scene
+
+def main():
+    a, b, fac = make_inputs()
+    scene = build_scene(a, b, fac)
+
+    arrays = {"a": a, "b": b, "fac": fac, "factor_value": np.float32(FACTOR_VALUE)}
+    for blend_mode in BLEND_KERNELS:
+        arrays[blend_mode] = render_mix(scene, blend_mode, 'IMAGE')
+        arrays[f"{blend_mode}_use_alpha"] = render_mix(scene, blend_mode, 'IMAGE', use_alpha=True)
+        arrays[f"{blend_mode}_clamp"] = render_mix(scene, blend_mode, 'IMAGE', clamp=True)
+        arrays[f"{blend_mode}_value"] = render_mix(scene, blend_mode, 'VALUE')
+        print(f"Rendered {blend_mode}")
+
+    os.makedirs(os.path.dirname(GOLDEN_PATH), exist_ok=True)
+    np.savez_compressed(GOLDEN_PATH, **arrays)
+    print(f"Wrote {len(arrays)} arrays to {GOLDEN_PATH}")
+
+
+if __name__ == "__main__":
+    main()
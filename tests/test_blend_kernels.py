@@ -0,0 +1,69 @@
+"""Check every blend kernel against golden arrays rendered by Blender's Mix node.
+
+Regenerate golden/blend_kernels.npz with render_blend_golden.py.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from blend_kernels import BLEND_KERNELS, blend_rgba, linear_to_srgb, srgb_to_linear
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "blend_kernels.npz")
+
+# Blender evaluates in float32 too, the HSV modes round a little differently
+TOLERANCE = 1e-5
+
+@pytest.fixture(scope="module")
+def golden():
+    with np.load(GOLDEN_PATH) as arrays:
+        return dict(arrays)
+
+def test_golden_covers_every_kernel(golden):
+    assert len(BLEND_KERNELS) == 19
+    for blend_mode in BLEND_KERNELS:
+        assert blend_mode in golden
+
+@pytest.mark.parametrize("blend_mode", list(BLEND_KERNELS))
+def test_kernel_matches_mix_node(golden, blend_mode):
+    a, b, fac = golden["a"], golden["b"], golden["fac"]
+    result = BLEND_KERNELS[blend_mode](a[..., :3], b[..., :3], fac[..., np.newaxis])
+    np.testing.assert_allclose(result, golden[blend_mode][..., :3], rtol=TOLERANCE, atol=TOLERANCE)
+
+@pytest.mark.parametrize("blend_mode", list(BLEND_KERNELS))
+def test_blend_rgba_matches_mix_node(golden, blend_mode):
+    a, b, fac = golden["a"], golden["b"], golden["fac"]
+    result = blend_rgba(blend_mode, a, b, fac)
+    np.testing.assert_allclose(result, golden[blend_mode], rtol=TOLERANCE, atol=TOLERANCE)
+    # The base alpha passes through untouched
+    np.testing.assert_array_equal(result[..., 3], a[..., 3])
+
+@pytest.mark.parametrize("blend_mode", list(BLEND_KERNELS))
+def test_blend_rgba_use_alpha(golden, blend_mode):
+    result = blend_rgba(blend_mode, golden["a"], golden["b"], golden["fac"], use_alpha=True)
+    np.testing.assert_allclose(result, golden[f"{blend_mode}_use_alpha"], rtol=TOLERANCE, atol=TOLERANCE)
+
+@pytest.mark.parametrize("blend_mode", list(BLEND_KERNELS))
+def test_blend_rgba_clamp(golden, blend_mode):
+    result = blend_rgba(blend_mode, golden["a"], golden["b"], golden["fac"], clamp=True)
+    np.testing.assert_allclose(result, golden[f"{blend_mode}_clamp"], rtol=TOLERANCE, atol=TOLERANCE)
+    assert result[..., :3].min() >= 0.0 and result[..., :3].max() <= 1.0
+
+@pytest.mark.parametrize("blend_mode", list(BLEND_KERNELS))
+def test_blend_rgba_factor_value(golden, blend_mode):
+    result = blend_rgba(blend_mode, golden["a"], golden["b"], float(golden["factor_value"]))
+    np.testing.assert_allclose(result, golden[f"{blend_mode}_value"], rtol=TOLERANCE, atol=TOLERANCE)
+
+def test_srgb_round_trip():
+    values = np.linspace(0.0, 1.0, 1001, dtype=np.float32)
+    np.testing.assert_allclose(srgb_to_linear(linear_to_srgb(values)), values, atol=1e-6)
+    assert linear_to_srgb(np.array([-0.5], dtype=np.float32))[0] == 0.0
+
+def test_srgb_in_place_matches_copy():
+    values = np.random.default_rng(0).random((16, 16, 3), dtype=np.float32)
+    for convert in (srgb_to_linear, linear_to_srgb):
+        expected = convert(values)
+        in_place = values.copy()
+        convert(in_place, in_place, np.empty_like(in_place))
+        np.testing.assert_array_equal(in_place, expected)
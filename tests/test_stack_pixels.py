@@ -0,0 +1,156 @@
+"""Check the bpy-free pixel helpers the PhotoStack scripts share."""
+
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from blend_kernels import BLEND_KERNELS
+from stack_pixels import (PRECISION_DTYPES, blend_layer_into, conform_proxy_band, cut_tiles, decode_pixels,
+                          encode_png, encode_pixels, merge_over, pack_rectangles, paint_bounds, painted_tiles,
+                          place_crop, reduce_crop_pixels, reduce_proxy_pixels, reflatten_dirty_tiles, tile_checksums)
+
+# Just the StackLayer fields the flatten reads
+Layer = namedtuple("Layer", ["blend_type", "factor_source", "factor", "clamp"])
+
+def random_layer(rng, height, width, painted=(slice(None), slice(None))):
+    pixels = np.zeros((height, width, 4), dtype=np.float32)
+    block = pixels[painted]
+    block[...] = rng.random(block.shape, dtype=np.float32)
+    return pixels
+
+def decode_png(data):
+    """Minimal decoder for what encode_png() writes: 8 bits, one IDAT, Sub filtered rows."""
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = {}
+    position = 8
+    while position < len(data):
+        length, tag = struct.unpack(">I4s", data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        assert struct.unpack(">I", data[position + 8 + length:position + 12 + length])[0] == zlib.crc32(tag + body)
+        chunks[tag] = body
+        position += 12 + length
+
+    width, height, depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+    assert depth == 8
+    channels = {0: 1, 4: 2, 2: 3, 6: 4}[color_type]
+    rows = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(height, width * channels + 1)
+    assert (rows[:, 0] == 1).all()
+    # Undo Sub: every byte adds the one a pixel to its left, mod 256
+    pixels = np.cumsum(rows[:, 1:].reshape(height, width, channels), axis=1, dtype=np.uint8)
+    return pixels[::-1]
+
+@pytest.mark.parametrize("channels", [1, 2, 3, 4])
+def test_png_decodes_to_the_encoded_bytes(channels):
+    rng = np.random.default_rng(channels)
+    pixels = rng.random((13, 17, channels), dtype=np.float32)
+    decoded = decode_png(encode_png(pixels))
+    np.testing.assert_array_equal(decoded, np.round(pixels * 255.0).astype(np.uint8))
+
+def test_crop_and_place_round_trip():
+    rng = np.random.default_rng(0)
+    canvas = random_layer(rng, 48, 64, (slice(7, 30), slice(11, 40)))
+    x0, y0, x1, y1 = paint_bounds(canvas)
+    assert (x0, y0, x1, y1) == (11, 7, 40, 30)
+    crop = canvas[y0:y1, x0:x1]
+    np.testing.assert_array_equal(place_crop(crop, (x0, y0), (64, 48)), canvas)
+
+def test_nothing_painted_has_no_bounds():
+    assert paint_bounds(np.zeros((8, 8, 4), dtype=np.float32)) is None
+
+def test_reduced_crop_matches_reduced_canvas():
+    rng = np.random.default_rng(1)
+    canvas = random_layer(rng, 50, 70, (slice(9, 33), slice(13, 58)))
+    x0, y0, x1, y1 = paint_bounds(canvas)
+    full = reduce_crop_pixels(canvas, (0, 0), (70, 50), 4)
+    cropped = reduce_crop_pixels(canvas[y0:y1, x0:x1], (x0, y0), (70, 50), 4)
+    np.testing.assert_allclose(cropped, full, atol=1e-6)
+
+def test_painted_tiles():
+    alpha = np.zeros((100, 130), dtype=np.float32)
+    alpha[70, 5] = 0.5
+    tiles = painted_tiles(alpha, 64)
+    assert tiles.shape == (2, 3)
+    assert tiles.sum() == 1 and tiles[1, 0]
+
+def test_packed_rectangles_do_not_overlap():
+    rng = np.random.default_rng(2)
+    sizes = [tuple(size) for size in rng.integers(1, 60, size=(40, 2))]
+    padding = 1
+    positions, (atlas_width, atlas_height) = pack_rectangles(sizes, padding)
+    covered = np.zeros((atlas_height, atlas_width), dtype=np.int32)
+    for (x, y), (width, height) in zip(positions, sizes):
+        assert x >= padding and y >= padding
+        covered[y - padding:y + height + padding, x - padding:x + width + padding] += 1
+        assert x + width + padding <= atlas_width and y + height + padding <= atlas_height
+    assert covered.max() == 1
+
+def test_proxy_conform_leaves_unpainted_pixels_identical():
+    rng = np.random.default_rng(3)
+    factor, height, width, band_rows = 4, 96, 80, 8
+    master = rng.random((height, width, 4), dtype=np.float32)
+    baseline = reduce_proxy_pixels(master, factor)
+    proxy = baseline.copy()
+    proxy[5:8, 4:9] = (1.0, 0.0, 0.0, 1.0)
+
+    conformed = master.copy()
+    delta = proxy - baseline
+    changed = 0
+    for bottom in range(0, height, band_rows * factor):
+        band = conformed[bottom:bottom + band_rows * factor]
+        changed += conform_proxy_band(band, delta, factor, bottom, clip=True)
+
+    assert changed == 2
+    # The bilinear taps reach one proxy pixel past the stroke
+    touched = np.zeros((height, width), dtype=bool)
+    touched[4 * factor:9 * factor, 3 * factor:10 * factor] = True
+    np.testing.assert_array_equal(conformed[~touched], master[~touched])
+    assert not np.array_equal(conformed[touched], master[touched])
+
+def test_merge_over_matches_stacked_mix_layers():
+    rng = np.random.default_rng(4)
+    bottom = random_layer(rng, 16, 16)
+    layers = [random_layer(rng, 16, 16) for _ in range(3)]
+    merged = merge_over(bottom, bottom[..., 3], [(layer, layer[..., 3]) for layer in layers])
+
+    # Mixing the merged layer over any background by its alpha gives what the separate layers did
+    background = rng.random((16, 16, 3), dtype=np.float32)
+    expected = background * (1.0 - bottom[..., 3:]) + bottom[..., :3] * bottom[..., 3:]
+    for layer in layers:
+        expected = expected * (1.0 - layer[..., 3:]) + layer[..., :3] * layer[..., 3:]
+    result = background * (1.0 - merged[..., 3:]) + merged[..., :3] * merged[..., 3:]
+    np.testing.assert_allclose(result, expected, atol=1e-5)
+
+def flatten(base, layers, layer_pixels, precision):
+    """The full flatten of stack arrays, as iter_flatten_stack_pixels() blends them."""
+    stored = np.empty(base.shape, dtype=PRECISION_DTYPES[precision])
+    encode_pixels(base.copy(), precision, stored)
+    for layer, pixels in zip(layers, layer_pixels):
+        factor = pixels[..., 3] if layer.factor_source == 'ALPHA' else layer.factor
+        blend_layer_into(stored, pixels, BLEND_KERNELS[layer.blend_type], factor, layer.clamp, band_rows=16, precision=precision)
+    return decode_pixels(stored, precision).astype(np.float32)
+
+@pytest.mark.parametrize("precision", list(PRECISION_DTYPES))
+def test_incremental_flatten_matches_full_flatten(precision):
+    rng = np.random.default_rng(5)
+    tile_size, height, width = 32, 96, 80
+    base = random_layer(rng, height, width)
+    layers = [Layer('MIX', 'ALPHA', None, False), Layer('MULTIPLY', 'VALUE', 0.6, False), Layer('OVERLAY', 'ALPHA', None, True)]
+    layer_pixels = [random_layer(rng, height, width) for _ in layers]
+    result = flatten(base, layers, layer_pixels, precision)
+
+    images = [base] + layer_pixels
+    old_checksums = [tile_checksums(pixels, tile_size) for pixels in images]
+    layer_pixels[1][40:45, 50:70] = (0.2, 0.9, 0.4, 1.0)
+    layer_pixels[2][0:3, 0:3] = 0.0
+    new_checksums = [tile_checksums(pixels, tile_size) for pixels in images]
+
+    dirty = np.zeros(old_checksums[0].shape, dtype=bool)
+    for old, new in zip(old_checksums, new_checksums):
+        dirty |= old != new
+    assert dirty.sum() == 3
+
+    reflatten_dirty_tiles(result, layers, [cut_tiles(pixels, np.argwhere(dirty), tile_size) for pixels in images], precision)
+    np.testing.assert_array_equal(result, flatten(base, layers, layer_pixels, precision))